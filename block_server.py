@@ -0,0 +1,239 @@
+#!/usr/bin/python
+
+import os
+import signal
+import socket
+import logging
+import argparse
+import threading
+import socketserver
+
+import protocol
+import iotrace
+from error import *
+from log import Logger
+from disk import FileDisk, MemoryDisk
+from worker_pool import WorkerPool, WORKER_SLOTS
+
+
+class _BlockRequestHandler(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        self.device = None
+
+    def handle(self):
+        sock = self.request
+        while True:
+            try:
+                header = protocol.recv_exact(sock, protocol.REQUEST.size)
+            except (EOFError, OSError):
+                return
+            op, tag, offset, length = protocol.REQUEST.unpack(header)
+            payload = None
+            if op in (protocol.OP_ATTACH, protocol.OP_WRITE):
+                try:
+                    payload = protocol.recv_exact(sock, length)
+                except (EOFError, OSError):
+                    return
+            try:
+                result, data = self._dispatch(op, offset, length, payload)
+            except StorgeError as e:
+                self.server.logger.error('request %d failed: %s' % (op, e))
+                if op == protocol.OP_READ:
+                    result, data = err_read_data_fail, None
+                else:
+                    result, data = err_write_data_fail, None
+            if data is None:
+                data_length = 0
+            else:
+                data_length = len(data)
+            response = protocol.RESPONSE.pack(result, tag, data_length)
+            try:
+                protocol.send_message(sock, response, data)
+            except OSError:
+                return
+
+    def _dispatch(self, op, offset, length, payload):
+        if op == protocol.OP_ATTACH:
+            name = bytes(payload).decode('utf-8')
+            device = self.server.exports.get(name)
+            if device is None:
+                return err_invalid_argument, None
+            self.device = device
+            return err_success, protocol.SIZE.pack(device.size)
+        if self.device is None:
+            return err_invalid_argument, None
+        if op == protocol.OP_READ:
+            return self.device.read(offset, length)
+        if op == protocol.OP_WRITE:
+            return self.device.write(payload, offset), None
+        if op == protocol.OP_FLUSH:
+            return self.device.flush(), None
+        return err_invalid_argument, None
+
+
+class _WorkerRequestHandler(socketserver.BaseRequestHandler):
+
+    '''serve the LUNs of a WorkerPool, payloads go straight between the
+    socket and the shared memory the workers read and write'''
+
+    def setup(self):
+        self.lun = None
+
+    def handle(self):
+        sock = self.request
+        pool = self.server.pool
+        while True:
+            try:
+                header = protocol.recv_exact(sock, protocol.REQUEST.size)
+                op, tag, offset, length = protocol.REQUEST.unpack(header)
+                if op == protocol.OP_ATTACH:
+                    name = bytes(protocol.recv_exact(sock, length)).decode('utf-8')
+                    size = pool.size_of(name)
+                    if size is None:
+                        self._respond(err_invalid_argument, tag)
+                    else:
+                        self.lun = name
+                        self._respond(err_success, tag, protocol.SIZE.pack(size))
+                elif op == protocol.OP_WRITE:
+                    with pool.buffer(length) as buffer:
+                        protocol.recv_into(sock, buffer.view)
+                        result = err_invalid_argument
+                        if self.lun is not None:
+                            result = pool.write(self.lun, buffer, offset)
+                    self._respond(result, tag)
+                elif op == protocol.OP_READ and self.lun is not None:
+                    with pool.buffer(length) as buffer:
+                        result = pool.read(self.lun, buffer, offset)
+                        self._respond(result, tag, buffer.view
+                                      if is_success(result) else None)
+                elif op == protocol.OP_FLUSH and self.lun is not None:
+                    self._respond(pool.flush(), tag)
+                else:
+                    self._respond(err_invalid_argument, tag)
+            except (EOFError, OSError):
+                return
+
+    def _respond(self, result, tag, data=None):
+        length = 0 if data is None else len(data)
+        protocol.send_message(self.request,
+                              protocol.RESPONSE.pack(result, tag, length), data)
+
+
+class _TcpServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class BlockServer(object):
+
+    '''serve devices to NetworkDisk clients, one thread per connection.
+    Given a WorkerPool instead of exports, serve the LUNs of its worker
+    processes'''
+
+    def __init__(self, exports, address, pool=None):
+        family, addr = protocol.parse_address(address)
+        handler = _BlockRequestHandler if pool is None else _WorkerRequestHandler
+        if family == socket.AF_UNIX:
+            if os.path.exists(addr):
+                os.unlink(addr)
+            self._server = _UnixServer(addr, handler)
+        else:
+            self._server = _TcpServer(addr, handler)
+        self._server.exports = exports
+        self._server.pool = pool
+        self._server.logger = Logger.get_logger('runtime.log')
+        self._family = family
+        self._thread = None
+
+    @property
+    def address(self):
+        addr = self._server.server_address
+        if self._family == socket.AF_UNIX:
+            return addr
+        return '%s:%d' % addr
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def shutdown(self):
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+        if self._family == socket.AF_UNIX:
+            addr = self._server.server_address
+            if os.path.exists(addr):
+                os.unlink(addr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='export disks over a socket')
+    parser.add_argument('address', help='host:port or unix socket path')
+    parser.add_argument('--file', action='append', default=[],
+                        metavar='NAME=PATHNAME', help='export a file disk')
+    parser.add_argument('--memory', action='append', default=[],
+                        metavar='NAME=SIZE', help='export a memory disk')
+    parser.add_argument('--system', metavar='SYSTEM_JSON',
+                        help='export the LUNs of a block system instead, '
+                        'served by worker processes')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes, one per core by default')
+    parser.add_argument('--slots', type=int, default=WORKER_SLOTS,
+                        help='1M shared memory slots for payloads')
+    parser.add_argument('--debug', action='store_true',
+                        help='log every I/O to runtime.log')
+    parser.add_argument('--trace', metavar='PATHNAME',
+                        help='trace I/O, dumped to PATHNAME on SIGUSR1 and exit')
+    parser.add_argument('--trace-sample', type=int, default=iotrace.TRACE_SAMPLE,
+                        metavar='N', help='trace one I/O in every N')
+    args = parser.parse_args()
+    if args.system is not None and (args.file or args.memory):
+        parser.error('--system can not be combined with --file or --memory')
+    if args.system is not None and args.trace is not None:
+        # the I/O runs in the worker processes
+        parser.error('--trace can not be combined with --system')
+
+    if args.debug:
+        Logger.set_level(logging.DEBUG)
+    if args.trace is not None:
+        iotrace.enable(sample=args.trace_sample)
+        signal.signal(signal.SIGUSR1,
+                      lambda signum, frame: iotrace.tracer.dump(args.trace))
+
+    exports = {}
+    pool = None
+    if args.system is not None:
+        pool = WorkerPool(args.system, args.workers, args.slots)
+    for spec in args.file:
+        name, _, pathname = spec.partition('=')
+        exports[name] = FileDisk(name, pathname)
+    for spec in args.memory:
+        name, _, size = spec.partition('=')
+        exports[name] = MemoryDisk(name, int(size))
+
+    server = BlockServer(exports, args.address, pool)
+    if pool is not None:
+        print('serving %s with %d workers on %s' %
+              (args.system, pool.num_workers, server.address))
+    else:
+        print('serving %s on %s' % (', '.join(sorted(exports)), server.address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if pool is not None:
+            pool.close()
+        if args.trace is not None:
+            iotrace.disable().dump(args.trace)
@@ -1,64 +1,617 @@
 #!/usr/bin/python
 
+import os
 import json
+import threading
+import collections
 
 from error import *
-from disk import FileDisk
+from disk import FileDisk, MemoryDisk, NetworkDisk
 from raid import *
-from lun import Lun
+from lun import Lun, ThinLun
+from pool import ChunkPool, POOL_DEFAULT_CHUNK
+from compress import CompressedLun, COMPRESS_DEFAULT_CHUNK, \
+    COMPRESS_DEFAULT_LEVEL
+from dedup import DedupStore, DedupLun, DEDUP_DEFAULT_CACHE
+from qos import QosScheduler, QOS_DEFAULT_DEPTH
+from topology import TopologyCache
+from buffer_cache import BufferCache, CachedDevice, BUFFER_CACHE_BLOCKS, \
+    BUFFER_CACHE_BLOCK, BUFFER_CACHE_INTERVAL, BUFFER_CACHE_POLICY
+from wal import WriteAheadLog, WAL_CHECKPOINT_INTERVAL
+
+QOS_OPTIONS = ('iops', 'bps', 'burst_iops', 'burst_bps',
+               'reserve_iops', 'reserve_bps', 'weight')
+READAHEAD_OPTIONS = ('min_window', 'max_window', 'streams', 'workers')
+# lun options apply_config changes without rebuilding the lun
+LUN_LIVE_OPTIONS = ('raids', 'qos', 'cache', 'readahead', 'wal')
+
+
+# the sections of system.json, in the order they are built
+CONF_SECTIONS = ('disks', 'raids', 'pools', 'luns')
+
+RAID_CLASS = {'RAID0': Raid0, 'RAID1': Raid1,
+              'RAID01': Raid01, 'RAID10': Raid10, 'RAID5': Raid5}
+
+
+def _index_conf(sys_conf):
+    return dict((section, collections.OrderedDict(
+        (conf['name'], conf) for conf in sys_conf.get(section, [])))
+        for section in CONF_SECTIONS)
+
+
+def _lun_kind(conf):
+    if conf.get('dedup'):
+        return 'dedup'
+    if 'pool' in conf:
+        return 'thin'
+    if 'compress' in conf:
+        return 'compress'
+    return 'thick'
+
+
+def _without(conf, *keys):
+    return dict((key, value) for key, value in conf.items() if key not in keys)
 
 
 class BlockSystem(object):
 
-    def __init__(self, system_db_name):
+    def __init__(self, system_db_name, topology_cache=None):
         self._system_db_name = system_db_name
+        # optional file remembering the disk sizes of the last good build
+        self._topology = None
+        if topology_cache is not None:
+            self._topology = TopologyCache(topology_cache)
         self.disks = {}
         self.raids = {}
+        self.pools = {}
         self.luns = {}
+        self.qos = None
+        # write-back block cache and the luns with "cache": true over it
+        self.cache = None
+        self.cached_luns = {}
+        # write-ahead log of the luns with "wal": true
+        self.wal = None
+        # fingerprint stores of the pools with dedup luns
+        self._dedup_stores = {}
+        # the configuration the live tree was built from, by section and name
+        self._conf = _index_conf({})
+        # names of the snapshot and clone luns loaded with each thin lun
+        self._members = {}
+        self._lock = threading.RLock()
         self._build_device_tree()
 
     def _build_device_tree(self):
         # load device config from json
-        with open(self._system_db_name) as f:
-            sys_conf = json.load(f)
+        with open(self._system_db_name, 'rb') as f:
+            conf_data = f.read()
+        sys_conf = json.loads(conf_data.decode('utf-8'))
 
         # create disks
         disk_conf = sys_conf['disks']
+        cached = None
+        sizes = {}
+        if self._topology is not None:
+            key = TopologyCache.make_key(conf_data)
+            cached = self._topology.load(key)
+            if cached is not None:
+                sizes = cached
         for conf in disk_conf:
-            disk_name = conf['name']
-            disk_pathname = conf['pathname']
-            self.disks[disk_name] = FileDisk(disk_name, disk_pathname)
-
-        # create raids
-        raid_class = {'RAID0': Raid0, 'RAID1': Raid1,
-                      'RAID01': Raid01, 'RAID10': Raid10, 'RAID5': Raid5}
-        raid_conf = sys_conf['raids']
-        for conf in raid_conf:
-            raid_name = conf['name']
-            raid_type = conf['type']
-            disk_list = conf['disks']
-            raid_constructor = raid_class.get(raid_type)
-            if raid_constructor is None:
-                raise InvalidArgumentError('Bad raid type: %s' % raid_type)
-            raid = raid_constructor(raid_name)
-            for disk_name in disk_list:
-                raid.add_disk(self.disks[disk_name])
-            result = raid.build()
-            if not is_success(result):
-                raise RaidBuildError('Raid build error %d' % result)
-            self.raids[raid_name] = raid
+            self._create_disk(conf, sizes.get(conf['name']))
+
+        # create raids, a cached topology was checked already
+        for conf in sys_conf['raids']:
+            self._create_raid(conf, validate=cached is None)
+
+        # create chunk pools for thin luns
+        for conf in sys_conf.get('pools', []):
+            self._create_pool(conf)
 
         # create luns
-        lun_conf = sys_conf['luns']
-        for conf in lun_conf:
-            lun_name = conf['name']
-            raid_list = conf['raids']
+        self._setup_qos(sys_conf)
+        self._setup_cache(sys_conf)
+        self._setup_wal(sys_conf)
+        for conf in sys_conf['luns']:
+            self._create_lun(conf)
+        if self.wal is not None:
+            # acknowledged writes which never made it home
+            self.wal.replay(dict((name, lun) for name, lun in self.luns.items()
+                                 if type(lun) is Lun))
+            self.wal.start()
+
+        if self._topology is not None and cached is None:
+            self._topology.save(key, dict((name, disk.size)
+                                          for name, disk in self.disks.items()))
+
+    def _create_disk(self, conf, size=None):
+        disk_name = conf['name']
+        disk_type = conf.get('type', 'file')
+        if disk_type == 'file':
+            disk = FileDisk(disk_name, conf['pathname'])
+            if 'scheduler' in conf:
+                disk.set_scheduler(conf['scheduler'])
+        elif disk_type == 'memory':
+            disk = MemoryDisk(disk_name, conf['size'])
+        elif disk_type == 'network':
+            disk = NetworkDisk(disk_name, conf['address'],
+                               conf.get('export', disk_name),
+                               conf.get('connections', 4))
+        else:
+            raise InvalidArgumentError('Bad disk type: %s' % disk_type)
+        if size is not None:
+            disk.seed_size(size)
+        self.disks[disk_name] = disk
+        self._conf['disks'][disk_name] = conf
+        return disk
+
+    def _create_raid(self, conf, validate=True):
+        raid_name = conf['name']
+        raid_type = conf['type']
+        raid_constructor = RAID_CLASS.get(raid_type)
+        if raid_constructor is None:
+            raise InvalidArgumentError('Bad raid type: %s' % raid_type)
+        options = dict((key, conf[key])
+                       for key in raid_constructor.OPTIONS if key in conf)
+        raid = raid_constructor(
+            raid_name, conf.get('stripe', RAID_DEFAULT_STRIPE), **options)
+        raid.add_disks([self.disks[disk_name] for disk_name in conf['disks']])
+        # a cached topology skips the checks, never the setup
+        result = raid.build(validate)
+        if not is_success(result):
+            raise RaidBuildError('Raid build error %d' % result)
+        self.raids[raid_name] = raid
+        self._conf['raids'][raid_name] = conf
+        return raid
+
+    def _create_pool(self, conf):
+        pool_name = conf['name']
+        pool = ChunkPool(pool_name, conf.get('chunk_size', POOL_DEFAULT_CHUNK))
+        pool.add_raids([self.raids[raid_name] for raid_name in conf['raids']])
+        self.pools[pool_name] = pool
+        self._dedup_stores[pool_name] = DedupStore(
+            pool, conf.get('dedup_cache', DEDUP_DEFAULT_CACHE))
+        self._conf['pools'][pool_name] = conf
+        return pool
+
+    def _setup_qos(self, sys_conf):
+        # every lun shares one scheduler once any of them has QoS
+        depth = sys_conf.get('qos', {}).get('depth', QOS_DEFAULT_DEPTH)
+        if self.qos is not None:
+            self.qos.depth = depth
+            return
+        if 'qos' in sys_conf or \
+                any('qos' in conf for conf in sys_conf.get('luns', [])):
+            self.qos = QosScheduler(depth)
+            for lun_name, conf in self._conf['luns'].items():
+                self._set_qos(self.luns[lun_name], conf)
+                for member_name in self._members.get(lun_name, []):
+                    self._set_qos(self.luns[member_name], {})
+
+    def _setup_cache(self, sys_conf):
+        # one cache for every cached lun, sized once when first needed
+        if self.cache is not None:
+            return
+        if 'cache' in sys_conf or \
+                any(conf.get('cache') for conf in sys_conf.get('luns', [])):
+            cache_conf = sys_conf.get('cache', {})
+            self.cache = BufferCache(
+                cache_conf.get('blocks', BUFFER_CACHE_BLOCKS),
+                cache_conf.get('block_size', BUFFER_CACHE_BLOCK),
+                cache_conf.get('interval', BUFFER_CACHE_INTERVAL),
+                cache_conf.get('dirty_limit'),
+                cache_conf.get('policy', BUFFER_CACHE_POLICY))
+
+    def _setup_wal(self, sys_conf):
+        # the log lives on a disk of its own, which no raid may use
+        if self.wal is not None or 'wal' not in sys_conf:
+            return
+        wal_conf = sys_conf['wal']
+        self.wal = WriteAheadLog(FileDisk('WAL', wal_conf['pathname']),
+                                 wal_conf.get('interval',
+                                              WAL_CHECKPOINT_INTERVAL))
+
+    def _create_lun(self, conf):
+        lun_name = conf['name']
+        members = []
+        kind = _lun_kind(conf)
+        if kind == 'dedup':
+            lun = DedupLun(lun_name, self._dedup_stores[conf['pool']],
+                           conf['size'], conf.get('map'))
+        elif kind == 'thin':
+            lun = ThinLun(lun_name, self.pools[conf['pool']], conf['size'],
+                          conf.get('map'))
+            # snapshots and clones taken by earlier runs
+            for member_conf in conf.get('snapshots', []):
+                member = lun.attach(member_conf['name'], member_conf['map'],
+                                    member_conf.get('writable', False))
+                self._set_qos(member, member_conf)
+                self.luns[member.name] = member
+                members.append(member.name)
+        elif kind == 'compress':
+            compress_conf = conf['compress']
+            lun = CompressedLun(
+                lun_name, conf.get('size'),
+                compress_conf.get('chunk_size', COMPRESS_DEFAULT_CHUNK),
+                compress_conf.get('level', COMPRESS_DEFAULT_LEVEL),
+                compress_conf.get('workers'))
+            lun.add_raids([self.raids[raid_name] for raid_name in conf['raids']])
+            result = lun.build()
+            if not is_success(result):
+                raise RaidBuildError('Compressed LUN build error %d' % result)
+        else:
             lun = Lun(lun_name)
-            for raid_name in raid_list:
-                lun.add_raid(self.raids[raid_name])
-            self.luns[lun_name] = lun
+            lun.add_raids([self.raids[raid_name] for raid_name in conf['raids']])
+        self._set_qos(lun, conf)
+        self._set_readahead(lun, conf)
+        self._set_wal(lun, conf)
+        self.luns[lun_name] = lun
+        self._set_cache(lun, conf)
+        self._members[lun_name] = members
+        self._conf['luns'][lun_name] = conf
+        return lun
+
+    def _set_qos(self, lun, conf):
+        if self.qos is None:
+            return
+        qos_conf = conf.get('qos', {})
+        limits = dict((key, qos_conf[key])
+                      for key in QOS_OPTIONS if key in qos_conf)
+        if lun.qos is None:
+            lun.qos = self.qos.add_queue(lun.name, **limits)
+        else:
+            self.qos.set_limits(lun.qos, **limits)
+
+    def _set_readahead(self, lun, conf):
+        readahead_conf = conf.get('readahead')
+        if not readahead_conf:
+            if type(lun) is Lun:
+                lun.clear_readahead()
+            return
+        if type(lun) is not Lun:
+            raise InvalidArgumentError('readahead needs a thick LUN: %s' %
+                                       lun.name)
+        if readahead_conf is True:
+            readahead_conf = {}
+        lun.set_readahead(**dict((key, readahead_conf[key])
+                                 for key in READAHEAD_OPTIONS
+                                 if key in readahead_conf))
+
+    def _set_wal(self, lun, conf):
+        if not conf.get('wal'):
+            if getattr(lun, 'wal', None) is not None:
+                # the logged writes go home before the lun leaves the log
+                result = self.wal.checkpoint()
+                if not is_success(result):
+                    raise DeviceAccessError('WAL checkpoint failed, error %d' %
+                                            result)
+                lun.wal = None
+            return
+        if type(lun) is not Lun:
+            raise InvalidArgumentError('WAL needs a thick LUN: %s' % lun.name)
+        if self.wal is None:
+            raise InvalidArgumentError('LUN %s logs to a WAL but there is '
+                                       'none' % lun.name)
+        lun.wal = self.wal
+
+    def _set_cache(self, lun, conf):
+        if conf.get('cache'):
+            if lun.name not in self.cached_luns:
+                self.cached_luns[lun.name] = CachedDevice(lun, self.cache)
+            return
+        cached = self.cached_luns.pop(lun.name, None)
+        if cached is not None:
+            result = cached.close()
+            if not is_success(result):
+                raise DeviceAccessError('write back %s failed, error %d' %
+                                        (lun.name, result))
+
+    def _remove_lun(self, lun_name):
+        conf = self._conf['luns'].pop(lun_name)
+        lun = self.luns.pop(lun_name)
+        self._set_cache(lun, {})
+        names = self._members.pop(lun_name, [])
+        luns = [self.luns.pop(name) for name in names] + [lun]
+        if _lun_kind(conf) in ('thick', 'compress'):
+            # the raids may live on in another lun, do not let close reach them
+            for raid_name in conf['raids']:
+                lun.remove_raid(self.raids[raid_name])
+        for item in luns:
+            item.close()
+            if item.qos is not None:
+                self.qos.remove_queue(item.qos)
+                item.qos = None
+
+    def _raid_fates(self, new):
+        '''decide what happens to every live raid: 'keep' it, change its
+        'members' in place, 'replace' it or 'remove' it'''
+        replaced_disks = set(name for name, conf in self._conf['disks'].items()
+                             if name in new['disks'] and
+                             new['disks'][name] != conf)
+        fates = {}
+        for raid_name, conf in self._conf['raids'].items():
+            new_conf = new['raids'].get(raid_name)
+            if new_conf is None:
+                fates[raid_name] = 'remove'
+            elif replaced_disks.intersection(conf['disks']):
+                fates[raid_name] = 'replace'
+            elif new_conf == conf:
+                fates[raid_name] = 'keep'
+            elif conf['type'] == 'RAID1' and \
+                    _without(conf, 'disks') == _without(new_conf, 'disks'):
+                # mirrors come and go in place, a new one is resynced by
+                # build() before it serves reads
+                fates[raid_name] = 'members'
+            else:
+                fates[raid_name] = 'replace'
+        return fates
+
+    def _check_config(self, new, fates):
+        '''refuse a configuration with dangling names, or one which would
+        change the layout under a pool or a compressed lun'''
+        for section, names in (('raids', 'disks'), ('pools', 'raids'),
+                               ('luns', 'raids')):
+            known = new[names]
+            for conf in new[section].values():
+                for name in conf.get(names, []):
+                    if name not in known:
+                        raise InvalidArgumentError('%s uses unknown %s' %
+                                                   (conf['name'], name))
+        for lun_name, conf in new['luns'].items():
+            if 'pool' in conf and conf['pool'] not in new['pools']:
+                raise InvalidArgumentError('LUN %s uses unknown pool %s' %
+                                           (lun_name, conf['pool']))
+        for pool_name, conf in new['pools'].items():
+            old = self._conf['pools'].get(pool_name)
+            if old is None:
+                continue
+            kept = old['raids']
+            if old.get('chunk_size') != conf.get('chunk_size') or \
+                    conf['raids'][:len(kept)] != kept or \
+                    any(fates[name] == 'replace' for name in kept):
+                raise InvalidArgumentError(
+                    'pool %s can only grow by appending raids' % pool_name)
+        for lun_name, conf in new['luns'].items():
+            old = self._conf['luns'].get(lun_name)
+            if old is None or _lun_kind(old) != 'compress' or \
+                    _lun_kind(conf) != 'compress':
+                continue
+            if old['raids'] != conf['raids'] or \
+                    any(fates[name] == 'replace' for name in old['raids']):
+                raise InvalidArgumentError(
+                    'compressed LUN %s can not change raids' % lun_name)
+
+    def apply_config(self, sys_conf):
+        '''move the live tree to a new system.json configuration. Only the
+        devices whose configuration changed are touched, I/O to every other
+        LUN keeps running. A LUN or pool grows online when raids are
+        appended to it and a RAID1 takes or drops mirrors in place, any
+        other change to a device replaces it'''
+        with self._lock:
+            new = _index_conf(sys_conf)
+            fates = self._raid_fates(new)
+            self._check_config(new, fates)
+            conf = self._conf
+
+            # a disk with a new configuration is a new disk
+            stale_disks = {}
+            for disk_name, disk_conf in list(conf['disks'].items()):
+                if new['disks'].get(disk_name) != disk_conf:
+                    stale_disks[disk_name] = self.disks.pop(disk_name)
+                    del conf['disks'][disk_name]
+            for disk_name, disk_conf in new['disks'].items():
+                if disk_name not in self.disks:
+                    self._create_disk(disk_conf)
+
+            for raid_name, fate in fates.items():
+                if fate != 'members':
+                    continue
+                raid = self.raids[raid_name]
+                old_disks = conf['raids'][raid_name]['disks']
+                new_disks = new['raids'][raid_name]['disks']
+                for disk_name in new_disks:
+                    if disk_name not in old_disks:
+                        raid.add_disk(self.disks[disk_name])
+                for disk_name in old_disks:
+                    if disk_name not in new_disks:
+                        raid.remove_disk(stale_disks.get(disk_name) or
+                                         self.disks[disk_name])
+                result = raid.build()
+                if not is_success(result):
+                    raise RaidBuildError('Raid build error %d' % result)
+                conf['raids'][raid_name] = new['raids'][raid_name]
+
+            # luns let go of the raids which go away
+            for lun_name, lun_conf in list(conf['luns'].items()):
+                new_conf = new['luns'].get(lun_name)
+                if new_conf is None or \
+                        _lun_kind(new_conf) != _lun_kind(lun_conf) or \
+                        _without(new_conf, *LUN_LIVE_OPTIONS) != \
+                        _without(lun_conf, *LUN_LIVE_OPTIONS):
+                    self._remove_lun(lun_name)
+                    continue
+                if _lun_kind(lun_conf) != 'thick':
+                    continue
+                # keep the longest unchanged head of the concat, dropping
+                # from the tail so the offsets of the kept raids never move
+                raids = lun_conf['raids']
+                keep = 0
+                while keep < min(len(raids), len(new_conf['raids'])) and \
+                        raids[keep] == new_conf['raids'][keep] and \
+                        fates[raids[keep]] != 'replace':
+                    keep += 1
+                lun = self.luns[lun_name]
+                cached = self.cached_luns.get(lun_name)
+                if cached is not None and keep < len(raids):
+                    # write back before the tail goes away
+                    cached.close()
+                for raid_name in reversed(raids[keep:]):
+                    lun.remove_raid(self.raids[raid_name])
+                conf['luns'][lun_name] = dict(lun_conf, raids=raids[:keep])
+
+            for pool_name in list(conf['pools']):
+                if pool_name not in new['pools']:
+                    pool = self.pools.pop(pool_name)
+                    for raid_name in conf['pools'][pool_name]['raids']:
+                        pool.remove_raid(self.raids[raid_name])
+                    self._dedup_stores.pop(pool_name, None)
+                    del conf['pools'][pool_name]
+
+            retired = []
+            for raid_name, fate in fates.items():
+                if fate in ('remove', 'replace'):
+                    retired.append(self.raids.pop(raid_name))
+                    del conf['raids'][raid_name]
+            for raid_name, raid_conf in new['raids'].items():
+                if raid_name not in self.raids:
+                    self._create_raid(raid_conf)
+
+            for pool_name, pool_conf in new['pools'].items():
+                if pool_name not in self.pools:
+                    self._create_pool(pool_conf)
+                    continue
+                grown = pool_conf['raids'][len(conf['pools'][pool_name]['raids']):]
+                self.pools[pool_name].add_raids(
+                    [self.raids[raid_name] for raid_name in grown])
+                conf['pools'][pool_name] = pool_conf
+
+            self._setup_qos(sys_conf)
+            self._setup_cache(sys_conf)
+            self._setup_wal(sys_conf)
+            for lun_name, lun_conf in new['luns'].items():
+                if lun_name not in self.luns:
+                    self._create_lun(lun_conf)
+                    continue
+                current = conf['luns'][lun_name]
+                if _lun_kind(lun_conf) == 'thick':
+                    self.luns[lun_name].add_raids(
+                        [self.raids[raid_name] for raid_name in
+                         lun_conf['raids'][len(current['raids']):]])
+                if current.get('qos') != lun_conf.get('qos'):
+                    self._set_qos(self.luns[lun_name], lun_conf)
+                if current.get('wal') != lun_conf.get('wal'):
+                    self._set_wal(self.luns[lun_name], lun_conf)
+                if current.get('readahead') != lun_conf.get('readahead'):
+                    self._set_readahead(self.luns[lun_name], lun_conf)
+                if current.get('cache') != lun_conf.get('cache'):
+                    self._set_cache(self.luns[lun_name], lun_conf)
+                conf['luns'][lun_name] = lun_conf
+
+            for raid in retired:
+                raid.release()
+            for disk in stale_disks.values():
+                disk.close()
+            return err_success
+
+    def snapshot_lun(self, lun_name, name, map_pathname, writable=False):
+        '''snapshot a thin LUN, or clone it when writable, and record the new
+        LUN in system.json. The next start attaches it again, its chunks
+        would look free to the pool otherwise'''
+        with self._lock:
+            conf = self._conf['luns'].get(lun_name)
+            if conf is None or _lun_kind(conf) != 'thin':
+                raise InvalidArgumentError('%s is not a thin LUN' % lun_name)
+            if name in self.luns:
+                raise InvalidArgumentError('LUN %s already exists' % name)
+            lun = self.luns[lun_name]
+            if writable:
+                member = lun.clone(name, map_pathname)
+            else:
+                member = lun.snapshot(name, map_pathname)
+            member_conf = {'name': name, 'map': map_pathname}
+            if writable:
+                member_conf['writable'] = True
+            conf = dict(conf, snapshots=conf.get('snapshots', []) +
+                        [member_conf])
+            try:
+                # the map is on disk before system.json points at it
+                result = member.flush()
+                if not is_success(result):
+                    raise DeviceAccessError('flush %s failed, error %d' %
+                                            (name, result))
+                self._save_lun_conf(conf)
+            except StorgeError:
+                member.delete()
+                raise
+            self._conf['luns'][lun_name] = conf
+            self._set_qos(member, member_conf)
+            self.luns[name] = member
+            self._members[lun_name].append(name)
+        return member
+
+    def delete_snapshot(self, name):
+        '''drop a snapshot or clone from system.json, then free its chunks'''
+        with self._lock:
+            for lun_name, names in self._members.items():
+                if name in names:
+                    break
+            else:
+                raise InvalidArgumentError('%s is not a snapshot or clone' %
+                                           name)
+            conf = self._conf['luns'][lun_name]
+            conf = dict(conf, snapshots=[member_conf for member_conf
+                                         in conf.get('snapshots', [])
+                                         if member_conf['name'] != name])
+            self._save_lun_conf(conf)
+            self._conf['luns'][lun_name] = conf
+            names.remove(name)
+            member = self.luns.pop(name)
+            if member.qos is not None:
+                self.qos.remove_queue(member.qos)
+                member.qos = None
+            return member.delete()
+
+    def _save_lun_conf(self, lun_conf):
+        '''put the configuration of a LUN into system.json'''
+        try:
+            with open(self._system_db_name) as f:
+                sys_conf = json.load(f)
+            luns = sys_conf.setdefault('luns', [])
+            names = [conf['name'] for conf in luns]
+            if lun_conf['name'] in names:
+                luns[names.index(lun_conf['name'])] = lun_conf
+            else:
+                luns.append(lun_conf)
+            temp = '%s.tmp' % self._system_db_name
+            with open(temp, 'w') as f:
+                json.dump(sys_conf, f, indent=4)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp, self._system_db_name)
+        except (OSError, ValueError) as e:
+            raise DeviceAccessError(str(e))
+
+    def flush(self):
+        # dirty cached blocks reach the luns before anything is flushed
+        if self.cache is not None:
+            result = self.cache.sync()
+            if not is_success(result):
+                return result
+        for _, disk in self.disks.items():
+            result = disk.flush()
+            if not is_success(result):
+                return result
+        # thin luns persist their chunk maps
+        for _, lun in self.luns.items():
+            result = lun.flush()
+            if not is_success(result):
+                return result
+        return err_success
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.close()
+        # the last checkpoint writes the log home
+        if self.wal is not None:
+            self.wal.close()
+        for _, lun in self.luns.items():
+            lun.close()
+        for _, pool in self.pools.items():
+            pool.close()
+        for _, disk in self.disks.items():
+            disk.close()
 
     def dump_device_tree(self):
+        for _, pool in self.pools.items():
+            pool.dump_device_tree()
         for _, lun in self.luns.items():
             lun.dump_device_tree()
 
@@ -68,7 +621,7 @@ if __name__ == "__main__":
     bs.dump_device_tree()
     lun = bs.luns['LUN_0']
 
-    test_string = 'x' * 1024 * 1024 * 4  # 4M
+    test_string = b'x' * 1024 * 1024 * 4  # 4M
     test_string_length = len(test_string)
     offset = 1024 * 512
 
@@ -82,3 +635,5 @@ if __name__ == "__main__":
     print('write length: %d' % test_string_length)
     print('read result: %d' % result)
     print('read length: %d' % len(read_string))
+
+    bs.close()
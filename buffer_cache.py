@@ -0,0 +1,440 @@
+#!/usr/bin/python
+
+import time
+import threading
+
+from error import *
+from device import Device, byte_view
+from lru import make_cache
+from storage import Storage
+
+BUFFER_CACHE_BLOCK = 4096
+BUFFER_CACHE_BLOCKS = 4096  # 16M of 4K blocks
+BUFFER_CACHE_INTERVAL = 1.0  # seconds between background flushes
+BUFFER_CACHE_POLICY = '2q'  # a scan must not flush the hot blocks
+
+
+class BufferCache(Storage):
+
+    '''a write-back cache of device blocks, keyed by (device, block) and
+    shared by every CachedDevice on it.
+
+    Blocks live in a cache of capacity blocks under the eviction policy,
+    which sees every read and write of them. A written block stays there
+    and is also one of the dirty blocks of its device, up to dirty_limit
+    of them, which hold it until it is written back even if the policy
+    evicts it: a background thread writes them back every interval, or
+    sooner once half of dirty_limit is reached, sorted by block and
+    coalesced into one vectored write per device. A writer which finds
+    dirty_limit blocks dirty flushes inline.
+
+    Device I/O runs outside the cache lock. A block being read in is
+    marked loading and every other access to it waits for the read, a
+    block being written back is marked flushing and no second write back
+    of it starts until the first is done.'''
+
+    def __init__(self, capacity=BUFFER_CACHE_BLOCKS, block_size=BUFFER_CACHE_BLOCK,
+                 interval=BUFFER_CACHE_INTERVAL, dirty_limit=None,
+                 policy=BUFFER_CACHE_POLICY):
+        super(BufferCache, self).__init__()
+        if capacity <= 0 or block_size <= 0:
+            raise InvalidArgumentError('Bad buffer cache: %d blocks of %d' %
+                                       (capacity, block_size))
+        self._block_size = block_size
+        self._capacity = capacity
+        # the blocks kept for reads, dirty ones are held by _dirty as well
+        # so evicting a block never needs a write back
+        self._blocks = make_cache(policy, capacity)
+        # device -> {block number: data} of the blocks newer than the device
+        self._dirty = {}
+        self._num_dirty = 0
+        # (device, block) -> data being written back
+        self._flushing = {}
+        # (device, block) being read in
+        self._loading = set()
+        self._dirty_limit = dirty_limit or max(1, capacity // 2)
+        self._background = max(1, self._dirty_limit // 2)
+        self._interval = interval
+        self._cond = threading.Condition()
+        self._stop = False
+        self.hits = 0
+        self.misses = 0
+        self.write_backs = 0
+        self._flusher = threading.Thread(target=self._flush_loop,
+                                         name='buffer-cache-flusher')
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    @property
+    def block_size(self):
+        return self._block_size
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @property
+    def num_dirty(self):
+        return self._num_dirty
+
+    def stats(self):
+        with self._cond:
+            return {'policy': self._blocks.name,
+                    'blocks': len(self._blocks), 'dirty': self._num_dirty,
+                    'flushing': len(self._flushing),
+                    'hits': self.hits, 'misses': self.misses,
+                    'evictions': self._blocks.evictions,
+                    'write_backs': self.write_backs}
+
+    def _span(self, device, block):
+        '''the length of a block, the last one of a device may be short'''
+        return min(self._block_size, device.size - block * self._block_size)
+
+    def _blocks_of(self, offset, length):
+        '''split a range into (block, offset in block, position, length)'''
+        block_size = self._block_size
+        position = 0
+        while position < length:
+            block, start = divmod(offset + position, block_size)
+            piece = min(block_size - start, length - position)
+            yield block, start, position, piece
+            position += piece
+
+    def _runs(self, blocks):
+        '''group sorted block numbers into runs of back to back blocks'''
+        run = []
+        for block in blocks:
+            if run and block != run[-1] + 1:
+                yield run
+                run = []
+            run.append(block)
+        if run:
+            yield run
+
+    def _lookup(self, device, block, touch=True):
+        '''the newest copy of a cached block, or None, with the lock held.
+        A touch counts as an access for the eviction policy'''
+        key = (device, block)
+        if touch:
+            data = self._blocks.get(key)
+        else:
+            data = self._blocks.peek(key)
+        dirty = self._dirty.get(device)
+        if dirty is not None and block in dirty:
+            return dirty[block]
+        return self._flushing.get(key, data)
+
+    def _wait_loading(self, device, blocks):
+        while any((device, block) in self._loading for block in blocks):
+            self._cond.wait()
+
+    def _load(self, device, blocks, pinned=(), keep=True):
+        '''read uncached blocks, one request per run, return block -> data,
+        and cache them when keep is set. Called with the lock held, which
+        is dropped for the read, the pinned blocks are held off from other
+        threads meanwhile too'''
+        block_size = self._block_size
+        keys = [(device, block) for block in list(blocks) + list(pinned)]
+        self._loading.update(keys)
+        self.misses += len(blocks)
+        self._cond.release()
+        try:
+            runs = []
+            iov = []
+            for run in self._runs(sorted(blocks)):
+                start = run[0] * block_size
+                buffer = bytearray(run[-1] * block_size +
+                                   self._span(device, run[-1]) - start)
+                runs.append((run, buffer))
+                iov.append((buffer, start))
+            result = device.readv_into(iov)
+        finally:
+            self._cond.acquire()
+            self._loading.difference_update(keys)
+            self._cond.notify_all()
+        if not is_success(result):
+            raise DeviceAccessError('read blocks of %s failed, error %d' %
+                                    (device.name, result))
+        loaded = {}
+        for run, buffer in runs:
+            for i, block in enumerate(run):
+                data = buffer[i * block_size:(i + 1) * block_size]
+                loaded[block] = data
+                if keep:
+                    # nothing touched the block while it was loading
+                    self._blocks.set((device, block), data)
+        return loaded
+
+    def readv_into(self, device, iov):
+        with self._cond:
+            blocks = set()
+            for buffer, offset in iov:
+                for block, _, _, _ in self._blocks_of(offset, len(buffer)):
+                    blocks.add(block)
+            self._wait_loading(device, blocks)
+            missing = {}
+            for buffer, offset in iov:
+                for block, start, position, length in \
+                        self._blocks_of(offset, len(buffer)):
+                    data = self._lookup(device, block)
+                    piece = buffer[position:position + length]
+                    if data is None:
+                        missing.setdefault(block, []).append((start, piece))
+                        continue
+                    self.hits += 1
+                    piece[:] = data[start:start + length]
+            if missing:
+                loaded = self._load(device, list(missing))
+                for block, pieces in missing.items():
+                    data = loaded[block]
+                    for start, piece in pieces:
+                        piece[:] = data[start:start + len(piece)]
+        return err_success
+
+    def writev(self, device, iov):
+        with self._cond:
+            blocks = set()
+            partial = set()
+            for data, offset in iov:
+                for block, _, _, length in self._blocks_of(offset, len(data)):
+                    blocks.add(block)
+                    if length != self._span(device, block):
+                        partial.add(block)
+            self._wait_loading(device, blocks)
+            # blocks written in part and not cached are read first, the
+            # cached ones are kept, eviction may drop them during the read
+            held = {}
+            missing = []
+            for block in partial:
+                data = self._lookup(device, block, touch=False)
+                if data is None:
+                    missing.append(block)
+                else:
+                    held[block] = data
+            if missing:
+                # the write below is the one access the policy sees
+                held.update(self._load(device, missing, held, keep=False))
+            dirty = self._dirty.setdefault(device, {})
+            written = {}
+            for data, offset in iov:
+                for block, start, position, length in \
+                        self._blocks_of(offset, len(data)):
+                    entry = dirty.get(block)
+                    if entry is None:
+                        entry = self._lookup(device, block, touch=False)
+                        if entry is None:
+                            entry = held.get(block)
+                        if entry is None:
+                            entry = bytearray(self._span(device, block))
+                        dirty[block] = entry
+                        self._num_dirty += 1
+                    entry[start:start + length] = data[position:position + length]
+                    written[block] = entry
+            # a rewrite is a reference, the block keeps its place and history
+            for block, entry in written.items():
+                self._blocks.set((device, block), entry)
+            over = self._num_dirty >= self._dirty_limit
+            if not over and self._num_dirty >= self._background:
+                self._cond.notify_all()
+        if over:
+            # writers outrun the flusher, make them pay for it
+            return self._flush(list(self._dirty))
+        return err_success
+
+    def _flush(self, devices):
+        '''write back the dirty blocks of devices which are not already on
+        their way, outside the lock'''
+        result = err_success
+        for device in devices:
+            with self._cond:
+                dirty = self._dirty.get(device)
+                if not dirty:
+                    continue
+                blocks = sorted(block for block in dirty
+                                if (device, block) not in self._flushing)
+                if not blocks:
+                    continue
+                taken = {}
+                for block in blocks:
+                    taken[block] = dirty.pop(block)
+                    self._flushing[(device, block)] = taken[block]
+                self._num_dirty -= len(blocks)
+                if not dirty:
+                    del self._dirty[device]
+                # a snapshot, writers may change the blocks in flight
+                block_size = self._block_size
+                iov = [(b''.join(taken[block] for block in run),
+                        run[0] * block_size) for run in self._runs(blocks)]
+            device_result = err_write_data_fail
+            try:
+                device_result = device.writev(iov)
+            finally:
+                with self._cond:
+                    self._finish_flush(device, taken, is_success(device_result))
+            if not is_success(device_result):
+                # the blocks stay dirty for the next try
+                self.logger.error('flush %s failed, error %d' %
+                                  (device.name, device_result))
+                if is_success(result):
+                    result = device_result
+        return result
+
+    def _finish_flush(self, device, taken, written):
+        dirty = self._dirty.setdefault(device, {})
+        for block, data in taken.items():
+            key = (device, block)
+            del self._flushing[key]
+            if block in dirty:
+                # written again in flight, it goes back with the next flush
+                continue
+            if not written:
+                dirty[block] = data
+                self._num_dirty += 1
+        if written:
+            self.write_backs += len(taken)
+        if not dirty:
+            del self._dirty[device]
+        self._cond.notify_all()
+
+    def _flush_loop(self):
+        while True:
+            with self._cond:
+                deadline = time.monotonic() + self._interval
+                while not self._stop and self._num_dirty < self._background:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self._cond.wait(timeout)
+                if self._stop:
+                    return
+                devices = list(self._dirty)
+            try:
+                self._flush(devices)
+            except StorgeError as e:
+                self.logger.error('buffer cache flush: %s' % e)
+
+    def sync(self, device=None):
+        '''write every dirty block, of one device or of all, back now'''
+        with self._cond:
+            devices = [device] if device is not None else list(self._dirty)
+        # a second pass takes the blocks written again while a background
+        # write back of them was in flight
+        for _ in range(2):
+            result = self._flush(devices)
+            if not is_success(result):
+                return result
+            with self._cond:
+                while any(key[0] in devices for key in self._flushing):
+                    self._cond.wait()
+        return err_success
+
+    def drop(self, device):
+        '''write back and forget the blocks of a device'''
+        result = self.sync(device)
+        if not is_success(result):
+            return result
+        with self._cond:
+            for key in self._blocks.keys():
+                if key[0] is device:
+                    self._blocks.delete(key)
+        return err_success
+
+    def close(self):
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        self._flusher.join()
+        return self.sync()
+
+
+class CachedDevice(Device):
+
+    '''a device whose I/O goes through a BufferCache. Once a device is
+    cached every read and write of it has to go through its CachedDevice,
+    or the cache goes stale'''
+
+    def __init__(self, device, cache):
+        super(CachedDevice, self).__init__(device.name)
+        self._device = device
+        self._cache = cache
+
+    @property
+    def device(self):
+        return self._device
+
+    @property
+    def cache(self):
+        return self._cache
+
+    @property
+    def size(self):
+        return self._device.size
+
+    @property
+    def info(self):
+        return 'cached, %s' % ', '.join('%s: %s' % item for item in
+                                         sorted(self._cache.stats().items()))
+
+    def read(self, offset, length):
+        if not self.is_valid_range(offset, length):
+            return err_invalid_argument, None
+        data = bytearray(length)
+        result = self._cache.readv_into(self._device, [(memoryview(data), offset)])
+        if not is_success(result):
+            return result, None
+        return result, data
+
+    def readv(self, iov):
+        data = []
+        for offset, length in iov:
+            if not self.is_valid_range(offset, length):
+                return err_invalid_argument, []
+            data.append(bytearray(length))
+        result = self._cache.readv_into(
+            self._device, [(memoryview(buffer), offset)
+                           for buffer, (offset, _) in zip(data, iov)])
+        if not is_success(result):
+            return result, []
+        return result, data
+
+    def readv_into(self, iov):
+        iov = [(byte_view(buffer), offset) for buffer, offset in iov]
+        for buffer, offset in iov:
+            if not self.is_valid_range(offset, len(buffer)):
+                return err_invalid_argument
+        return self._cache.readv_into(self._device, iov)
+
+    def write(self, data, offset):
+        if data is None:
+            return err_invalid_argument
+        return self.writev([(data, offset)])
+
+    def writev(self, iov):
+        views = []
+        for data, offset in iov:
+            if data is None:
+                return err_invalid_argument
+            data = byte_view(data)
+            if not self.is_valid_range(offset, len(data)):
+                return err_invalid_argument
+            views.append((data, offset))
+        return self._cache.writev(self._device, views)
+
+    def sync(self):
+        '''write back the dirty blocks of this device'''
+        return self._cache.sync(self._device)
+
+    def flush(self):
+        result = self.sync()
+        if not is_success(result):
+            return result
+        return self._device.flush()
+
+    def close(self):
+        '''write back and forget the cached blocks, the device stays open'''
+        return self._cache.drop(self._device)
+
+    def dump_device_tree(self, level=0):
+        print('%s-->%s (size: %d %s)' %
+              ('  ' * level, self.name, self.size, self.info))
+        self._device.dump_device_tree(level + 1)
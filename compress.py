@@ -0,0 +1,369 @@
+#!/usr/bin/python
+
+import os
+import zlib
+import array
+import struct
+import threading
+import contextlib
+import collections
+import concurrent.futures
+
+from error import *
+from device import byte_view
+from lun import Lun
+from qos import throttle
+
+COMPRESS_DEFAULT_CHUNK = 64 * 1024  # 64K
+COMPRESS_DEFAULT_LEVEL = 6
+COMPRESS_UNIT = 512  # compressed chunks take whole units
+COMPRESS_LOCKS = 64
+COMPRESS_MAGIC = b'CLUN'
+COMPRESS_RAW = 0x80000000  # stored length flag, the chunk did not compress
+
+# magic, chunk size, logical size, then the chunk index
+_HEADER = struct.Struct('!4sIQ')
+
+
+def _units(length):
+    return (length + COMPRESS_UNIT - 1) // COMPRESS_UNIT
+
+
+class CompressedLun(Lun):
+
+    '''a LUN which stores each fixed size logical chunk zlib compressed.
+
+    The start of the raids holds a header and the chunk index, one
+    (unit, stored length) pair per chunk, where a stored length of 0 means
+    the chunk was never written or is all zeros. Compressed chunks are
+    packed into COMPRESS_UNIT sized units after the index. A chunk which
+    does not save a unit is stored raw and read without decompressing.
+
+    zlib drops the GIL, so chunks of one request compress in parallel on a
+    thread pool.'''
+
+    def __init__(self, name, size=None, chunk_size=COMPRESS_DEFAULT_CHUNK,
+                 level=COMPRESS_DEFAULT_LEVEL, workers=None):
+        if chunk_size <= 0 or chunk_size % COMPRESS_UNIT:
+            raise InvalidArgumentError('Bad chunk size: %d' % chunk_size)
+        if not -1 <= level <= 9:
+            raise InvalidArgumentError('Bad compression level: %d' % level)
+        self._logical_size = size
+        self._chunk_size = chunk_size
+        self._level = level
+        self._index = None
+        super(CompressedLun, self).__init__(name)
+        self._zero = bytes(chunk_size)
+        self._data_start = 0
+        self._used = bytearray()
+        self._hint = 0
+        self._alloc_lock = threading.Lock()
+        self._locks = [threading.Lock() for _ in range(COMPRESS_LOCKS)]
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            workers or os.cpu_count() or 1)
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    @property
+    def chunk_size(self):
+        return self._chunk_size
+
+    @property
+    def level(self):
+        return self._level
+
+    @property
+    def info(self):
+        ratio = float(self.bytes_in) / self.bytes_out if self.bytes_out else 0
+        return 'compressed, level: %d, chunk: %d, free units: %d/%d, ' \
+            'ratio: %.2f' % (self._level, self._chunk_size,
+                             self._used.count(0), len(self._used), ratio)
+
+    def update_size(self):
+        super(CompressedLun, self).update_size()
+        # until build() the LUN has no logical size
+        self._size = self._logical_size if self._index is not None else 0
+
+    def build(self):
+        '''load the chunk index from the raids, or format them when they
+        hold none, call after the raids are added. A formatted LUN keeps
+        the chunk and logical size in its header, more raids only add
+        space for chunks, and a different geometry is refused'''
+        physical = self._concat.size
+        if physical < _HEADER.size:
+            return err_disk_not_enough
+        result, header = self._concat.read(0, _HEADER.size)
+        if not is_success(result):
+            return result
+        magic, chunk_size, stored_size = _HEADER.unpack(bytes(header))
+        formatted = magic == COMPRESS_MAGIC
+        size = self._logical_size
+        if formatted:
+            if chunk_size != self._chunk_size or \
+                    (size is not None and size != stored_size):
+                self.logger.error(
+                    'compressed LUN %s has chunk %d, size %d, not chunk %d, '
+                    'size %s' % (self.name, chunk_size, stored_size,
+                                 self._chunk_size, size))
+                return err_invalid_argument
+            size = stored_size
+        elif size is None:
+            # as large as the raids, compression only saves disk writes
+            size = physical // (self._chunk_size + 8) * self._chunk_size
+        if size <= 0:
+            return err_disk_not_enough
+        num = (size + self._chunk_size - 1) // self._chunk_size
+        index_size = num * 2 * 4
+        self._data_start = _units(_HEADER.size + index_size) * COMPRESS_UNIT
+        if self._data_start + self._chunk_size > physical:
+            return err_disk_not_enough
+
+        index = array.array('I')
+        if formatted:
+            result, data = self._concat.read(_HEADER.size, index_size)
+            if not is_success(result):
+                return result
+            index.frombytes(bytes(data))
+        else:
+            self.logger.info('format compressed LUN %s' % self.name)
+            index.extend([0] * (num * 2))
+            result = self._concat.write(
+                _HEADER.pack(COMPRESS_MAGIC, self._chunk_size, size) +
+                index.tobytes(), 0)
+            if not is_success(result):
+                return result
+
+        self._used = bytearray((physical - self._data_start) // COMPRESS_UNIT)
+        for i in range(num):
+            stored = index[2 * i + 1]
+            if stored:
+                unit = index[2 * i]
+                length = _units(stored & ~COMPRESS_RAW)
+                self._used[unit:unit + length] = b'\x01' * length
+        self._index = index
+        self._logical_size = size
+        self._size = size
+        return err_success
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        return super(CompressedLun, self).close()
+
+    def _locked(self, indices):
+        '''hold the stripe locks of a set of chunks, in order'''
+        stack = contextlib.ExitStack()
+        for n in sorted(set(index % COMPRESS_LOCKS for index in indices)):
+            stack.enter_context(self._locks[n])
+        return stack
+
+    def _chunks(self, offset, length):
+        chunk_size = self._chunk_size
+        position = 0
+        while position < length:
+            index, start = divmod(offset + position, chunk_size)
+            piece = min(chunk_size - start, length - position)
+            yield index, start, position, piece
+            position += piece
+
+    def _allocate(self, count):
+        with self._alloc_lock:
+            run = bytes(count)
+            unit = self._used.find(run, self._hint)
+            if unit == -1:
+                unit = self._used.find(run, 0, self._hint + count)
+            if unit == -1:
+                raise DeviceNoEnoughSpaceError('LUN %s is full' % self.name)
+            self._used[unit:unit + count] = b'\x01' * count
+            self._hint = unit + count
+            return unit
+
+    def _free(self, unit, count):
+        with self._alloc_lock:
+            self._used[unit:unit + count] = bytes(count)
+            if unit < self._hint:
+                self._hint = unit
+
+    def _encode(self, chunk):
+        '''return (stored length, payload) for a whole chunk'''
+        if chunk == self._zero:
+            return 0, None
+        packed = zlib.compress(chunk, self._level)
+        if _units(len(packed)) >= _units(self._chunk_size):
+            return COMPRESS_RAW | self._chunk_size, chunk
+        return len(packed), packed
+
+    def _fetch(self, wanted):
+        '''read and decompress whole chunks, return index -> data'''
+        batch = []
+        blobs = collections.OrderedDict()
+        for index in wanted:
+            unit, stored = self._index[2 * index], self._index[2 * index + 1]
+            if stored == 0:
+                blobs[index] = None
+                continue
+            buffer = bytearray(stored & ~COMPRESS_RAW)
+            blobs[index] = (stored, buffer)
+            batch.append((memoryview(buffer),
+                          self._data_start + unit * COMPRESS_UNIT))
+        if batch:
+            result = self._concat.readv_into(batch)
+            if not is_success(result):
+                return result, None
+        packed = [(index, item[1]) for index, item in blobs.items()
+                  if item is not None and not item[0] & COMPRESS_RAW]
+        chunks = dict(zip([index for index, _ in packed],
+                          self._executor.map(zlib.decompress,
+                                             [blob for _, blob in packed])))
+        for index, item in blobs.items():
+            if item is None:
+                chunks[index] = self._zero
+            elif item[0] & COMPRESS_RAW:
+                chunks[index] = item[1]
+        return err_success, chunks
+
+    def _readv_into(self, iov):
+        pieces = []
+        for buffer, offset in iov:
+            for index, start, position, length in self._chunks(offset, len(buffer)):
+                pieces.append((index, start, buffer[position:position + length]))
+        wanted = set(index for index, _, _ in pieces)
+        with self._locked(wanted):
+            result, chunks = self._fetch(wanted)
+        if not is_success(result):
+            return result
+        for index, start, piece in pieces:
+            piece[:] = chunks[index][start:start + len(piece)]
+        return err_success
+
+    def _writev(self, views):
+        updates = collections.OrderedDict()
+        for data, offset in views:
+            for index, start, position, length in self._chunks(offset, len(data)):
+                updates.setdefault(index, []).append(
+                    (start, data[position:position + length]))
+        with self._locked(updates):
+            # chunks written in part are read back and merged
+            partial = [index for index, pieces in updates.items()
+                       if len(pieces) > 1 or
+                       len(pieces[0][1]) != self._chunk_size]
+            result, current = self._fetch(partial)
+            if not is_success(result):
+                return result
+            chunks = []
+            for index, pieces in updates.items():
+                if index in current:
+                    chunk = bytearray(current[index])
+                    for start, piece in pieces:
+                        chunk[start:start + len(piece)] = piece
+                else:
+                    chunk = pieces[0][1]
+                chunks.append(chunk)
+            encoded = list(self._executor.map(self._encode, chunks))
+            return self._commit(list(updates), encoded)
+
+    def _commit(self, indices, encoded):
+        '''write the encoded chunks to fresh units, then switch the index
+        over to them and free the old units'''
+        batch = []
+        placed = []
+        try:
+            for index, (stored, payload) in zip(indices, encoded):
+                unit = 0
+                if stored:
+                    unit = self._allocate(_units(stored & ~COMPRESS_RAW))
+                    batch.append((payload,
+                                  self._data_start + unit * COMPRESS_UNIT))
+                placed.append((index, unit, stored))
+        except DeviceNoEnoughSpaceError:
+            for _, unit, stored in placed:
+                if stored:
+                    self._free(unit, _units(stored & ~COMPRESS_RAW))
+            raise
+        result = self._concat.writev(batch) if batch else err_success
+        if not is_success(result):
+            for _, unit, stored in placed:
+                if stored:
+                    self._free(unit, _units(stored & ~COMPRESS_RAW))
+            return result
+
+        index_map = self._index
+        for index, unit, stored in placed:
+            old_unit, old_stored = index_map[2 * index], index_map[2 * index + 1]
+            index_map[2 * index] = unit
+            index_map[2 * index + 1] = stored
+            if old_stored:
+                self._free(old_unit, _units(old_stored & ~COMPRESS_RAW))
+        # only the entries of this commit, whose locks are held: another
+        # commit may be switching the chunks in between
+        runs = []
+        for index in sorted(indices):
+            if runs and runs[-1][1] == index:
+                runs[-1][1] = index + 1
+            else:
+                runs.append([index, index + 1])
+        result = self._concat.writev(
+            [(index_map[2 * first:2 * last].tobytes(),
+              _HEADER.size + first * 2 * 4) for first, last in runs])
+        with self._alloc_lock:
+            self.bytes_in += len(indices) * self._chunk_size
+            self.bytes_out += sum(stored & ~COMPRESS_RAW
+                                  for _, _, stored in placed)
+        return result
+
+    def read(self, offset, length):
+        if not self.is_valid_range(offset, length):
+            return err_invalid_argument, None
+        data = bytearray(length)
+        with throttle(self.qos, length):
+            result = self._readv_into([(memoryview(data), offset)])
+        if not is_success(result):
+            return result, None
+        return result, data
+
+    def readv(self, iov):
+        data = []
+        for offset, length in iov:
+            if not self.is_valid_range(offset, length):
+                return err_invalid_argument, []
+            data.append(bytearray(length))
+        with throttle(self.qos, sum(length for _, length in iov)):
+            result = self._readv_into(
+                [(memoryview(buffer), offset)
+                 for buffer, (offset, _) in zip(data, iov)])
+        if not is_success(result):
+            return result, []
+        return result, data
+
+    def read_into(self, buffer, offset):
+        return self.readv_into([(buffer, offset)])
+
+    def readv_into(self, iov):
+        iov = [(byte_view(buffer), offset) for buffer, offset in iov]
+        for buffer, offset in iov:
+            if not self.is_valid_range(offset, len(buffer)):
+                return err_invalid_argument
+        with throttle(self.qos, sum(len(buffer) for buffer, _ in iov)):
+            return self._readv_into(iov)
+
+    def write(self, data, offset):
+        if data is None:
+            return err_invalid_argument
+        return self.writev([(data, offset)])
+
+    def writev(self, iov):
+        views = []
+        for data, offset in iov:
+            if data is None:
+                return err_invalid_argument
+            data = byte_view(data)
+            if not self.is_valid_range(offset, len(data)):
+                return err_invalid_argument
+            views.append((data, offset))
+        with throttle(self.qos, sum(len(data) for data, _ in views)):
+            return self._writev(views)
+
+    async def aread(self, offset, length):
+        return await self._in_executor(self.read, offset, length)
+
+    async def awrite(self, data, offset):
+        return await self._in_executor(self.write, data, offset)
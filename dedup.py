@@ -0,0 +1,214 @@
+#!/usr/bin/python
+
+import os
+import array
+import hashlib
+import threading
+
+from error import *
+from lru import Lru
+from lun import ThinLun, THIN_UNMAPPED
+
+DEDUP_DIGEST_SIZE = 32  # BLAKE2b-256
+DEDUP_DEFAULT_CACHE = 256 * 1024  # fingerprints kept in memory
+DEDUP_LOCKS = 64
+
+
+class DedupStore(object):
+
+    '''fingerprint index and reference counts for the chunks of one pool,
+    shared by every DedupLun on it.
+
+    Reference counts cover every chunk and are rebuilt from the chunk maps
+    at load. The fingerprint index is only a bounded LRU cache: a chunk
+    whose fingerprint was evicted, or written before a restart, stays
+    valid but new writes can not dedup against it.'''
+
+    def __init__(self, pool, cache_capacity=DEDUP_DEFAULT_CACHE):
+        self._pool = pool
+        self._refs = array.array('I')
+        self._index = Lru(cache_capacity, self._evicted)
+        # chunk -> fingerprint, for the chunks in the index only
+        self._digests = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def pool(self):
+        return self._pool
+
+    def _grow(self):
+        missing = self._pool.num_chunks - len(self._refs)
+        if missing > 0:
+            self._refs.extend([0] * missing)
+
+    def _evicted(self, digest, physical):
+        self._digests.pop(physical, None)
+
+    def _forget(self, physical):
+        digest = self._digests.pop(physical, None)
+        if digest is not None:
+            self._index.delete(digest)
+
+    def _unref(self, physical):
+        if physical == THIN_UNMAPPED:
+            return
+        self._refs[physical] -= 1
+        if self._refs[physical] == 0:
+            self._forget(physical)
+            self._pool.free(physical)
+
+    def ref(self, physical):
+        with self._lock:
+            self._grow()
+            self._refs[physical] += 1
+
+    def unmap(self, physical):
+        with self._lock:
+            self._unref(physical)
+
+    def put(self, digest, data, old):
+        '''store a chunk of data whose fingerprint is digest for a logical
+        chunk which mapped old, return the pool chunk now holding the data'''
+        with self._lock:
+            physical = self._index.get(digest)
+            if physical is not None:
+                # duplicate, only the metadata changes
+                self.hits += 1
+                if physical != old:
+                    self._refs[physical] += 1
+                    self._unref(old)
+                return physical
+            self.misses += 1
+            if old != THIN_UNMAPPED and self._refs[old] == 1:
+                # nobody else maps the old chunk, overwrite it in place
+                self._forget(old)
+                target = old
+            else:
+                target = self._pool.allocate()
+                self._grow()
+                self._refs[target] = 1
+        result = self._pool.write(data, target * self._pool.chunk_size)
+        with self._lock:
+            if not is_success(result):
+                if target != old:
+                    self._unref(target)
+                raise DeviceAccessError('write chunk failed, error %d' % result)
+            if target != old:
+                self._unref(old)
+            # a racing write of the same data may have got in first
+            other = self._index.get(digest)
+            if other is not None:
+                self._digests.pop(other, None)
+            self._index.set(digest, target)
+            self._digests[target] = digest
+        return target
+
+    def stats(self):
+        with self._lock:
+            unique = len(self._refs) - self._refs.count(0)
+            return {'unique_chunks': unique,
+                    'logical_chunks': sum(self._refs),
+                    'cached_fingerprints': len(self._index),
+                    'hits': self.hits,
+                    'misses': self.misses}
+
+
+class DedupLun(ThinLun):
+
+    '''a thin LUN which stores every distinct chunk once. Chunks are
+    fingerprinted with BLAKE2b, a chunk which is already in the pool is
+    mapped instead of written, and all zero chunks are unmapped.
+
+    Use a pool with a small chunk size, 4K, to match the block size of the
+    workload.'''
+
+    def __init__(self, name, store, size, map_pathname=None):
+        self._store = store
+        super(DedupLun, self).__init__(name, store.pool, size, map_pathname)
+        self._zero = bytes(self._chunk_size)
+        self._locks = [threading.Lock() for _ in range(DEDUP_LOCKS)]
+
+    @property
+    def store(self):
+        return self._store
+
+    @property
+    def info(self):
+        return 'dedup, pool: %s, allocated: %d/%d' % (
+            self._pool.name, self.allocated_chunks, len(self._map))
+
+    def _load_map(self):
+        super(DedupLun, self)._load_map()
+        for physical in self._map:
+            if physical != THIN_UNMAPPED:
+                self._store.ref(physical)
+
+    def snapshot(self, name, map_pathname=None):
+        raise FunctionalNotImplementError('no snapshots of dedup LUN %s' %
+                                          self.name)
+
+    def clone(self, name, map_pathname=None):
+        raise FunctionalNotImplementError('no clones of dedup LUN %s' %
+                                          self.name)
+
+    def attach(self, name, map_pathname, writable=False):
+        raise FunctionalNotImplementError('no snapshots of dedup LUN %s' %
+                                          self.name)
+
+    def delete(self):
+        for index, physical in enumerate(self._map):
+            if physical != THIN_UNMAPPED:
+                self._map[index] = THIN_UNMAPPED
+                self._store.unmap(physical)
+        self.close()
+        if self._map_pathname is not None and \
+                os.path.exists(self._map_pathname):
+            os.unlink(self._map_pathname)
+        return err_success
+
+    def _fingerprint(self, chunk):
+        if chunk == self._zero:
+            return None
+        return hashlib.blake2b(chunk, digest_size=DEDUP_DIGEST_SIZE).digest()
+
+    def _merge(self, index, start, piece):
+        '''the whole chunk with piece written at start'''
+        chunk = bytearray(self._chunk_size)
+        physical = self._map[index]
+        if physical != THIN_UNMAPPED:
+            result = self._pool.readv_into(
+                [(memoryview(chunk), physical * self._chunk_size)])
+            if not is_success(result):
+                raise DeviceAccessError('read chunk failed, error %d' % result)
+        chunk[start:start + len(piece)] = piece
+        return chunk
+
+    def _put(self, index, chunk, digest):
+        old = self._map[index]
+        if digest is None:
+            physical = THIN_UNMAPPED
+            self._store.unmap(old)
+        else:
+            physical = self._store.put(digest, chunk, old)
+        if physical != old:
+            self._map[index] = physical
+            self._save_map(index, index + 1)
+
+    def _writev(self, views):
+        chunk_size = self._chunk_size
+        for data, offset in views:
+            for index, start, position, length in self._chunks(offset, len(data)):
+                piece = data[position:position + length]
+                lock = self._locks[index % DEDUP_LOCKS]
+                if length == chunk_size:
+                    # hash outside the lock, hashlib lets other threads run
+                    digest = self._fingerprint(piece)
+                    with lock:
+                        self._put(index, piece, digest)
+                else:
+                    with lock:
+                        chunk = self._merge(index, start, piece)
+                        self._put(index, chunk, self._fingerprint(chunk))
+        return err_success
@@ -1,9 +1,19 @@
 #!/usr/bin/python
 
+import asyncio
+
 from error import *
 from storage import Storage
 
 
+def byte_view(data):
+    '''a flat memoryview of bytes over any buffer-protocol object'''
+    view = memoryview(data)
+    if view.format != 'B' or view.ndim != 1:
+        view = view.cast('B')
+    return view
+
+
 class Device(Storage):
 
     '''device base class'''
@@ -39,6 +49,10 @@ class Device(Storage):
     def num_child(self):
         return len(self._children)
 
+    @property
+    def children(self):
+        return list(self._children)
+
     def update_size(self):
         self._size = 0
         # update me
@@ -54,13 +68,44 @@ class Device(Storage):
             child.parent = self
             self.update_size()
 
+    def add_children(self, children):
+        '''add many children with a single size update, building a tree one
+        add_child at a time re-sums every level for every child'''
+        present = set(id(dev) for dev in self._children)
+        for child in children:
+            if id(child) not in present:
+                present.add(id(child))
+                self._children.append(child)
+                child.parent = self
+        self.update_size()
+
     def remove_child(self, child):
         if child in self._children:
             self._children.remove(child)
+            if child.parent is self:
+                child.parent = None
             self.update_size()
 
     def is_valid_range(self, offset, length):
-        return offset >= 0 and length > 0 and offset + length < self.size
+        return offset >= 0 and length > 0 and offset + length <= self.size
+
+    def open(self):
+        for dev in self._children:
+            dev.open()
+        return err_success
+
+    def close(self):
+        for dev in self._children:
+            dev.close()
+        return err_success
+
+    def flush(self):
+        result = err_success
+        for dev in self._children:
+            result = dev.flush()
+            if not is_success(result):
+                break
+        return result
 
     def read(self, offset, length):
         raise NeedToBeImplementedError('need to implement by sub-class')
@@ -68,6 +113,50 @@ class Device(Storage):
     def write(self, data, offset):
         raise NeedToBeImplementedError('need to implement by sub-class')
 
+    def readv(self, iov):
+        '''read a list of (offset, length), return result and a list of data'''
+        data = []
+        for offset, length in iov:
+            result, read_data = self.read(offset, length)
+            if not is_success(result):
+                return result, data
+            data.append(read_data)
+        return err_success, data
+
+    def read_into(self, buffer, offset):
+        '''fill a caller supplied buffer from offset'''
+        return self.readv_into([(buffer, offset)])
+
+    def readv_into(self, iov):
+        '''fill a list of (buffer, offset)'''
+        for buffer, offset in iov:
+            view = byte_view(buffer)
+            result, data = self.read(offset, len(view))
+            if not is_success(result):
+                return result
+            view[:] = data
+        return err_success
+
+    def writev(self, iov):
+        '''write a list of (data, offset)'''
+        for data, offset in iov:
+            result = self.write(data, offset)
+            if not is_success(result):
+                return result
+        return err_success
+
+    # asyncio interface, by default the blocking call runs on the loop's
+    # executor so it never stalls the event loop
+    async def _in_executor(self, function, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, function, *args)
+
+    async def aread(self, offset, length):
+        return await self._in_executor(self.read, offset, length)
+
+    async def awrite(self, data, offset):
+        return await self._in_executor(self.write, data, offset)
+
     def dump_device_tree(self, level=0):
         print('%s-->%s (size: %d %s)' %
               ('  ' * level, self.name, self.size, self.info))
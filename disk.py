@@ -2,32 +2,397 @@
 
 import os
 import mmap
-import contextlib
+import socket
+import itertools
+import threading
 
+import protocol
+import iotrace
 from error import *
-from device import Device
+from log import Logger
+from device import Device, byte_view
+from iosched import IoQueue, IoRequest, IO_READ, IO_WRITE
 
 
 class Disk(Device):
 
     '''disk base class'''
-    pass
+
+    def seed_size(self, size):
+        '''take the size from a topology cache instead of asking the disk,
+        opening the disk still reports its real size'''
+        if self._size == 0:
+            self._size = size
+
+
+def _contiguous_runs(ranges):
+    '''group a list of (offset, length) into runs of back to back ranges,
+    keeping the given order, and yield (start, first index, last index)'''
+    first = 0
+    while first < len(ranges):
+        start, length = ranges[first]
+        end = start + length
+        last = first
+        while last + 1 < len(ranges) and ranges[last + 1][0] == end:
+            last += 1
+            end += ranges[last][1]
+        yield start, first, last
+        first = last + 1
 
 
 class MemoryDisk(Disk):
 
     '''a disk based on memory'''
 
-    def __init__(self, name):
-        raise FunctionalNotImplementError('TODO')
+    def __init__(self, name, size):
+        super(MemoryDisk, self).__init__(name)
+        if size <= 0:
+            raise InvalidArgumentError('Bad memory disk size: %d' % size)
+        self._size = size
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+
+    @property
+    def info(self):
+        return 'memory'
+
+    # the returned data is a view on the disk buffer, not a copy, so a
+    # later write to the same range is visible through it
+    def read(self, offset, length):
+        if not self.is_valid_range(offset, length):
+            self.logger.error(
+                'Invalid argument: offset %d, length %d' % (offset, length))
+            return err_invalid_argument, None
+        return err_success, self._view[offset:offset + length]
+
+    def write(self, data, offset):
+        if data is None:
+            self.logger.error('Invalid argument: data is none')
+            return err_invalid_argument
+        data = byte_view(data)
+        length = len(data)
+        if not self.is_valid_range(offset, length):
+            self.logger.error(
+                'Invalid argument: offset %d, length %d' % (offset, length))
+            return err_invalid_argument
+        self._view[offset:offset + length] = data
+        return err_success
+
+    # memory copies never block, so they run on the loop thread
+    async def aread(self, offset, length):
+        return self.read(offset, length)
+
+    async def awrite(self, data, offset):
+        return self.write(data, offset)
+
+    def readv_into(self, iov):
+        for buffer, offset in iov:
+            view = byte_view(buffer)
+            length = len(view)
+            if not self.is_valid_range(offset, length):
+                self.logger.error(
+                    'Invalid argument: offset %d, length %d' % (offset, length))
+                return err_invalid_argument
+            view[:] = self._view[offset:offset + length]
+        return err_success
+
+
+class _Request(object):
+
+    def __init__(self, buffer=None):
+        # the response payload is received straight into buffer if given
+        self.buffer = buffer
+        self.result = err_success
+        self.data = None
+        self.error = None
+        self._done = threading.Event()
+
+    def complete(self, result, data=None, error=None):
+        self.result = result
+        self.data = data
+        self.error = error
+        self._done.set()
+
+    def wait(self):
+        self._done.wait()
+        if self.error is not None:
+            raise DeviceAccessError(self.error)
+        return self.result, self.data
+
+
+class _Connection(object):
+
+    '''one pipelined connection, responses are matched to requests by tag'''
+
+    def __init__(self, address):
+        try:
+            self._sock = protocol.connect(address)
+        except Exception as e:
+            raise DeviceAccessError(str(e))
+        self._send_lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+        self._pending = {}
+        self._tags = itertools.count(1)
+        self._closed = False
+        self._receiver = threading.Thread(target=self._receive_loop)
+        self._receiver.daemon = True
+        self._receiver.start()
+
+    @property
+    def num_pending(self):
+        return len(self._pending)
+
+    @property
+    def is_closed(self):
+        '''true once the connection failed, it takes no more requests'''
+        return self._closed
+
+    def submit(self, op, offset, length, payload=None, buffer=None):
+        request = _Request(buffer)
+        with self._pending_lock:
+            if self._closed:
+                raise DeviceAccessError('connection closed')
+            tag = next(self._tags) & 0xFFFFFFFF
+            self._pending[tag] = request
+        header = protocol.REQUEST.pack(op, tag, offset, length)
+        try:
+            with self._send_lock:
+                protocol.send_message(self._sock, header, payload)
+        except Exception as e:
+            self._fail_all(str(e))
+        return request
+
+    def _receive_loop(self):
+        request = None
+        try:
+            while True:
+                header = protocol.recv_exact(self._sock, protocol.RESPONSE.size)
+                result, tag, length = protocol.RESPONSE.unpack(header)
+                with self._pending_lock:
+                    request = self._pending.pop(tag, None)
+                data = None
+                if length > 0:
+                    if request is not None and request.buffer is not None \
+                            and len(request.buffer) == length:
+                        data = protocol.recv_into(self._sock, request.buffer)
+                    else:
+                        data = protocol.recv_exact(self._sock, length)
+                if request is not None:
+                    request.complete(result, data)
+                request = None
+        except Exception as e:
+            if request is not None:
+                request.complete(err_read_data_fail, error=str(e))
+            self._fail_all(str(e))
+
+    def _fail_all(self, error):
+        with self._pending_lock:
+            self._closed = True
+            pending = list(self._pending.values())
+            self._pending.clear()
+        for request in pending:
+            request.complete(err_read_data_fail, error=error)
+
+    def close(self):
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+        self._receiver.join()
 
 
 class NetworkDisk(Disk):
 
     '''a disk based on the network resource'''
 
-    def __init__(self, name):
-        raise FunctionalNotImplementError('TODO')
+    def __init__(self, name, address, export, connections=4):
+        super(NetworkDisk, self).__init__(name)
+        self._address = address
+        self._export = export
+        self._num_connections = connections
+        self._connections = []
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        if self._size == 0:
+            self.open()
+        return self._size
+
+    @property
+    def info(self):
+        return 'address: %s, export: %s' % (self._address, self._export)
+
+    def open(self):
+        with self._lock:
+            if self._connections:
+                return err_success
+            connections = []
+            try:
+                for _ in range(self._num_connections):
+                    conn, data = self._attach()
+                    connections.append(conn)
+            except Exception:
+                for conn in connections:
+                    conn.close()
+                raise
+            self._size = protocol.SIZE.unpack(bytes(data))[0]
+            self._connections = connections
+        return err_success
+
+    def _attach(self):
+        '''a new connection attached to the export, with the attach reply'''
+        conn = _Connection(self._address)
+        try:
+            name = self._export.encode('utf-8')
+            result, data = conn.submit(
+                protocol.OP_ATTACH, 0, len(name), name).wait()
+            if not is_success(result):
+                raise DeviceNotFoundError(
+                    'export %s not found on %s' %
+                    (self._export, self._address))
+        except Exception:
+            conn.close()
+            raise
+        return conn, data
+
+    def _reconnect(self):
+        '''replace the failed connections, drop those which cannot be
+        replaced, return the live ones'''
+        with self._lock:
+            connections = []
+            for conn in self._connections:
+                if conn.is_closed:
+                    conn.close()
+                    try:
+                        conn, _ = self._attach()
+                    except StorgeError as e:
+                        self.logger.error('%s: reconnect failed: %s' %
+                                          (self.name, e))
+                        continue
+                connections.append(conn)
+            self._connections = connections
+        if not connections:
+            raise DeviceAccessError('%s: no connection to %s' %
+                                    (self.name, self._address))
+        return connections
+
+    def close(self):
+        with self._lock:
+            connections = self._connections
+            self._connections = []
+        for conn in connections:
+            conn.close()
+        return err_success
+
+    def _connection(self):
+        connections = self._connections
+        if not connections:
+            self.open()
+            connections = self._connections
+        if any(conn.is_closed for conn in connections):
+            connections = self._reconnect()
+        # the least loaded connection of the pool
+        return min(connections, key=lambda conn: conn.num_pending)
+
+    def flush(self):
+        # a failed connection has already failed every write it carried
+        connections = [conn for conn in self._connections
+                       if not conn.is_closed]
+        if not connections:
+            return err_success
+        requests = [conn.submit(protocol.OP_FLUSH, 0, 0)
+                    for conn in connections]
+        result = err_success
+        for request in requests:
+            request_result, _ = request.wait()
+            if not is_success(request_result):
+                result = request_result
+        return result
+
+    def read(self, offset, length):
+        if not self.is_valid_range(offset, length):
+            self.logger.error(
+                'Invalid argument: offset %d, length %d' % (offset, length))
+            return err_invalid_argument, None
+        request = self._connection().submit(protocol.OP_READ, offset, length)
+        result, data = request.wait()
+        if is_success(result) and (data is None or len(data) != length):
+            return err_read_data_fail, data
+        return result, data
+
+    def write(self, data, offset):
+        if data is None:
+            self.logger.error('Invalid argument: data is none')
+            return err_invalid_argument
+        data = byte_view(data)
+        length = len(data)
+        if not self.is_valid_range(offset, length):
+            self.logger.error(
+                'Invalid argument: offset %d, length %d' % (offset, length))
+            return err_invalid_argument
+        request = self._connection().submit(
+            protocol.OP_WRITE, offset, length, data)
+        result, _ = request.wait()
+        return result
+
+    # the vectored calls put every request in flight before waiting
+    def readv(self, iov):
+        for offset, length in iov:
+            if not self.is_valid_range(offset, length):
+                return err_invalid_argument, []
+        requests = [self._connection().submit(protocol.OP_READ, offset, length)
+                    for offset, length in iov]
+        data = []
+        result = err_success
+        for request, (_, length) in zip(requests, iov):
+            request_result, read_data = request.wait()
+            if is_success(result):
+                if not is_success(request_result):
+                    result = request_result
+                elif read_data is None or len(read_data) != length:
+                    result = err_read_data_fail
+            data.append(read_data)
+        if not is_success(result):
+            return result, []
+        return result, data
+
+    def readv_into(self, iov):
+        iov = [(byte_view(buffer), offset) for buffer, offset in iov]
+        for buffer, offset in iov:
+            if not self.is_valid_range(offset, len(buffer)):
+                return err_invalid_argument
+        requests = [self._connection().submit(
+            protocol.OP_READ, offset, len(buffer), buffer=buffer)
+            for buffer, offset in iov]
+        result = err_success
+        for request, (buffer, _) in zip(requests, iov):
+            request_result, read_data = request.wait()
+            if not is_success(result):
+                continue
+            if not is_success(request_result):
+                result = request_result
+            elif read_data is None or len(read_data) != len(buffer):
+                result = err_read_data_fail
+            elif read_data is not buffer:
+                buffer[:] = read_data
+        return result
+
+    def writev(self, iov):
+        iov = [(None if data is None else byte_view(data), offset)
+               for data, offset in iov]
+        for data, offset in iov:
+            if data is None or not self.is_valid_range(offset, len(data)):
+                return err_invalid_argument
+        requests = [self._connection().submit(
+            protocol.OP_WRITE, offset, len(data), data) for data, offset in iov]
+        result = err_success
+        for request in requests:
+            request_result, _ = request.wait()
+            if is_success(result) and not is_success(request_result):
+                result = request_result
+        return result
 
 
 class FileDisk(Disk):
@@ -37,6 +402,25 @@ class FileDisk(Disk):
     def __init__(self, name, pathname):
         super(FileDisk, self).__init__(name)
         self._pathname = pathname
+        # the file is opened and mapped once, on first use or by open(),
+        # and kept until close()
+        self._fileno = None
+        self._mmap = None
+        self._lock = threading.Lock()
+        # an IoQueue orders and merges requests when a scheduler is set
+        self._queue = None
+
+    def set_scheduler(self, scheduler, **options):
+        '''queue I/O through a 'noop', 'deadline' or 'clook' scheduler, None
+        issues every request as it comes'''
+        if scheduler is None or scheduler == 'none':
+            self._queue = None
+        else:
+            self._queue = IoQueue(self, scheduler, **options)
+
+    @property
+    def queue(self):
+        return self._queue
 
     @property
     def size(self):
@@ -51,22 +435,93 @@ class FileDisk(Disk):
     def info(self):
         return 'pathname: %s' % (self._pathname)
 
+    @property
+    def is_open(self):
+        return self._mmap is not None
+
+    def open(self):
+        with self._lock:
+            if self._mmap is not None:
+                return err_success
+            try:
+                fileno = os.open(self._pathname, os.O_RDWR)
+                try:
+                    self._mmap = mmap.mmap(fileno, 0)
+                except Exception:
+                    os.close(fileno)
+                    raise
+            except Exception as e:
+                raise DeviceAccessError(str(e))
+            if self._size and len(self._mmap) != self._size:
+                # resized since its size was taken, maybe from a topology cache
+                size = len(self._mmap)
+                self._mmap.close()
+                self._mmap = None
+                os.close(fileno)
+                raise DeviceAccessError('%s: size %d, expected %d' %
+                                        (self._pathname, size, self._size))
+            self._fileno = fileno
+            self._size = len(self._mmap)
+        return err_success
+
+    def close(self):
+        with self._lock:
+            if self._mmap is None:
+                return err_success
+            try:
+                self._mmap.flush()
+                self._mmap.close()
+                os.close(self._fileno)
+            except Exception as e:
+                raise DeviceAccessError(str(e))
+            finally:
+                self._mmap = None
+                self._fileno = None
+        return err_success
+
+    def flush(self):
+        m = self._mmap
+        if m is None:
+            return err_success
+        try:
+            # msync the whole mapping
+            m.flush()
+        except Exception as e:
+            raise DeviceAccessError(str(e))
+        return err_success
+
+    def _mapping(self):
+        m = self._mmap
+        if m is None:
+            self.open()
+            m = self._mmap
+        return m
+
     def read(self, offset, length):
-        data = None
-        self.logger.debug('start read on %s, offset %d, length %d' %
-                          (self.name, offset, length))
+        if Logger.debug:
+            self.logger.debug('start read on %s, offset %d, length %d',
+                              self.name, offset, length)
 
         if not self.is_valid_range(offset, length):
             self.logger.error(
                 'Invalid argument: offset %d, length %d' % (offset, length))
-            return err_invalid_argument, data
+            return err_invalid_argument, None
+
+        if iotrace.tracer is None:
+            return self._read(offset, length)
+        return iotrace.tracer.call(self, iotrace.TRACE_READ, offset, length,
+                                   self._read, offset, length)
+
+    def _read(self, offset, length):
+        if self._queue is not None:
+            data = bytearray(length)
+            result = self._readv_into([(byte_view(data), offset)])
+            return result, data if is_success(result) else None
 
         try:
-            fileno = os.open(self._pathname, os.O_RDWR)
-            with contextlib.closing(mmap.mmap(fileno, 0)) as m:
-                m.seek(offset)
-                data = m.read(length)
-            os.close(fileno)
+            data = self._mapping()[offset:offset + length]
+        except DeviceAccessError:
+            raise
         except Exception as e:
             raise DeviceAccessError(str(e))
 
@@ -78,20 +533,151 @@ class FileDisk(Disk):
             return err_success, data
 
     def write(self, data, offset):
-        self.logger.debug('start write on %s: offset %d, length %d' %
-                          (self.name, offset, 0 if data is None else len(data)))
+        if Logger.debug:
+            self.logger.debug('start write on %s: offset %d, length %d',
+                              self.name, offset, 0 if data is None else len(data))
         if data is None:
             self.logger.error('Invalid argument: data is none')
             return err_invalid_argument
+        data = byte_view(data)
 
-        if self.is_valid_range(offset, len(data)):
-            try:
-                fileno = os.open(self._pathname, os.O_RDWR)
-                with contextlib.closing(mmap.mmap(fileno, 0)) as m:
-                    m.seek(offset)
-                    m.write(data)
-                os.close(fileno)
-            except Exception as e:
-                raise DeviceAccessError(str(e))
+        if not self.is_valid_range(offset, len(data)):
+            self.logger.error(
+                'Invalid argument: offset %d, length %d' % (offset, len(data)))
+            return err_invalid_argument
+
+        if iotrace.tracer is None:
+            return self._write(data, offset)
+        return iotrace.tracer.call(self, iotrace.TRACE_WRITE, offset, len(data),
+                                   self._write, data, offset)
+
+    def _write(self, data, offset):
+        if self._queue is not None:
+            return self._writev([(data, offset)])
+
+        try:
+            self._mapping()[offset:offset + len(data)] = data
+        except DeviceAccessError:
+            raise
+        except Exception as e:
+            raise DeviceAccessError(str(e))
+        return err_success
+
+    def _pread(self, offset, length):
+        try:
+            data = os.pread(self._fileno, length, offset)
+        except Exception as e:
+            raise DeviceAccessError(str(e))
+        if len(data) != length:
+            return err_read_data_fail, data
+        return err_success, data
+
+    def _pwrite(self, data, offset):
+        try:
+            if os.pwrite(self._fileno, data, offset) != len(data):
+                return err_write_data_fail
+        except Exception as e:
+            raise DeviceAccessError(str(e))
+        return err_success
+
+    async def aread(self, offset, length):
+        if not self.is_valid_range(offset, length):
+            self.logger.error(
+                'Invalid argument: offset %d, length %d' % (offset, length))
+            return err_invalid_argument, None
+        self._mapping()
+        return await self._in_executor(self._pread, offset, length)
+
+    async def awrite(self, data, offset):
+        if data is None:
+            self.logger.error('Invalid argument: data is none')
+            return err_invalid_argument
+        data = byte_view(data)
+        if not self.is_valid_range(offset, len(data)):
+            self.logger.error(
+                'Invalid argument: offset %d, length %d' % (offset, len(data)))
+            return err_invalid_argument
+        self._mapping()
+        return await self._in_executor(self._pwrite, data, offset)
+
+    def readv(self, iov):
+        data = [bytearray(length) for _, length in iov]
+        result = self.readv_into(list(zip(data, [offset for offset, _ in iov])))
+        if not is_success(result):
+            return result, []
+        return result, data
+
+    def readv_into(self, iov):
+        iov = [(byte_view(buffer), offset) for buffer, offset in iov]
+        ranges = [(offset, len(buffer)) for buffer, offset in iov]
+        for offset, length in ranges:
+            if not self.is_valid_range(offset, length):
+                self.logger.error(
+                    'Invalid argument: offset %d, length %d' % (offset, length))
+                return err_invalid_argument
+        if iotrace.tracer is None or not iov:
+            return self._readv_into(iov)
+        return iotrace.tracer.call(self, iotrace.TRACE_READ, iov[0][1],
+                                   sum(length for _, length in ranges),
+                                   self._readv_into, iov)
+
+    def _readv_into(self, iov):
+        self._mapping()
+        if self._queue is not None:
+            return self._queue.submit([IoRequest(IO_READ, offset, buffer)
+                                       for buffer, offset in iov])
+        # one preadv per run of back to back ranges, straight into the
+        # caller's buffers
+        ranges = [(offset, len(buffer)) for buffer, offset in iov]
+        for start, first, last in _contiguous_runs(ranges):
+            result = self.preadv_run([buffer for buffer, _ in iov[first:last + 1]],
+                                     start)
+            if not is_success(result):
+                return result
+        return err_success
+
+    def preadv_run(self, buffers, start):
+        '''fill buffers from the back to back range at start'''
+        expected = sum(len(buffer) for buffer in buffers)
+        try:
+            if os.preadv(self._fileno, buffers, start) != expected:
+                return err_read_data_fail
+        except Exception as e:
+            raise DeviceAccessError(str(e))
+        return err_success
+
+    def pwritev_run(self, buffers, start):
+        '''write buffers back to back from start'''
+        expected = sum(len(buffer) for buffer in buffers)
+        try:
+            if os.pwritev(self._fileno, buffers, start) != expected:
+                return err_write_data_fail
+        except Exception as e:
+            raise DeviceAccessError(str(e))
+        return err_success
+
+    def writev(self, iov):
+        views = []
+        for data, offset in iov:
+            if data is None or not self.is_valid_range(offset, len(byte_view(data))):
+                self.logger.error('Invalid argument: offset %d' % offset)
+                return err_invalid_argument
+            views.append((byte_view(data), offset))
+        if iotrace.tracer is None or not views:
+            return self._writev(views)
+        return iotrace.tracer.call(self, iotrace.TRACE_WRITE, views[0][1],
+                                   sum(len(data) for data, _ in views),
+                                   self._writev, views)
 
+    def _writev(self, iov):
+        self._mapping()
+        if self._queue is not None:
+            return self._queue.submit([IoRequest(IO_WRITE, offset, data)
+                                       for data, offset in iov])
+        ranges = [(offset, len(data)) for data, offset in iov]
+        for start, first, last in _contiguous_runs(ranges):
+            result = self.pwritev_run([data for data, _ in iov[first:last + 1]],
+                                      start)
+            if not is_success(result):
+                return result
         return err_success
@@ -5,6 +5,7 @@ import struct
 from error import *
 from storage import Storage
 from block_system import BlockSystem
+from buffer_cache import CachedDevice
 
 BLOCK_SIZE = 4096
 FS_MAGIC_NUMBER = 0xA0B1C2D3
@@ -39,7 +40,7 @@ class SuperBlock(object):
         return blocks * BLOCK_SIZE
 
     def adjust_data_space_size(self, size):
-        self.data_blocks = size / BLOCK_SIZE
+        self.data_blocks = size // BLOCK_SIZE
 
     def is_valid(self):
         # a simple check
@@ -87,8 +88,7 @@ class BlockCache(object):
         return BLOCK_SIZE
 
     def discard_cache(self):
-        if self._array is not None:
-            del self._array
+        self._array = None
 
     def zero_cache(self):
         self.discard_cache()
@@ -97,18 +97,17 @@ class BlockCache(object):
     def load_from_device(self, device):
         assert_true(self.block != INVALID_BLOCK_NUMBER)
         offset_in_device = self.block * BLOCK_SIZE
-        result, data = device.read(offset_in_device, BLOCK_SIZE)
+        if self._array is None:
+            self._array = bytearray(BLOCK_SIZE)
+        result = device.read_into(self._array, offset_in_device)
         if not is_success(result):
             raise DeviceAccessError(
                 'read data from device failed, error  %d' % result)
-        self.discard_cache()
-        self._array = bytearray(data)
 
     def flush_to_device(self, device):
         assert_true(self.block != INVALID_BLOCK_NUMBER)
         offset_in_device = self.block * BLOCK_SIZE
-        data = str(self._array)
-        result = device.write(data, offset_in_device)
+        result = device.write(self._array, offset_in_device)
         if not is_success(result):
             raise DeviceAccessError(
                 'flush data to device failed, error %d' % result)
@@ -218,7 +217,7 @@ class DirInode(Inode):
 
     @property
     def max_entry_number(self):
-        return (BLOCK_SIZE - 32) / 4
+        return (BLOCK_SIZE - 32) // 4
 
     def current_entry_count(self):
         result = 0
@@ -518,7 +517,7 @@ class IndirectBlock(Storage):
 
     @property
     def max_entry_number(self):
-        return BLOCK_SIZE / 4
+        return BLOCK_SIZE // 4
 
     @property
     def current_entry_count(self):
@@ -605,9 +604,12 @@ class IndirectBlock2(IndirectBlock):
 
 class FileSystem(Storage):
 
-    def __init__(self, name, device, size=0, new=False):
+    def __init__(self, name, device, size=0, new=False, cache=None):
         super(FileSystem, self).__init__()
         self.name = name
+        # superblock, bitmap and inode blocks are read over and over
+        if cache is not None and not isinstance(device, CachedDevice):
+            device = CachedDevice(device, cache)
         self.device = device
         self.size = size
         self.sb = SuperBlock()
@@ -709,7 +711,7 @@ class FileSystem(Storage):
             block_offset = block - self.sb.data_start_block
             bitmap_start_block = self.sb.data_bitmap_start_block
         # get the block offset in bitmap space
-        offset = block_offset / BLOCK_SIZE
+        offset = block_offset // BLOCK_SIZE
         # get the entry index in a block
         index = block_offset % BLOCK_SIZE
         # read-modify-write
@@ -730,25 +732,29 @@ class FileSystem(Storage):
         start_block = self.sb.inode_bitmap_start_block
         end_block = start_block + self.sb.inode_bitmap_blocks
         # make a blocks list for inode blocks
-        blocks = range(start_block, end_block)
+        blocks = list(range(start_block, end_block))
         # data bitmap
         start_block = self.sb.data_bitmap_start_block
         end_block = start_block + self.sb.data_bitmap_blocks
         # add data blocks
         blocks.extend(range(start_block, end_block))
-        # zero these blocks
-        bc = BlockCache()
-        bc.zero_cache()
-        for block in blocks:
-            bc.block = block
-            bc.flush_to_device(self.device)
-        bc.discard_cache()
+        # zero these blocks in one vectored write
+        zero = bytes(BLOCK_SIZE)
+        iov = [(zero, block * BLOCK_SIZE) for block in blocks]
+        result = self.device.writev(iov)
+        if not is_success(result):
+            raise DeviceAccessError(
+                'clear bitmap space failed, error %d' % result)
 
     def mount(self):
         return err_success
 
     def unmount(self):
-        return err_success
+        return self.sync()
+
+    def sync(self):
+        '''write back cached blocks and flush the device'''
+        return self.device.flush()
 
     def ls(self, pathname):
         raise FunctionalNotImplementError('ls')
@@ -775,12 +781,12 @@ class FileSystem(Storage):
 class FsFactory(object):
 
     @staticmethod
-    def create_fs(name, device, size=0):
-        return FileSystem(name, device, size, new=True)
+    def create_fs(name, device, size=0, cache=None):
+        return FileSystem(name, device, size, new=True, cache=cache)
 
     @staticmethod
-    def attach_fs(name, device):
-        return FileSystem(name, device, 0, new=False)
+    def attach_fs(name, device, cache=None):
+        return FileSystem(name, device, 0, new=False, cache=cache)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,257 @@
+#!/usr/bin/python
+
+import time
+import bisect
+import itertools
+import threading
+
+from error import *
+
+IO_READ = 0
+IO_WRITE = 1
+
+DEADLINE_READ_EXPIRE = 0.05  # 50ms
+DEADLINE_WRITE_EXPIRE = 0.5  # 500ms
+DEADLINE_BATCH = 64  # requests dispatched per round
+
+
+class IoRequest(object):
+
+    __slots__ = ('op', 'offset', 'buffer', 'seq', 'deadline', 'result',
+                 'error', 'done')
+
+    def __init__(self, op, offset, buffer):
+        self.op = op
+        self.offset = offset
+        self.buffer = buffer
+        self.seq = 0
+        self.deadline = 0.0
+        self.result = err_success
+        self.error = None
+        self.done = False
+
+    @property
+    def end(self):
+        return self.offset + len(self.buffer)
+
+
+class NoopScheduler(object):
+
+    '''dispatch in arrival order, only back to back requests merge'''
+
+    name = 'noop'
+
+    def order(self, requests, now):
+        return list(requests)
+
+
+class ClookScheduler(object):
+
+    '''elevator: sweep up in offset order from where the last round ended,
+    then jump back to the lowest offset'''
+
+    name = 'clook'
+
+    def __init__(self):
+        self._head = 0
+
+    def _sweep(self, requests, start):
+        ordered = sorted(requests, key=lambda request: (request.offset,
+                                                        request.seq))
+        split = bisect.bisect_left([request.offset for request in ordered],
+                                   start)
+        return ordered[split:] + ordered[:split]
+
+    def order(self, requests, now):
+        ordered = self._sweep(requests, self._head)
+        if ordered:
+            self._head = ordered[-1].end
+        return ordered
+
+
+class DeadlineScheduler(ClookScheduler):
+
+    '''C-LOOK rounds of at most batch requests. A request past its deadline,
+    reads expire sooner than writes, makes the round start at the oldest
+    expired request so no offset waits for long'''
+
+    name = 'deadline'
+
+    def __init__(self, read_expire=DEADLINE_READ_EXPIRE,
+                 write_expire=DEADLINE_WRITE_EXPIRE, batch=DEADLINE_BATCH):
+        super(DeadlineScheduler, self).__init__()
+        self._expire = {IO_READ: read_expire, IO_WRITE: write_expire}
+        self._batch = batch
+
+    def stamp(self, request, now):
+        request.deadline = now + self._expire[request.op]
+
+    def order(self, requests, now):
+        expired = [request for request in requests if request.deadline <= now]
+        start = self._head
+        if expired:
+            start = min(expired, key=lambda request: request.seq).offset
+        ordered = self._sweep(requests, start)[:self._batch]
+        # expired requests always make the round
+        chosen = set(id(request) for request in ordered)
+        late = [request for request in expired if id(request) not in chosen]
+        if late:
+            ordered = self._sweep(ordered[:self._batch - len(late)] + late,
+                                  start)
+        if ordered:
+            self._head = ordered[-1].end
+        return ordered
+
+
+SCHEDULERS = {'noop': NoopScheduler, 'clook': ClookScheduler,
+              'elevator': ClookScheduler, 'deadline': DeadlineScheduler}
+
+
+def _overlap(a, b):
+    return a.offset < b.end and b.offset < a.end
+
+
+class IoQueue(object):
+
+    '''a per device request queue. Requests are ordered by a scheduler,
+    contiguous requests of the same kind and overlapping reads are merged, and
+    each merged run goes to the device as one vectored call.
+
+    There is no queue thread: a submitting thread which finds the device
+    idle dispatches a whole round, its own requests and everything queued
+    behind it, while the others wait for their requests to complete.'''
+
+    def __init__(self, device, scheduler='deadline', **options):
+        factory = SCHEDULERS.get(scheduler)
+        if factory is None:
+            raise InvalidArgumentError('Bad scheduler: %s' % scheduler)
+        self._device = device
+        self._scheduler = factory(**options)
+        self._pending = []
+        self._busy = False
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self.rounds = 0
+        self.merged = 0
+
+    @property
+    def scheduler(self):
+        return self._scheduler.name
+
+    @property
+    def depth(self):
+        return len(self._pending)
+
+    def submit(self, requests):
+        '''queue requests and wait for them, return the first error code'''
+        with self._cond:
+            now = time.monotonic()
+            stamp = getattr(self._scheduler, 'stamp', None)
+            for request in requests:
+                request.seq = next(self._seq)
+                if stamp is not None:
+                    stamp(request, now)
+            self._pending.extend(requests)
+            while not all(request.done for request in requests):
+                if self._busy:
+                    self._cond.wait()
+                    continue
+                self._busy = True
+                batch = self._take_round()
+                self._cond.release()
+                try:
+                    self._dispatch(batch)
+                finally:
+                    self._cond.acquire()
+                    self._busy = False
+                    self._cond.notify_all()
+        for request in requests:
+            if request.error is not None:
+                raise request.error
+        for request in requests:
+            if not is_success(request.result):
+                return request.result
+        return err_success
+
+    def _take_round(self):
+        '''the pending requests which may be reordered freely: the arrival
+        order prefix up to the first request which overlaps an earlier
+        write, or a write which overlaps an earlier read. Only reads may
+        overlap in a round, so no scheduler order or batch cut can swap
+        two writes to the same bytes'''
+        taken = []
+        by_op = {IO_READ: [], IO_WRITE: []}
+        for request in self._pending:
+            if any(_overlap(other, request) for other in by_op[IO_WRITE]) or \
+                    (request.op == IO_WRITE and
+                     any(_overlap(other, request) for other in by_op[IO_READ])):
+                break
+            taken.append(request)
+            by_op[request.op].append(request)
+        ordered = self._scheduler.order(taken, time.monotonic())
+        # a scheduler may defer some of them to the next round
+        chosen = set(id(request) for request in ordered)
+        self._pending[:len(taken)] = [request for request in taken
+                                      if id(request) not in chosen]
+        self.rounds += 1
+        return ordered
+
+    def _dispatch(self, ordered):
+        group = []
+        end = 0
+        for request in ordered:
+            if group and request.op == group[0].op and \
+                    group[0].offset <= request.offset <= end:
+                group.append(request)
+                end = max(end, request.end)
+                continue
+            if group:
+                self._issue(group)
+            group = [request]
+            end = request.end
+        if group:
+            self._issue(group)
+
+    def _issue(self, group):
+        self.merged += len(group) - 1
+        start = group[0].offset
+        try:
+            contiguous = all(group[i].offset == group[i - 1].end
+                             for i in range(1, len(group)))
+            if group[0].op == IO_READ:
+                result = self._read(group, start, contiguous)
+            else:
+                result = self._write(group, start, contiguous)
+        except StorgeError as e:
+            for request in group:
+                request.error = e
+                request.done = True
+            return
+        for request in group:
+            request.result = result
+            request.done = True
+
+    def _read(self, group, start, contiguous):
+        if contiguous:
+            return self._device.preadv_run([request.buffer for request in group],
+                                           start)
+        end = max(request.end for request in group)
+        union = bytearray(end - start)
+        result = self._device.preadv_run([union], start)
+        if is_success(result):
+            view = memoryview(union)
+            for request in group:
+                request.buffer[:] = view[request.offset - start:
+                                         request.end - start]
+        return result
+
+    def _write(self, group, start, contiguous):
+        if contiguous:
+            return self._device.pwritev_run([request.buffer for request in group],
+                                            start)
+        # overlapping writes land in arrival order, the last one wins
+        end = max(request.end for request in group)
+        union = bytearray(end - start)
+        for request in sorted(group, key=lambda request: request.seq):
+            union[request.offset - start:request.end - start] = request.buffer
+        return self._device.pwritev_run([union], start)
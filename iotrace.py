@@ -0,0 +1,144 @@
+#!/usr/bin/python
+
+import time
+import struct
+import threading
+
+from error import *
+
+TRACE_READ = 0
+TRACE_WRITE = 1
+TRACE_RECORDS = 65536
+TRACE_SAMPLE = 1  # trace one I/O in every TRACE_SAMPLE
+
+# magic, record size, devices, records, wall clock of the trace start
+_HEADER = struct.Struct('<4sHHQd')
+# time since the trace start, latency, offset, length, device, op
+_RECORD = struct.Struct('<ddQIHB')
+_NAME = struct.Struct('<H')
+_MAGIC = b'IOTR'
+
+# the tracer in use, the hot paths only test it against None when off
+tracer = None
+
+
+class Tracer(object):
+
+    '''a ring buffer of binary I/O records, the last `records` sampled I/Os
+    of every traced device. call() runs one I/O and records it, the
+    devices only call it once tracing is enabled.'''
+
+    def __init__(self, records=TRACE_RECORDS, sample=TRACE_SAMPLE):
+        if records <= 0 or sample <= 0:
+            raise InvalidArgumentError('Bad trace: %d records, 1 in %d' %
+                                       (records, sample))
+        self._buffer = bytearray(records * _RECORD.size)
+        self._capacity = records
+        self._sample = sample
+        # I/Os seen, threads may lose an increment, which only moves sampling
+        self._seen = 0
+        self._count = 0
+        # device name -> id in the records
+        self._devices = {}
+        self._lock = threading.Lock()
+        self._wall = time.time()
+        self._start = time.perf_counter()
+
+    @property
+    def count(self):
+        '''records written, the buffer keeps the last `records` of them'''
+        return self._count
+
+    def call(self, device, op, offset, length, function, *args):
+        self._seen += 1
+        if self._seen % self._sample:
+            return function(*args)
+        start = time.perf_counter()
+        result = function(*args)
+        end = time.perf_counter()
+        with self._lock:
+            index = self._devices.get(device.name)
+            if index is None:
+                index = self._devices[device.name] = len(self._devices)
+            _RECORD.pack_into(self._buffer,
+                              self._count % self._capacity * _RECORD.size,
+                              start - self._start, end - start, offset,
+                              length, index, op)
+            self._count += 1
+        return result
+
+    def records(self):
+        '''(time, device, op, offset, length, latency) oldest first, times in
+        seconds from the start of the trace'''
+        return _decode(*self._snapshot())[1]
+
+    def _snapshot(self):
+        with self._lock:
+            count = min(self._count, self._capacity)
+            first = self._count - count
+            data = bytearray()
+            for number in range(first, self._count):
+                position = number % self._capacity * _RECORD.size
+                data += self._buffer[position:position + _RECORD.size]
+            names = sorted(self._devices, key=self._devices.get)
+        return names, count, data
+
+    def dump(self, pathname):
+        '''write the records to a file, load() reads it back'''
+        names, count, data = self._snapshot()
+        try:
+            with open(pathname, 'wb') as f:
+                f.write(_HEADER.pack(_MAGIC, _RECORD.size, len(names), count,
+                                     self._wall))
+                for name in names:
+                    encoded = name.encode('utf-8')
+                    f.write(_NAME.pack(len(encoded)))
+                    f.write(encoded)
+                f.write(data)
+        except Exception as e:
+            raise DeviceAccessError(str(e))
+        return err_success
+
+
+def _decode(names, count, data):
+    records = []
+    for number in range(count):
+        start, latency, offset, length, index, op = \
+            _RECORD.unpack_from(data, number * _RECORD.size)
+        records.append((start, names[index], op, offset, length, latency))
+    return names, records
+
+
+def load(pathname):
+    '''read a dump, return the wall clock of the trace start and records as
+    Tracer.records gives them'''
+    try:
+        with open(pathname, 'rb') as f:
+            data = f.read()
+    except Exception as e:
+        raise DeviceAccessError(str(e))
+    magic, record_size, num_names, count, wall = _HEADER.unpack_from(data)
+    if magic != _MAGIC or record_size != _RECORD.size:
+        raise InvalidArgumentError('%s is not an I/O trace' % pathname)
+    position = _HEADER.size
+    names = []
+    for _ in range(num_names):
+        length, = _NAME.unpack_from(data, position)
+        position += _NAME.size
+        names.append(bytes(data[position:position + length]).decode('utf-8'))
+        position += length
+    return wall, _decode(names, count, memoryview(data)[position:])[1]
+
+
+def enable(records=TRACE_RECORDS, sample=TRACE_SAMPLE):
+    '''start tracing into a new buffer'''
+    global tracer
+    tracer = Tracer(records, sample)
+    return tracer
+
+
+def disable():
+    '''stop tracing, return the tracer, whose records can still be dumped'''
+    global tracer
+    stopped, tracer = tracer, None
+    return stopped
@@ -2,9 +2,14 @@
 
 import logging
 
+LOG_LEVEL = logging.INFO
+
 
 class Logger(object):
     _logger = None
+    _level = LOG_LEVEL
+    # tested by the I/O paths before they build a debug message
+    debug = False
 
     @classmethod
     def get_logger(cls, filename, console=False):
@@ -12,12 +17,12 @@ class Logger(object):
             return cls._logger
 
         logger = logging.getLogger('Logger')
-        logger.setLevel(logging.DEBUG)
+        logger.setLevel(cls._level)
 
         formatter = logging.Formatter(
             '%(asctime)s [%(filename)s,%(lineno)d] - %(name)s - %(levelname)s - %(message)s')
 
-        file_handle = logging.FileHandler(filename)
+        file_handle = logging.FileHandler(filename, delay=True)
         file_handle.setLevel(logging.DEBUG)
         file_handle.setFormatter(formatter)
         logger.addHandler(file_handle)
@@ -31,3 +36,11 @@ class Logger(object):
         cls._logger = logger
 
         return cls._logger
+
+    @classmethod
+    def set_level(cls, level):
+        '''log from level up, logging.DEBUG turns the per I/O messages on'''
+        cls._level = level
+        cls.debug = level <= logging.DEBUG
+        if cls._logger is not None:
+            cls._logger.setLevel(level)
@@ -1,26 +1,485 @@
 #!/usr/bin/python
 
+import threading
 import collections
 
+from error import *
 
-class Lru(object):
 
-    def __init__(self, capacity=32):
+def weigh_bytes(key, value):
+    '''weigh an entry by the length of its value, for a capacity in bytes'''
+    return len(value)
+
+
+class Cache(object):
+
+    '''base of the cache policies. The capacity is a number of entries, or
+    any other unit when weigh(key, value) gives the weight of an entry,
+    e.g. weigh_bytes for a capacity in bytes.
+
+    on_evict(key, value) is called, with the cache locked, for every entry
+    pushed out by set, a write-back cache writes its dirty data there. An
+    entry heavier than the whole cache is never kept, it is evicted at once.
+
+    Every method takes the cache lock, so one cache may be shared by
+    threads, ShardedCache spreads the lock over several caches.'''
+
+    name = None
+
+    def __init__(self, capacity=32, on_evict=None, weigh=None):
+        if capacity <= 0:
+            raise InvalidArgumentError('Bad cache capacity: %d' % capacity)
         self._capacity = capacity
-        self._cache = collections.OrderedDict()
+        # called with (key, value) when set pushes an entry out
+        self._on_evict = on_evict
+        self._weigh = weigh
+        self._weight = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @property
+    def weight(self):
+        return self._weight
+
+    def stats(self):
+        with self._lock:
+            return {'policy': self.name, 'entries': self._count(),
+                    'weight': self._weight, 'capacity': self._capacity,
+                    'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
+
+    def __len__(self):
+        return self._count()
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._peek(key) is not None
 
     def get(self, key):
-        try:
-            value = self._cache.pop(key)
-            self._cache[key] = value
+        with self._lock:
+            value = self._lookup(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
             return value
-        except KeyError:
+
+    def peek(self, key):
+        '''get without counting or promoting the entry'''
+        with self._lock:
+            return self._peek(key)
+
+    def set(self, key, value):
+        size = 1 if self._weigh is None else self._weigh(key, value)
+        with self._lock:
+            old = self._remove(key)
+            if old is not None:
+                self._weight -= old[1]
+            if size > self._capacity:
+                self.evictions += 1
+                if self._on_evict is not None:
+                    self._on_evict(key, value)
+                return
+            if old is None:
+                self._admit(key, size)
+            # make room first, the key being set is never the victim
+            while self._weight + size > self._capacity:
+                evicted_key, evicted, evicted_size = self._victim()
+                self._weight -= evicted_size
+                self.evictions += 1
+                if self._on_evict is not None:
+                    self._on_evict(evicted_key, evicted)
+            if old is not None:
+                self._update(key, value, size)
+            else:
+                self._insert(key, value, size)
+            self._weight += size
+            self._trim()
+
+    def delete(self, key):
+        with self._lock:
+            old = self._remove(key)
+            self._forget(key)
+            if old is None:
+                return None
+            self._weight -= old[1]
+            return old[0]
+
+    def keys(self):
+        with self._lock:
+            return self._keys()
+
+    def clear(self):
+        '''drop every entry, without calling on_evict'''
+        with self._lock:
+            self._clear()
+            self._weight = 0
+
+    # policy hooks, called with the lock held
+    def _count(self):
+        raise NeedToBeImplementedError('need to implement by sub-class')
+
+    def _lookup(self, key):
+        '''return the value of a resident key and record the hit'''
+        raise NeedToBeImplementedError('need to implement by sub-class')
+
+    def _peek(self, key):
+        raise NeedToBeImplementedError('need to implement by sub-class')
+
+    def _admit(self, key, size):
+        '''see a key which is not resident before room is made for it'''
+        pass
+
+    def _insert(self, key, value, size):
+        '''place a key which is not resident'''
+        raise NeedToBeImplementedError('need to implement by sub-class')
+
+    def _update(self, key, value, size):
+        '''place a key which was resident, by default as a new key'''
+        self._insert(key, value, size)
+
+    def _remove(self, key):
+        '''take a resident key out, return (value, size) or None'''
+        raise NeedToBeImplementedError('need to implement by sub-class')
+
+    def _victim(self):
+        '''take the entry to evict out, return (key, value, size)'''
+        raise NeedToBeImplementedError('need to implement by sub-class')
+
+    def _forget(self, key):
+        '''drop any history kept for a deleted key'''
+        pass
+
+    def _trim(self):
+        '''bound the history after a set'''
+        pass
+
+    def _keys(self):
+        raise NeedToBeImplementedError('need to implement by sub-class')
+
+    def _clear(self):
+        raise NeedToBeImplementedError('need to implement by sub-class')
+
+
+class Lru(Cache):
+
+    '''least recently used'''
+
+    name = 'lru'
+
+    def __init__(self, capacity=32, on_evict=None, weigh=None):
+        super(Lru, self).__init__(capacity, on_evict, weigh)
+        # key -> (value, size), least recent first
+        self._cache = collections.OrderedDict()
+
+    def _count(self):
+        return len(self._cache)
+
+    def _lookup(self, key):
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        self._cache.move_to_end(key)
+        return entry[0]
+
+    def _peek(self, key):
+        entry = self._cache.get(key)
+        return None if entry is None else entry[0]
+
+    def _insert(self, key, value, size):
+        self._cache[key] = (value, size)
+
+    def _remove(self, key):
+        return self._cache.pop(key, None)
+
+    def _victim(self):
+        key, (value, size) = self._cache.popitem(last=False)
+        return key, value, size
+
+    def _keys(self):
+        return list(self._cache)
+
+    def _clear(self):
+        self._cache.clear()
+
+
+class TwoQueue(Cache):
+
+    '''2Q: a new key enters a small FIFO and is promoted to the main LRU
+    only when it comes back after leaving the FIFO, which a ghost list of
+    recently evicted keys remembers. A scan passes through the FIFO
+    without touching the main LRU.'''
+
+    name = '2q'
+
+    def __init__(self, capacity=32, on_evict=None, weigh=None,
+                 fifo_ratio=0.25, ghost_ratio=0.5):
+        super(TwoQueue, self).__init__(capacity, on_evict, weigh)
+        self._fifo_capacity = max(1, int(capacity * fifo_ratio))
+        self._ghost_capacity = max(1, int(capacity * ghost_ratio))
+        self._fifo = collections.OrderedDict()
+        self._fifo_weight = 0
+        self._main = collections.OrderedDict()
+        # evicted from the fifo, key -> size
+        self._ghosts = collections.OrderedDict()
+        self._ghost_weight = 0
+
+    def _count(self):
+        return len(self._fifo) + len(self._main)
+
+    def _lookup(self, key):
+        entry = self._main.get(key)
+        if entry is not None:
+            self._main.move_to_end(key)
+            return entry[0]
+        # a hit in the fifo does not promote, the key may be a scan
+        entry = self._fifo.get(key)
+        return None if entry is None else entry[0]
+
+    def _peek(self, key):
+        entry = self._main.get(key) or self._fifo.get(key)
+        return None if entry is None else entry[0]
+
+    def _insert(self, key, value, size):
+        ghost = self._ghosts.pop(key, None)
+        if ghost is not None:
+            self._ghost_weight -= ghost
+            self._main[key] = (value, size)
+        else:
+            self._fifo[key] = (value, size)
+            self._fifo_weight += size
+
+    def _update(self, key, value, size):
+        # rewriting a key is a second reference to it
+        self._main[key] = (value, size)
+
+    def _remove(self, key):
+        entry = self._main.pop(key, None)
+        if entry is None:
+            entry = self._fifo.pop(key, None)
+            if entry is not None:
+                self._fifo_weight -= entry[1]
+        return entry
+
+    def _victim(self):
+        if self._fifo and (self._fifo_weight > self._fifo_capacity or
+                           not self._main):
+            key, (value, size) = self._fifo.popitem(last=False)
+            self._fifo_weight -= size
+            self._ghosts[key] = size
+            self._ghost_weight += size
+            return key, value, size
+        key, (value, size) = self._main.popitem(last=False)
+        return key, value, size
+
+    def _forget(self, key):
+        ghost = self._ghosts.pop(key, None)
+        if ghost is not None:
+            self._ghost_weight -= ghost
+
+    def _trim(self):
+        while self._ghost_weight > self._ghost_capacity:
+            _, size = self._ghosts.popitem(last=False)
+            self._ghost_weight -= size
+
+    def _keys(self):
+        return list(self._fifo) + list(self._main)
+
+    def _clear(self):
+        self._fifo.clear()
+        self._main.clear()
+        self._ghosts.clear()
+        self._fifo_weight = self._ghost_weight = 0
+
+
+class Arc(Cache):
+
+    '''adaptive replacement cache: t1 holds keys seen once, t2 keys seen
+    again, and the ghost lists b1 and b2 remember what each evicted. A
+    miss which hits a ghost moves the target weight of t1 towards the
+    list which would have kept the key. Weights stand in for entry counts
+    everywhere, so it adapts in bytes as well.'''
+
+    name = 'arc'
+
+    def __init__(self, capacity=32, on_evict=None, weigh=None):
+        super(Arc, self).__init__(capacity, on_evict, weigh)
+        self._t1 = collections.OrderedDict()
+        self._t2 = collections.OrderedDict()
+        self._b1 = collections.OrderedDict()
+        self._b2 = collections.OrderedDict()
+        self._t1_weight = 0
+        self._b1_weight = 0
+        self._b2_weight = 0
+        # target weight of t1
+        self._p = 0
+
+    @property
+    def target(self):
+        return self._p
+
+    def _count(self):
+        return len(self._t1) + len(self._t2)
+
+    def _lookup(self, key):
+        entry = self._t2.get(key)
+        if entry is not None:
+            self._t2.move_to_end(key)
+            return entry[0]
+        entry = self._t1.pop(key, None)
+        if entry is None:
             return None
+        self._t1_weight -= entry[1]
+        self._t2[key] = entry
+        return entry[0]
+
+    def _peek(self, key):
+        entry = self._t2.get(key) or self._t1.get(key)
+        return None if entry is None else entry[0]
+
+    def _admit(self, key, size):
+        # a ghost hit moves the target before the victim is chosen
+        if key in self._b1:
+            step = max(self._b2_weight // max(self._b1_weight, 1), 1) * size
+            self._p = min(self._capacity, self._p + step)
+        elif key in self._b2:
+            step = max(self._b1_weight // max(self._b2_weight, 1), 1) * size
+            self._p = max(0, self._p - step)
+
+    def _insert(self, key, value, size):
+        if key in self._b1:
+            self._b1_weight -= self._b1.pop(key)
+            self._t2[key] = (value, size)
+        elif key in self._b2:
+            self._b2_weight -= self._b2.pop(key)
+            self._t2[key] = (value, size)
+        else:
+            self._t1[key] = (value, size)
+            self._t1_weight += size
+
+    def _update(self, key, value, size):
+        self._t2[key] = (value, size)
+
+    def _remove(self, key):
+        entry = self._t2.pop(key, None)
+        if entry is None:
+            entry = self._t1.pop(key, None)
+            if entry is not None:
+                self._t1_weight -= entry[1]
+        return entry
+
+    def _victim(self):
+        if self._t1 and (self._t1_weight > self._p or not self._t2):
+            key, (value, size) = self._t1.popitem(last=False)
+            self._t1_weight -= size
+            self._b1[key] = size
+            self._b1_weight += size
+        else:
+            key, (value, size) = self._t2.popitem(last=False)
+            self._b2[key] = size
+            self._b2_weight += size
+        return key, value, size
+
+    def _forget(self, key):
+        if key in self._b1:
+            self._b1_weight -= self._b1.pop(key)
+        if key in self._b2:
+            self._b2_weight -= self._b2.pop(key)
+
+    def _trim(self):
+        # t1 and b1 together hold at most the capacity, all four lists twice
+        while self._b1 and self._t1_weight + self._b1_weight > self._capacity:
+            self._b1_weight -= self._b1.popitem(last=False)[1]
+        while self._b2 and self._weight + self._b1_weight + \
+                self._b2_weight > 2 * self._capacity:
+            self._b2_weight -= self._b2.popitem(last=False)[1]
+
+    def _keys(self):
+        return list(self._t1) + list(self._t2)
+
+    def _clear(self):
+        for entries in (self._t1, self._t2, self._b1, self._b2):
+            entries.clear()
+        self._t1_weight = self._b1_weight = self._b2_weight = 0
+        self._p = 0
+
+
+POLICIES = {'lru': Lru, '2q': TwoQueue, 'arc': Arc}
+
+
+def make_cache(policy='lru', capacity=32, on_evict=None, weigh=None):
+    factory = POLICIES.get(policy)
+    if factory is None:
+        raise InvalidArgumentError('Bad cache policy: %s' % policy)
+    return factory(capacity, on_evict, weigh)
+
+
+class ShardedCache(object):
+
+    '''a cache split by key hash into shards of one policy, each with its
+    own lock and an even share of the capacity, for caches hit by many
+    threads at once'''
+
+    def __init__(self, policy='lru', capacity=32, on_evict=None, weigh=None,
+                 shards=16):
+        if shards <= 0:
+            raise InvalidArgumentError('Bad shard count: %d' % shards)
+        share = max(1, capacity // shards)
+        self._shards = [make_cache(policy, share, on_evict, weigh)
+                        for _ in range(shards)]
+
+    def _shard(self, key):
+        return self._shards[hash(key) % len(self._shards)]
+
+    @property
+    def capacity(self):
+        return sum(shard.capacity for shard in self._shards)
+
+    @property
+    def weight(self):
+        return sum(shard.weight for shard in self._shards)
+
+    def stats(self):
+        total = {}
+        for shard in self._shards:
+            for key, value in shard.stats().items():
+                if isinstance(value, int):
+                    total[key] = total.get(key, 0) + value
+                else:
+                    total[key] = value
+        total['shards'] = len(self._shards)
+        return total
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._shards)
+
+    def __contains__(self, key):
+        return key in self._shard(key)
+
+    def get(self, key):
+        return self._shard(key).get(key)
+
+    def peek(self, key):
+        return self._shard(key).peek(key)
 
     def set(self, key, value):
-        try:
-            self._cache.pop(key)
-        except KeyError:
-            if len(self._cache) >= self._capacity:
-                self._cache.popitem(last=False)
-        self._cache[key] = value
+        self._shard(key).set(key, value)
+
+    def delete(self, key):
+        return self._shard(key).delete(key)
+
+    def keys(self):
+        keys = []
+        for shard in self._shards:
+            keys.extend(shard.keys())
+        return keys
+
+    def clear(self):
+        for shard in self._shards:
+            shard.clear()
@@ -1,25 +1,621 @@
 #!/usr/bin/python
 
-from device import Device
-from raid import Raid0
+import os
+import array
+import threading
+
+from error import *
+from device import Device, byte_view
+from raid import Concat
+from qos import throttle
+from readahead import Readahead
+
+
+def _read_bytes(iov):
+    return sum(length for _, length in iov)
+
+
+def _buffer_bytes(iov):
+    return sum(len(byte_view(buffer)) for buffer, _ in iov
+               if buffer is not None)
 
 
 class Lun(Device):
 
     def __init__(self, name):
         super(Lun, self).__init__(name)
-        # LUN manages raids by a Raid0 model
-        self._raid0 = Raid0('InternalRaid0')
-        self.add_child(self._raid0)
+        # LUN joins its raids back to back
+        self._concat = Concat('InternalConcat')
+        self.add_child(self._concat)
+        # a QosQueue when the LUN shares the raids under a QosScheduler
+        self.qos = None
+        # a Readahead over the raids for sequential readers
+        self.readahead = None
+        # a WriteAheadLog which makes writes durable before they go home
+        self.wal = None
+
+    def set_readahead(self, **options):
+        '''prefetch for sequential streams, see Readahead for the options'''
+        if self.readahead is not None:
+            self.readahead.close()
+        self.readahead = Readahead(self._concat, **options)
+
+    def clear_readahead(self):
+        if self.readahead is not None:
+            self.readahead.close()
+            self.readahead = None
 
     def add_raid(self, raid):
-        self._raid0.add_child(raid)
+        self._concat.add_child(raid)
+
+    def add_raids(self, raids):
+        self._concat.add_children(raids)
 
     def remove_raid(self, raid):
-        self._raid0.remove_child(raid)
+        if self.wal is not None:
+            # logged writes may land on the raid which goes away
+            self.wal.checkpoint()
+        self._concat.remove_child(raid)
+        if self.readahead is not None:
+            self.readahead.reset()
+
+    def close(self):
+        self.clear_readahead()
+        return super(Lun, self).close()
+
+    def _invalidate(self, iov):
+        for data, offset in iov:
+            if data is not None:
+                self.readahead.invalidate(offset, len(byte_view(data)))
+
+    def _home_readv_into(self, iov):
+        if self.readahead is None:
+            return self._concat.readv_into(iov)
+        for buffer, offset in iov:
+            result = self.readahead.read_into(buffer, offset)
+            if not is_success(result):
+                return result
+        return err_success
+
+    def _readv_into(self, iov):
+        if self.wal is None:
+            return self._home_readv_into(iov)
+        iov = [(byte_view(buffer), offset) for buffer, offset in iov]
+        for buffer, offset in iov:
+            if not self.is_valid_range(offset, len(buffer)):
+                return err_invalid_argument
+        return self.wal.readv_into(self, iov, self._home_readv_into)
+
+    def home_writev(self, iov):
+        '''write straight to the raids, bypassing the WAL'''
+        result = self._concat.writev(iov)
+        if self.readahead is not None:
+            self._invalidate(iov)
+        return result
+
+    def _writev(self, iov):
+        if self.wal is None:
+            return self.home_writev(iov)
+        views = []
+        for data, offset in iov:
+            if data is None:
+                return err_invalid_argument
+            data = byte_view(data)
+            if not self.is_valid_range(offset, len(data)):
+                return err_invalid_argument
+            views.append((data, offset))
+        return self.wal.log(self, views)
+
+    def read(self, offset, length):
+        with throttle(self.qos, length):
+            if self.readahead is None and self.wal is None:
+                return self._concat.read(offset, length)
+            if not self.is_valid_range(offset, length):
+                return err_invalid_argument, None
+            data = bytearray(length)
+            result = self._readv_into([(memoryview(data), offset)])
+        if not is_success(result):
+            return result, None
+        return result, data
+
+    def write(self, data, offset):
+        with throttle(self.qos, _buffer_bytes([(data, offset)])):
+            if self.readahead is None and self.wal is None:
+                return self._concat.write(data, offset)
+            return self._writev([(data, offset)])
+
+    def readv(self, iov):
+        with throttle(self.qos, _read_bytes(iov)):
+            if self.readahead is None and self.wal is None:
+                return self._concat.readv(iov)
+            data = []
+            for offset, length in iov:
+                if not self.is_valid_range(offset, length):
+                    return err_invalid_argument, []
+                data.append(bytearray(length))
+            result = self._readv_into(
+                [(memoryview(buffer), offset)
+                 for buffer, (offset, _) in zip(data, iov)])
+        if not is_success(result):
+            return result, []
+        return result, data
+
+    def writev(self, iov):
+        with throttle(self.qos, _buffer_bytes(iov)):
+            return self._writev(iov)
+
+    def read_into(self, buffer, offset):
+        with throttle(self.qos, len(byte_view(buffer))):
+            if self.readahead is None and self.wal is None:
+                return self._concat.read_into(buffer, offset)
+            return self._readv_into([(buffer, offset)])
+
+    def readv_into(self, iov):
+        with throttle(self.qos, _buffer_bytes(iov)):
+            return self._readv_into(iov)
+
+    async def aread(self, offset, length):
+        if self.qos is not None or self.readahead is not None or \
+                self.wal is not None:
+            # waiting for QoS, a prefetch or a log flush blocks, keep it
+            # off the event loop
+            return await super(Lun, self).aread(offset, length)
+        return await self._concat.aread(offset, length)
+
+    async def awrite(self, data, offset):
+        if self.qos is not None or self.readahead is not None or \
+                self.wal is not None:
+            return await super(Lun, self).awrite(data, offset)
+        return await self._concat.awrite(data, offset)
+
+
+THIN_UNMAPPED = 0xFFFFFFFF
+THIN_UNIT = 4096  # a fresh chunk written in part is zero padded to units
+
+
+class ThinLun(Device):
+
+    '''a LUN which takes chunks from a ChunkPool only when they are first
+    written, the chunk map (logical chunk -> pool chunk) is kept in a file
+
+    Snapshots and clones share chunks with their origin. Every member of
+    such a family has its own flat chunk map, so a read never walks a chain.
+    A pool chunk allocated before a member's floor epoch may be shared, and
+    writing it redirects the write to a fresh chunk.
+
+    A fresh chunk written in part only gets the written units, the others
+    read as zeros until flush() zeroes them on disk, and only then does
+    its map entry reach the map file.'''
+
+    def __init__(self, name, pool, size, map_pathname=None, chunk_map=None,
+                 writable=True):
+        super(ThinLun, self).__init__(name)
+        if size <= 0:
+            raise InvalidArgumentError('Bad LUN size: %d' % size)
+        self._pool = pool
+        self._chunk_size = pool.chunk_size
+        self._size = size
+        num = (size + self._chunk_size - 1) // self._chunk_size
+        self._map_pathname = map_pathname
+        self._map_fileno = None
+        self._lock = threading.Lock()
+        # remaps do their I/O outside the lock, holding just their chunk
+        self._cond = threading.Condition(self._lock)
+        self._busy = set()
+        # chunk index -> a byte per unit, non zero once written, for the
+        # fresh chunks written in part
+        self._valid = {}
+        self._unit = min(THIN_UNIT, self._chunk_size)
+        self._writable = writable
+        self.qos = None
+        # chunks born before the floor may be shared within the family
+        self._floor = 0
+        self._family = [self]
+        if chunk_map is None:
+            self._map = array.array('I', [THIN_UNMAPPED]) * num
+            self._map_shared = False
+            if map_pathname is not None:
+                self._load_map()
+        else:
+            # the map array is shared with its origin until the first change
+            self._map = chunk_map
+            self._map_shared = True
+            if map_pathname is not None:
+                self._open_map()
+                self._save_map(0, len(self._map))
+
+    @property
+    def pool(self):
+        return self._pool
+
+    @property
+    def writable(self):
+        return self._writable
+
+    @property
+    def allocated_chunks(self):
+        return len(self._map) - self._map.count(THIN_UNMAPPED)
+
+    @property
+    def info(self):
+        return '%s, pool: %s, allocated: %d/%d' % (
+            'thin' if self._writable else 'snapshot', self._pool.name,
+            self.allocated_chunks, len(self._map))
+
+    def _open_map(self):
+        try:
+            self._map_fileno = os.open(self._map_pathname,
+                                       os.O_RDWR | os.O_CREAT, 0o644)
+        except Exception as e:
+            raise DeviceAccessError(str(e))
+
+    def _load_map(self):
+        self._open_map()
+        try:
+            data = os.pread(self._map_fileno,
+                            len(self._map) * self._map.itemsize, 0)
+        except Exception as e:
+            raise DeviceAccessError(str(e))
+        loaded = array.array('I')
+        loaded.frombytes(data[:len(data) - len(data) % loaded.itemsize])
+        self._map[:len(loaded)] = loaded
+        for physical in self._map:
+            if physical != THIN_UNMAPPED:
+                self._pool.mark_used(physical)
+        if len(loaded) < len(self._map):
+            # a new or grown LUN, write out the unmapped tail
+            self._save_map(len(loaded), len(self._map))
+
+    def _save_map(self, first, last):
+        if self._map_fileno is None:
+            return
+        data = self._map[first:last].tobytes()
+        try:
+            os.pwrite(self._map_fileno, data, first * self._map.itemsize)
+        except Exception as e:
+            raise DeviceAccessError(str(e))
+
+    def _own_map(self):
+        if self._map_shared:
+            self._map = array.array('I', self._map)
+            self._map_shared = False
+
+    def _hold(self, index):
+        '''wait until no remap works on a chunk and take it, called with
+        the lock held'''
+        while index in self._busy:
+            self._cond.wait()
+        self._busy.add(index)
+
+    def _unhold(self, index):
+        '''called with the lock held'''
+        self._busy.discard(index)
+        self._cond.notify_all()
+
+    def _seal(self):
+        '''zero the unwritten units of the chunks written in part and save
+        their map entries, called with the lock held'''
+        chunk_size = self._chunk_size
+        unit = self._unit
+        while self._valid:
+            index = next(iter(self._valid))
+            self._hold(index)
+            try:
+                valid = self._valid.get(index)
+                if valid is None:
+                    continue
+                base = self._map[index] * chunk_size
+                iov = []
+                first = valid.find(0)
+                while first != -1:
+                    last = valid.find(1, first)
+                    if last == -1:
+                        last = len(valid)
+                    end = min(last * unit, chunk_size)
+                    iov.append((bytes(end - first * unit), base + first * unit))
+                    first = valid.find(0, last)
+                result = self._pool.writev(iov)
+                if not is_success(result):
+                    raise DeviceAccessError('zero chunk failed, error %d' %
+                                            result)
+                del self._valid[index]
+                self._save_map(index, index + 1)
+            finally:
+                self._unhold(index)
+
+    def flush(self):
+        with self._lock:
+            self._seal()
+        result = self._pool.flush()
+        if is_success(result) and self._map_fileno is not None:
+            try:
+                os.fsync(self._map_fileno)
+            except Exception as e:
+                raise DeviceAccessError(str(e))
+        return result
+
+    def close(self):
+        if self._map_fileno is not None:
+            self.flush()
+            os.close(self._map_fileno)
+            self._map_fileno = None
+        return err_success
+
+    def _join(self, member):
+        # from now on every chunk mapped so far may be shared
+        epoch = self._pool.new_epoch()
+        for lun in self._family:
+            if lun._writable:
+                lun._floor = epoch
+        self._family.append(member)
+        member._family = self._family
+        member._floor = epoch
+
+    def snapshot(self, name, map_pathname=None):
+        '''freeze the current chunk map as a read only LUN, writes which
+        complete before the call are in the snapshot. Only a member which
+        is attached again after a restart keeps its chunks, see
+        BlockSystem.snapshot_lun'''
+        with self._lock:
+            self._seal()
+            snap = ThinLun(name, self._pool, self._size, map_pathname,
+                           self._map, writable=False)
+            self._map_shared = True
+            self._join(snap)
+        return snap
+
+    def clone(self, name, map_pathname=None):
+        '''a writable LUN sharing every chunk with this one'''
+        with self._lock:
+            self._seal()
+            clone = ThinLun(name, self._pool, self._size, map_pathname,
+                            self._map)
+            self._map_shared = True
+            self._join(clone)
+        return clone
+
+    def attach(self, name, map_pathname, writable=False):
+        '''load a snapshot or clone of this LUN saved by an earlier run'''
+        with self._lock:
+            member = ThinLun(name, self._pool, self._size, map_pathname,
+                             writable=writable)
+            self._join(member)
+        return member
+
+    def _is_shared(self, index, physical):
+        for lun in self._family:
+            if lun is not self and index < len(lun._map) and \
+                    lun._map[index] == physical:
+                return True
+        return False
+
+    def delete(self):
+        '''drop this LUN, its chunks go back to the pool unless another
+        member of the family still maps them'''
+        with self._lock:
+            for index, physical in enumerate(self._map):
+                if physical != THIN_UNMAPPED and \
+                        not self._is_shared(index, physical):
+                    self._pool.free(physical)
+            self._family.remove(self)
+            self._family = [self]
+            self._map = array.array('I', [THIN_UNMAPPED]) * len(self._map)
+            self._map_shared = False
+            self._valid.clear()
+        self.close()
+        if self._map_pathname is not None and \
+                os.path.exists(self._map_pathname):
+            os.unlink(self._map_pathname)
+        return err_success
+
+    def _chunks(self, offset, length):
+        '''split a range into (chunk index, offset in chunk, position, length)'''
+        chunk_size = self._chunk_size
+        position = 0
+        while position < length:
+            index, start = divmod(offset + position, chunk_size)
+            piece = min(chunk_size - start, length - position)
+            yield index, start, position, piece
+            position += piece
+
+    def _padded(self, valid, start, data):
+        '''widen a write to a chunk written in part to whole units, zeros
+        go where the units were never written. Return the start, the data
+        and the first and last unit'''
+        unit = self._unit
+        end = start + len(data)
+        first = start // unit
+        last = (end - 1) // unit
+        head = 0 if valid[first] else start - first * unit
+        tail = 0 if valid[last] else \
+            min((last + 1) * unit, self._chunk_size) - end
+        if head or tail:
+            data = b''.join((bytes(head), data, bytes(tail)))
+        return start - head, data, first, last
+
+    def _remap(self, index, start, data):
+        '''give a chunk a fresh pool chunk on its first write, or on the first
+        write after it became shared, and fill in chunks written in part.
+        Return the pool chunk to write to, or None when the write is done.
+        The lock is only held to allocate and to publish the new mapping,
+        the chunk is held off from other remaps during the I/O'''
+        chunk_size = self._chunk_size
+        with self._lock:
+            self._hold(index)
+            physical = self._map[index]
+            valid = self._valid.get(index)
+            shared = physical != THIN_UNMAPPED and valid is None and \
+                self._pool.birth(physical) < self._floor
+            fresh = None
+            try:
+                if physical == THIN_UNMAPPED or shared:
+                    fresh = self._pool.allocate()
+            finally:
+                if fresh is None and valid is None:
+                    self._unhold(index)
+        if fresh is None and valid is None:
+            return physical
+        try:
+            if fresh is None:
+                # a chunk written in part, padded as the new units need
+                offset, chunk, first, last = self._padded(valid, start, data)
+                result = self._pool.write(chunk,
+                                          physical * chunk_size + offset)
+                if not is_success(result):
+                    raise DeviceAccessError('write chunk failed, error %d' %
+                                            result)
+                with self._lock:
+                    valid[first:last + 1] = b'\x01' * (last - first + 1)
+                    if not valid.count(0):
+                        del self._valid[index]
+                        self._save_map(index, index + 1)
+                return None
+            offset = 0
+            if len(data) == chunk_size:
+                chunk = data
+            elif shared:
+                # copy the rest of the shared chunk
+                result, chunk = self._pool.read(physical * chunk_size,
+                                                chunk_size)
+                if not is_success(result):
+                    self._pool.free(fresh)
+                    raise DeviceAccessError(
+                        'read shared chunk failed, error %d' % result)
+                chunk = bytearray(chunk)
+                chunk[start:start + len(data)] = data
+            else:
+                # only the written units, the rest reads as zeros
+                valid = bytearray(len(range(0, chunk_size, self._unit)))
+                offset, chunk, first, last = self._padded(valid, start, data)
+                valid[first:last + 1] = b'\x01' * (last - first + 1)
+                if not valid.count(0):
+                    valid = None
+            result = self._pool.write(chunk, fresh * chunk_size + offset)
+            if not is_success(result):
+                self._pool.free(fresh)
+                raise DeviceAccessError('write fresh chunk failed, error %d' %
+                                        result)
+            with self._lock:
+                # readers look at the map first, then the units
+                if valid is not None:
+                    self._valid[index] = valid
+                self._own_map()
+                self._map[index] = fresh
+                if valid is None:
+                    self._save_map(index, index + 1)
+                if shared and not self._is_shared(index, physical):
+                    self._pool.free(physical)
+            return None
+        finally:
+            with self._lock:
+                self._unhold(index)
 
     def read(self, offset, length):
-        return self._raid0.read(offset, length)
+        if not self.is_valid_range(offset, length):
+            return err_invalid_argument, None
+        data = bytearray(length)
+        with throttle(self.qos, length):
+            result = self._readv_into([(memoryview(data), offset)])
+        if not is_success(result):
+            return result, None
+        return result, data
+
+    def readv(self, iov):
+        data = []
+        for offset, length in iov:
+            if not self.is_valid_range(offset, length):
+                return err_invalid_argument, []
+            data.append(bytearray(length))
+        with throttle(self.qos, _read_bytes(iov)):
+            result = self._readv_into(
+                [(memoryview(buffer), offset)
+                 for buffer, (offset, _) in zip(data, iov)])
+        if not is_success(result):
+            return result, []
+        return result, data
+
+    def readv_into(self, iov):
+        iov = [(byte_view(buffer), offset) for buffer, offset in iov]
+        for buffer, offset in iov:
+            if not self.is_valid_range(offset, len(buffer)):
+                return err_invalid_argument
+        with throttle(self.qos, _buffer_bytes(iov)):
+            return self._readv_into(iov)
+
+    def _readv_into(self, iov):
+        chunk_size = self._chunk_size
+        chunk_map = self._map
+        batch = []
+        for buffer, offset in iov:
+            for index, start, position, length in self._chunks(offset, len(buffer)):
+                piece = buffer[position:position + length]
+                physical = chunk_map[index]
+                valid = self._valid.get(index)
+                if physical == THIN_UNMAPPED:
+                    # never written, zeros without any disk I/O
+                    piece[:] = bytes(length)
+                elif valid is None:
+                    batch.append((piece, physical * chunk_size + start))
+                else:
+                    self._split_valid(batch, valid, piece,
+                                      physical * chunk_size, start)
+        if not batch:
+            return err_success
+        return self._pool.readv_into(batch)
+
+    def _split_valid(self, batch, valid, piece, base, start):
+        '''read the written units of a piece of a chunk written in part,
+        zero the others'''
+        unit = self._unit
+        position = start
+        end = start + len(piece)
+        while position < end:
+            written = valid[position // unit]
+            stop = position
+            while stop < end and valid[stop // unit] == written:
+                stop = (stop // unit + 1) * unit
+            stop = min(stop, end)
+            run = piece[position - start:stop - start]
+            if written:
+                batch.append((run, base + position))
+            else:
+                run[:] = bytes(len(run))
+            position = stop
 
     def write(self, data, offset):
-        return self._raid0.write(data, offset)
+        if data is None:
+            return err_invalid_argument
+        return self.writev([(data, offset)])
+
+    def writev(self, iov):
+        if not self._writable:
+            self.logger.error('%s is read only' % self.name)
+            return err_invalid_argument
+        views = []
+        for data, offset in iov:
+            if data is None:
+                return err_invalid_argument
+            data = byte_view(data)
+            if not self.is_valid_range(offset, len(data)):
+                return err_invalid_argument
+            views.append((data, offset))
+        with throttle(self.qos, _buffer_bytes(views)):
+            return self._writev(views)
+
+    def _writev(self, views):
+        chunk_size = self._chunk_size
+        pool = self._pool
+        batch = []
+        for data, offset in views:
+            for index, start, position, length in self._chunks(offset, len(data)):
+                piece = data[position:position + length]
+                physical = self._map[index]
+                if physical == THIN_UNMAPPED or index in self._valid or \
+                        pool.birth(physical) < self._floor:
+                    physical = self._remap(index, start, piece)
+                    if physical is None:
+                        continue
+                batch.append((piece, physical * chunk_size + start))
+        if not batch:
+            return err_success
+        return pool.writev(batch)
@@ -0,0 +1,36 @@
+#!/usr/bin/python
+
+# XOR parity over whole buffers. NumPy is used when it is installed, else
+# the buffers are XORed as big integers, which also runs in C.
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _xor_numpy(buffers, length):
+    # XOR 8 bytes at a time when the length allows it
+    dtype = numpy.uint64 if length % 8 == 0 else numpy.uint8
+    result = numpy.frombuffer(buffers[0], dtype=dtype).copy()
+    for buf in buffers[1:]:
+        numpy.bitwise_xor(result, numpy.frombuffer(buf, dtype=dtype),
+                          out=result)
+    return result.tobytes()
+
+
+def _xor_int(buffers, length):
+    result = int.from_bytes(buffers[0], 'little')
+    for buf in buffers[1:]:
+        result ^= int.from_bytes(buf, 'little')
+    return result.to_bytes(length, 'little')
+
+
+def xor_buffers(buffers):
+    '''XOR a list of equally sized buffers, return bytes'''
+    length = len(buffers[0])
+    if len(buffers) == 1:
+        return bytes(buffers[0])
+    if numpy is not None:
+        return _xor_numpy(buffers, length)
+    return _xor_int(buffers, length)
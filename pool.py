@@ -0,0 +1,123 @@
+#!/usr/bin/python
+
+import array
+import threading
+
+from error import *
+from device import Device
+from raid import Concat
+
+POOL_DEFAULT_CHUNK = 1 * 1024 * 1024  # 1M
+
+
+class ChunkPool(Device):
+
+    '''fixed size physical chunks carved from a set of raids and handed out
+    to thin LUNs, read and write address the pool physically'''
+
+    def __init__(self, name, chunk_size=POOL_DEFAULT_CHUNK):
+        if chunk_size <= 0:
+            raise InvalidArgumentError('Bad chunk size: %d' % chunk_size)
+        self._chunk_size = chunk_size
+        # one byte per chunk, non zero when the chunk is allocated
+        self._used = bytearray()
+        # the epoch each chunk was allocated in, snapshots start new epochs
+        self._births = array.array('Q')
+        self._epoch = 0
+        self._hint = 0
+        self._lock = threading.Lock()
+        super(ChunkPool, self).__init__(name)
+        self._concat = Concat('%s_Concat' % name)
+        self.add_child(self._concat)
+
+    @property
+    def chunk_size(self):
+        return self._chunk_size
+
+    @property
+    def num_chunks(self):
+        return len(self._used)
+
+    @property
+    def free_chunks(self):
+        return self._used.count(0)
+
+    @property
+    def info(self):
+        return 'chunk: %d, free: %d/%d' % (self._chunk_size, self.free_chunks,
+                                           self.num_chunks)
+
+    def add_raid(self, raid):
+        self._concat.add_child(raid)
+
+    def add_raids(self, raids):
+        self._concat.add_children(raids)
+
+    def remove_raid(self, raid):
+        self._concat.remove_child(raid)
+
+    def update_size(self):
+        super(ChunkPool, self).update_size()
+        with self._lock:
+            num = self._size // self._chunk_size
+            if num > len(self._used):
+                grow = num - len(self._used)
+                self._used.extend(bytes(grow))
+                self._births.extend([0] * grow)
+            else:
+                del self._used[num:]
+                del self._births[num:]
+
+    @property
+    def epoch(self):
+        return self._epoch
+
+    def new_epoch(self):
+        with self._lock:
+            self._epoch += 1
+            return self._epoch
+
+    def birth(self, index):
+        return self._births[index]
+
+    def allocate(self):
+        '''take a free chunk, return its index'''
+        with self._lock:
+            # search from the last allocation on, then wrap around
+            index = self._used.find(0, self._hint)
+            if index == -1:
+                index = self._used.find(0, 0, self._hint)
+            if index == -1:
+                raise DeviceNoEnoughSpaceError('pool %s is full' % self.name)
+            self._used[index] = 1
+            self._births[index] = self._epoch
+            self._hint = index + 1
+            return index
+
+    def mark_used(self, index):
+        with self._lock:
+            if not 0 <= index < len(self._used):
+                raise InvalidArgumentError('Bad chunk: %d' % index)
+            self._used[index] = 1
+
+    def free(self, index):
+        with self._lock:
+            if 0 <= index < len(self._used):
+                self._used[index] = 0
+                if index < self._hint:
+                    self._hint = index
+
+    def read(self, offset, length):
+        return self._concat.read(offset, length)
+
+    def write(self, data, offset):
+        return self._concat.write(data, offset)
+
+    def readv(self, iov):
+        return self._concat.readv(iov)
+
+    def readv_into(self, iov):
+        return self._concat.readv_into(iov)
+
+    def writev(self, iov):
+        return self._concat.writev(iov)
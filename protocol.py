@@ -0,0 +1,85 @@
+#!/usr/bin/python
+
+import socket
+import struct
+
+# Block protocol
+#
+# request  : op(1) reserved(3) tag(4) offset(8) length(8)
+#            followed by 'length' bytes of payload for ATTACH and WRITE
+# response : result(4) tag(4) length(8)
+#            followed by 'length' bytes of payload for ATTACH and READ
+#
+# Every request carries a tag which is echoed in its response, so a client
+# can keep many requests in flight on one connection. A connection is bound
+# to one exported device by an ATTACH request whose payload is the export
+# name and whose response payload is the device size.
+
+REQUEST = struct.Struct('!B3xIQQ')
+RESPONSE = struct.Struct('!iIQ')
+SIZE = struct.Struct('!Q')
+
+OP_ATTACH = 1
+OP_READ = 2
+OP_WRITE = 3
+OP_FLUSH = 4
+
+# payloads are streamed in frames of this size so a large transfer never
+# needs a second copy of the buffer
+BULK_FRAME = 1 * 1024 * 1024  # 1M
+# payloads up to this size are sent together with their header
+SMALL_PAYLOAD = 64 * 1024  # 64K
+
+
+def parse_address(address):
+    '''"host:port" is a TCP address, anything else is a unix socket path'''
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit():
+        return socket.AF_INET, (host or 'localhost', int(port))
+    return socket.AF_UNIX, address
+
+
+def connect(address):
+    family, addr = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.connect(addr)
+        if family == socket.AF_INET:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+def recv_into(sock, buf):
+    '''fill the whole of buf from sock'''
+    view = memoryview(buf)
+    received = 0
+    while received < len(view):
+        count = sock.recv_into(view[received:received + BULK_FRAME])
+        if count == 0:
+            raise EOFError('connection closed by peer')
+        received += count
+    return buf
+
+
+def recv_exact(sock, length):
+    return recv_into(sock, bytearray(length))
+
+
+def send_payload(sock, payload):
+    view = memoryview(payload).cast('B')
+    for start in range(0, len(view), BULK_FRAME):
+        sock.sendall(view[start:start + BULK_FRAME])
+
+
+def send_message(sock, header, payload=None):
+    if payload is None or len(payload) == 0:
+        sock.sendall(header)
+    elif len(payload) <= SMALL_PAYLOAD:
+        # one segment for small messages
+        sock.sendall(header + bytes(payload))
+    else:
+        sock.sendall(header)
+        send_payload(sock, payload)
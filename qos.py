@@ -0,0 +1,306 @@
+#!/usr/bin/python
+
+import time
+import threading
+import contextlib
+import collections
+
+from error import *
+
+QOS_DEFAULT_DEPTH = 32
+QOS_COST_UNIT = 64 * 1024  # 64K of transfer weighs as much as one I/O
+
+
+_UNTHROTTLED = contextlib.nullcontext()
+
+
+def throttle(queue, nbytes):
+    '''context for one I/O through a LUN's QosQueue, which may be None'''
+    if queue is None:
+        return _UNTHROTTLED
+    return queue.io(nbytes)
+
+
+class TokenBucket(object):
+
+    '''tokens refill at rate per second up to burst, a rate of 0 never
+    limits. Taking may leave the bucket in debt, so a request larger than
+    the burst still goes through and the next ones pay for it'''
+
+    def __init__(self, rate, burst=None):
+        if rate < 0:
+            raise InvalidArgumentError('Bad rate: %d' % rate)
+        self._rate = rate
+        self._burst = burst if burst else rate
+        self._tokens = self._burst
+        self._stamp = time.monotonic()
+
+    @property
+    def rate(self):
+        return self._rate
+
+    @property
+    def tokens(self):
+        return self._tokens
+
+    def refill(self, now):
+        if self._rate:
+            self._tokens = min(self._burst, self._tokens +
+                               (now - self._stamp) * self._rate)
+        self._stamp = now
+
+    def ready(self):
+        return not self._rate or self._tokens >= 0
+
+    def wait_time(self):
+        '''seconds until ready, after a refill'''
+        if self.ready():
+            return 0.0
+        return -self._tokens / self._rate
+
+    def take(self, amount):
+        if self._rate:
+            self._tokens -= amount
+
+
+class _QosRequest(object):
+
+    def __init__(self, nbytes, seq):
+        self.nbytes = nbytes
+        self.seq = seq
+        self.start = 0.0
+        self.finish = 0.0
+        self.granted = False
+        # set when the queue is removed before the request was granted
+        self.cancelled = False
+
+
+class QosQueue(object):
+
+    '''the QoS state of one LUN: limit and reservation buckets, a weight
+    for sharing what is left, and the requests waiting to dispatch'''
+
+    def __init__(self, scheduler, name, iops=0, bps=0, burst_iops=None,
+                 burst_bps=None, reserve_iops=0, reserve_bps=0, weight=1):
+        if weight <= 0:
+            raise InvalidArgumentError('Bad weight: %s' % weight)
+        self._scheduler = scheduler
+        self.name = name
+        self.weight = weight
+        self.limit_iops = TokenBucket(iops, burst_iops)
+        self.limit_bps = TokenBucket(bps, burst_bps)
+        self.reserve_iops = TokenBucket(reserve_iops)
+        self.reserve_bps = TokenBucket(reserve_bps)
+        self.waiting = collections.deque()
+        self.last_finish = 0.0
+        self.inflight = 0
+        self.dispatched = 0
+        self.throttled = 0
+        self.removed = False
+
+    @property
+    def buckets(self):
+        return (self.limit_iops, self.limit_bps,
+                self.reserve_iops, self.reserve_bps)
+
+    @property
+    def reserved(self):
+        '''true while the LUN is below its reservation'''
+        if not self.reserve_iops.rate and not self.reserve_bps.rate:
+            return False
+        return self.reserve_iops.ready() and self.reserve_bps.ready()
+
+    @property
+    def limited(self):
+        return not (self.limit_iops.ready() and self.limit_bps.ready())
+
+    def limit_wait(self):
+        return max(self.limit_iops.wait_time(), self.limit_bps.wait_time())
+
+    def io(self, nbytes):
+        '''context for one I/O of nbytes, blocks until the scheduler lets it
+        go'''
+        return _QosTicket(self._scheduler, self, nbytes)
+
+    def stats(self):
+        return self._scheduler.queue_stats(self)
+
+
+class _QosTicket(object):
+
+    def __init__(self, scheduler, queue, nbytes):
+        self._scheduler = scheduler
+        self._queue = queue
+        self._nbytes = nbytes
+
+    def __enter__(self):
+        self._scheduler.submit(self._queue, self._nbytes)
+        return self
+
+    def __exit__(self, *exc):
+        self._scheduler.complete(self._queue)
+        return False
+
+
+class QosScheduler(object):
+
+    '''share the raids between LUNs. At most depth I/Os are in flight, and
+    whenever a slot is free the next request comes from, in order:
+      1. a LUN below its reservation, oldest request first
+      2. the smallest weighted fair queueing finish tag
+    A LUN over its iops or bytes/s limit waits for its buckets to refill
+    whatever its place in the order.
+
+    There is no dispatcher thread, waiting requests run the scheduling in
+    turn whenever something changes.'''
+
+    def __init__(self, depth=QOS_DEFAULT_DEPTH):
+        if depth <= 0:
+            raise InvalidArgumentError('Bad queue depth: %d' % depth)
+        self._depth = depth
+        self._inflight = 0
+        self._queues = []
+        self._virtual_time = 0.0
+        self._seq = 0
+        self._cond = threading.Condition()
+
+    @property
+    def depth(self):
+        return self._depth
+
+    @depth.setter
+    def depth(self, depth):
+        if depth <= 0:
+            raise InvalidArgumentError('Bad queue depth: %d' % depth)
+        with self._cond:
+            self._depth = depth
+            self._schedule()
+
+    def add_queue(self, name, **limits):
+        queue = QosQueue(self, name, **limits)
+        with self._cond:
+            self._queues.append(queue)
+        return queue
+
+    def remove_queue(self, queue):
+        '''drop a LUN's queue, its waiting requests fail'''
+        with self._cond:
+            self._queues.remove(queue)
+            queue.removed = True
+            for request in queue.waiting:
+                request.cancelled = True
+            queue.waiting.clear()
+            self._cond.notify_all()
+
+    def set_limits(self, queue, **limits):
+        '''change the limits of a LUN while it runs'''
+        with self._cond:
+            fresh = QosQueue(self, queue.name, **limits)
+            queue.weight = fresh.weight
+            queue.limit_iops = fresh.limit_iops
+            queue.limit_bps = fresh.limit_bps
+            queue.reserve_iops = fresh.reserve_iops
+            queue.reserve_bps = fresh.reserve_bps
+            self._schedule()
+
+    def submit(self, queue, nbytes):
+        with self._cond:
+            if queue.removed:
+                raise DeviceNotAvailableError('LUN %s is removed' % queue.name)
+            self._seq += 1
+            request = _QosRequest(nbytes, self._seq)
+            # finish tags of a LUN never fall behind the virtual clock,
+            # so an idle LUN can not save up credit
+            cost = 1.0 + float(nbytes) / QOS_COST_UNIT
+            request.start = max(self._virtual_time, queue.last_finish)
+            request.finish = request.start + cost / queue.weight
+            queue.last_finish = request.finish
+            queue.waiting.append(request)
+            timeout = self._schedule()
+            if not request.granted:
+                queue.throttled += 1
+            while not request.granted:
+                self._cond.wait(timeout)
+                if request.cancelled:
+                    raise DeviceNotAvailableError('LUN %s is removed' %
+                                                  queue.name)
+                timeout = self._schedule()
+
+    def complete(self, queue):
+        with self._cond:
+            self._inflight -= 1
+            queue.inflight -= 1
+            self._schedule()
+            # the freed slot may belong to a LUN still over its limits, so
+            # let every waiter recompute how long to sleep
+            self._cond.notify_all()
+
+    def _schedule(self):
+        '''grant as many waiting requests as the depth allows, called with
+        the lock held. Return how long to wait for a bucket to refill, or
+        None when only a completion can make progress'''
+        now = time.monotonic()
+        for queue in self._queues:
+            for bucket in queue.buckets:
+                bucket.refill(now)
+        granted = False
+        while self._inflight < self._depth:
+            queue = self._pick()
+            if queue is None:
+                break
+            request = queue.waiting.popleft()
+            for bucket in (queue.limit_bps, queue.reserve_bps):
+                bucket.take(request.nbytes)
+            for bucket in (queue.limit_iops, queue.reserve_iops):
+                bucket.take(1)
+            self._virtual_time = max(self._virtual_time, request.start)
+            self._inflight += 1
+            queue.inflight += 1
+            queue.dispatched += 1
+            request.granted = True
+            granted = True
+        if granted:
+            self._cond.notify_all()
+        if self._inflight >= self._depth:
+            return None
+        waits = [queue.limit_wait() for queue in self._queues
+                 if queue.waiting and queue.limited]
+        if not waits:
+            return None
+        return max(min(waits), 0.001)
+
+    def _pick(self):
+        best = None
+        best_key = None
+        for queue in self._queues:
+            if not queue.waiting or queue.limited:
+                continue
+            head = queue.waiting[0]
+            if queue.reserved:
+                key = (0, head.seq)
+            else:
+                key = (1, head.finish, head.seq)
+            if best_key is None or key < best_key:
+                best, best_key = queue, key
+        return best
+
+    def queue_stats(self, queue):
+        with self._cond:
+            return {'name': queue.name,
+                    'weight': queue.weight,
+                    'waiting': len(queue.waiting),
+                    'inflight': queue.inflight,
+                    'dispatched': queue.dispatched,
+                    'throttled': queue.throttled,
+                    'limited': queue.limited,
+                    'reserved': queue.reserved,
+                    'iops_tokens': queue.limit_iops.tokens,
+                    'bps_tokens': queue.limit_bps.tokens}
+
+    def stats(self):
+        with self._cond:
+            queues = list(self._queues)
+            inflight = self._inflight
+        return {'depth': self._depth,
+                'inflight': inflight,
+                'luns': [self.queue_stats(queue) for queue in queues]}
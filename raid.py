@@ -1,25 +1,40 @@
 #!/usr/bin/python
 
+import time
+import bisect
+import asyncio
+import itertools
+import contextlib
+import threading
+import collections
+import concurrent.futures
+
+import iotrace
 from error import *
-from storage import Storage
-from device import Device
+from log import Logger
+from device import Device, byte_view
+from parity import xor_buffers
 
 RAID_DEFAULT_STRIPE = 1 * 1024 * 1024  # 1M
 
 
-class Extent(Storage):
-
-    def __init__(self, device, start, length):
-        self.device = device
-        self.start = start
-        self.length = length
+# a piece of an I/O mapped onto one child
+Extent = collections.namedtuple('Extent', ['device', 'start', 'length'])
 
 
 class Raid(Device):
 
+    # raid specific keys accepted from system.json
+    OPTIONS = ()
+
     def __init__(self, name, stripe=RAID_DEFAULT_STRIPE):
         super(Raid, self).__init__(name)
+        if stripe <= 0:
+            raise InvalidArgumentError('Bad stripe size: %d' % stripe)
         self._stripe = stripe
+        self._pool = None
+        self._pool_workers = 0
+        self._pool_lock = threading.Lock()
 
     @property
     def stripe(self):
@@ -28,108 +43,1098 @@ class Raid(Device):
     def add_disk(self, disk):
         self.add_child(disk)
 
+    def add_disks(self, disks):
+        self.add_children(disks)
+
     def remove_disk(self, disk):
         self.remove_child(disk)
 
-    def build(self):
+    def build(self, validate=True):
+        '''set the raid up once its disks are added, validate is False when
+        the layout is known to be good and only the setup has to run'''
         return err_success
 
+    def close(self):
+        self._shutdown_pool()
+        return super(Raid, self).close()
+
+    def release(self):
+        '''stop the worker pools but leave the disks open, for a raid taken
+        out of a live tree whose disks may still serve other raids'''
+        self._shutdown_pool()
+        for dev in self._children:
+            if isinstance(dev, Raid):
+                dev.release()
+
+    def _shutdown_pool(self):
+        with self._pool_lock:
+            pool = self._pool
+            self._pool = None
+        if pool is not None:
+            pool.shutdown()
+
+    def _pool_size(self):
+        # one worker per member, so every member can have a request in flight
+        return len(self._children)
+
+    def _submit(self, function, *args):
+        '''run a call on the worker pool, return its future. The pool is
+        resized to the member count, submitting under the same lock as
+        the resize so nothing goes to a pool once it is shut down, whose
+        queued calls still run'''
+        with self._pool_lock:
+            workers = max(1, self._pool_size())
+            if self._pool is None or self._pool_workers != workers:
+                if self._pool is not None:
+                    self._pool.shutdown(wait=False)
+                self._pool = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=workers,
+                    thread_name_prefix='%s-io' % self.name)
+                self._pool_workers = workers
+            return self._pool.submit(function, *args)
+
+    def _dispatch(self, calls):
+        '''run a list of (function, args) concurrently, results in order'''
+        if len(calls) == 1:
+            function, args = calls[0]
+            return [function(*args)]
+        futures = [self._submit(function, *args)
+                   for function, args in calls[1:]]
+        # the calling thread takes the first call itself
+        function, args = calls[0]
+        results = [function(*args)]
+        results.extend(future.result() for future in futures)
+        return results
+
     def _make_extents(self, offset, length):
         raise NeedToBeImplementedError('need to implement by sub-class')
 
     def read(self, offset, length):
-        self.logger.debug('start read on %s, offset %d, length %d' %
-                          (self.name, offset, length))
+        if Logger.debug:
+            self.logger.debug('start read on %s, offset %d, length %d',
+                              self.name, offset, length)
         if not self.is_valid_range(offset, length):
             return err_invalid_argument, None
-        data = []
-        extents = self._make_extents(offset, length)
-        for extent in extents:
-            result, read_data = extent.device.read(extent.start, extent.length)
-            if not is_success(result):
-                break
-            data.append(read_data)
-        return result, ''.join(data)
+        if iotrace.tracer is None:
+            result, data = self._readv([(offset, length)])
+        else:
+            result, data = iotrace.tracer.call(
+                self, iotrace.TRACE_READ, offset, length, self._readv,
+                [(offset, length)])
+        if not is_success(result):
+            return result, None
+        return result, data[0]
 
     def write(self, data, offset):
-        self.logger.debug('start write on %s: offset %d, length %d' %
-                          (self.name, offset, 0 if data is None else len(data)))
+        if Logger.debug:
+            self.logger.debug('start write on %s: offset %d, length %d',
+                              self.name, offset, 0 if data is None else len(data))
         if data is None:
             return err_invalid_argument
-        length = len(data)
-        if not self.is_valid_range(offset, length):
+        data = byte_view(data)
+        if not self.is_valid_range(offset, len(data)):
             return err_invalid_argument
-        write_offset = 0
+        if iotrace.tracer is None:
+            return self._writev([(data, offset)])
+        return iotrace.tracer.call(self, iotrace.TRACE_WRITE, offset, len(data),
+                                   self._writev, [(data, offset)])
+
+    def readv(self, iov):
+        for offset, length in iov:
+            if not self.is_valid_range(offset, length):
+                return err_invalid_argument, []
+        if iotrace.tracer is None or not iov:
+            return self._readv(iov)
+        return iotrace.tracer.call(self, iotrace.TRACE_READ, iov[0][0],
+                                   sum(length for _, length in iov),
+                                   self._readv, iov)
+
+    def readv_into(self, iov):
+        iov = [(byte_view(buffer), offset) for buffer, offset in iov]
+        for buffer, offset in iov:
+            if not self.is_valid_range(offset, len(buffer)):
+                return err_invalid_argument
+        if iotrace.tracer is None or not iov:
+            return self._readv_into(iov)
+        return iotrace.tracer.call(self, iotrace.TRACE_READ, iov[0][1],
+                                   sum(len(buffer) for buffer, _ in iov),
+                                   self._readv_into, iov)
+
+    def writev(self, iov):
+        views = []
+        for data, offset in iov:
+            if data is None:
+                return err_invalid_argument
+            data = byte_view(data)
+            if not self.is_valid_range(offset, len(data)):
+                return err_invalid_argument
+            views.append((data, offset))
+        if iotrace.tracer is None or not views:
+            return self._writev(views)
+        return iotrace.tracer.call(self, iotrace.TRACE_WRITE, views[0][1],
+                                   sum(len(data) for data, _ in views),
+                                   self._writev, views)
+
+    def _readv(self, iov):
+        buffers = [bytearray(length) for _, length in iov]
+        result = self._readv_into(
+            [(memoryview(buffer), offset)
+             for buffer, (offset, _) in zip(buffers, iov)])
+        if not is_success(result):
+            return result, []
+        return result, buffers
+
+    def _readv_into(self, iov):
+        # split every request into extents and collect the extents of each
+        # child into one sub-batch, so a child sees a single readv_into, then
+        # issue the sub-batches to the children concurrently; every extent
+        # lands in its slice of the caller's buffer
+        batches = collections.OrderedDict()
+        for buffer, offset in iov:
+            position = 0
+            for extent in self._make_extents(offset, len(buffer)):
+                batches.setdefault(extent.device, []).append(
+                    (buffer[position:position + extent.length], extent.start))
+                position += extent.length
+        results = self._dispatch([(device.readv_into, (sub_iov,))
+                                  for device, sub_iov in batches.items()])
+        for result in results:
+            if not is_success(result):
+                return result
+        return err_success
+
+    # extents go to their members concurrently on the event loop
+    async def aread(self, offset, length):
+        if not self.is_valid_range(offset, length):
+            return err_invalid_argument, None
         extents = self._make_extents(offset, length)
-        for extent in extents:
-            data_to_be_wrote = data[write_offset:write_offset + extent.length]
-            result = extent.device.write(data_to_be_wrote, extent.start)
+        results = await asyncio.gather(
+            *[extent.device.aread(extent.start, extent.length)
+              for extent in extents])
+        for result, _ in results:
             if not is_success(result):
-                break
+                return result, None
+        if len(results) == 1:
+            return results[0]
+        return err_success, b''.join(data for _, data in results)
+
+    async def awrite(self, data, offset):
+        if data is None:
+            return err_invalid_argument
+        data = byte_view(data)
+        if not self.is_valid_range(offset, len(data)):
+            return err_invalid_argument
+        requests = []
+        write_offset = 0
+        for extent in self._make_extents(offset, len(data)):
+            requests.append(extent.device.awrite(
+                data[write_offset:write_offset + extent.length], extent.start))
             write_offset += extent.length
-        return result
+        for result in await asyncio.gather(*requests):
+            if not is_success(result):
+                return result
+        return err_success
 
+    def _readv_into_by_copy(self, iov):
+        # for raids which read through their own _readv
+        result, data = self._readv(
+            [(offset, len(buffer)) for buffer, offset in iov])
+        if not is_success(result):
+            return result
+        for (buffer, _), read_data in zip(iov, data):
+            buffer[:] = read_data
+        return err_success
 
-class Raid0(Raid):
+    def _writev(self, iov):
+        batches = collections.OrderedDict()
+        for data, offset in iov:
+            write_offset = 0
+            for extent in self._make_extents(offset, len(data)):
+                sub_iov = batches.setdefault(extent.device, [])
+                sub_iov.append(
+                    (data[write_offset:write_offset + extent.length], extent.start))
+                write_offset += extent.length
+        results = self._dispatch([(device.writev, (sub_iov,))
+                                  for device, sub_iov in batches.items()])
+        for result in results:
+            if not is_success(result):
+                return result
+        return err_success
+
+
+class Concat(Raid):
+
+    '''children laid out back to back, used by Lun to join its raids'''
+
+    def __init__(self, name, stripe=RAID_DEFAULT_STRIPE):
+        super(Concat, self).__init__(name, stripe)
+        self._table = ([0], ())
 
     @property
     def info(self):
-        return 'Raid0'
+        return 'Concat'
 
-    def build(self):
-        if len(self._children) > 0:
+    def build(self, validate=True):
+        if not validate or len(self._children) > 0:
             return err_success
-        self.logger.error('no disk in raid')
+        self.logger.error('no device in concat')
         return err_disk_not_enough
 
-    # this is not a real raid0, we perform data IO on disks one by one.
-    # to be improved
+    def update_size(self):
+        # start offset of every child plus the end, kept together with the
+        # children it was computed from so a mapping sees one consistent pair
+        offsets = [0]
+        for dev in self._children:
+            offsets.append(offsets[-1] + dev.size)
+        self._table = (offsets, tuple(self._children))
+        self._size = offsets[-1]
+        if self.parent is not None:
+            self.parent.update_size()
+
     def _make_extents(self, offset, length):
-        offset_passed = 0
+        offsets, devices = self._table
+        index = bisect.bisect_right(offsets, offset) - 1
         extents = []
+        while length > 0:
+            length_in_curr_dev = min(offsets[index + 1] - offset, length)
+            if length_in_curr_dev > 0:
+                extents.append(Extent(devices[index],
+                                      offset - offsets[index],
+                                      length_in_curr_dev))
+                offset += length_in_curr_dev
+                length -= length_in_curr_dev
+            index += 1
+        return extents
 
-        for device in self._children:
-            # find the first device in the io range
-            if offset > offset_passed + device.size:
-                offset_passed += device.size
-                continue
-            if offset > offset_passed:
-                offset_in_curr_dev = offset - offset_passed
-            else:
-                offset_in_curr_dev = 0
-            if length <= device.size - offset_in_curr_dev:
-                length_in_curr_dev = length
-            else:
-                length_in_curr_dev = device.size - offset_in_curr_dev
-            extents.append(
-                Extent(device, offset_in_curr_dev, length_in_curr_dev))
-            # increase the offset for next device mapping
-            offset_passed += device.size
-            length -= length_in_curr_dev
-            if length == 0:
-                break
+
+class Raid0(Raid):
+
+    @property
+    def info(self):
+        return 'Raid0, stripe: %d' % self._stripe
+
+    def build(self, validate=True):
+        if not validate:
+            return err_success
+        if len(self._children) == 0:
+            self.logger.error('no disk in raid')
+            return err_disk_not_enough
+        if self._member_size() == 0:
+            self.logger.error('disks are smaller than the stripe size')
+            return err_disk_not_enough
+        return err_success
+
+    def _member_size(self):
+        # only whole stripe units of the smallest disk are used
+        if not self._children:
+            return 0
+        smallest = min(dev.size for dev in self._children)
+        return smallest - smallest % self._stripe
+
+    def update_size(self):
+        self._size = self._member_size() * len(self._children)
+        if self.parent is not None:
+            self.parent.update_size()
+
+    # stripe unit n of the raid lives on disk n % disks, at stripe unit
+    # n / disks of that disk
+    def _make_extents(self, offset, length):
+        stripe = self._stripe
+        children = self._children
+        num = len(children)
+        extents = []
+        while length > 0:
+            unit, offset_in_unit = divmod(offset, stripe)
+            length_in_unit = min(stripe - offset_in_unit, length)
+            extents.append(Extent(children[unit % num],
+                                  (unit // num) * stripe + offset_in_unit,
+                                  length_in_unit))
+            offset += length_in_unit
+            length -= length_in_unit
         return extents
 
 
+class RoundRobinPolicy(object):
+
+    '''members take reads in turn'''
+
+    def __init__(self):
+        self._counter = itertools.count()
+
+    def choose(self, raid, members, offset):
+        return members[next(self._counter) % len(members)]
+
+
+class LeastOutstandingPolicy(object):
+
+    '''the member with the fewest reads in flight'''
+
+    def choose(self, raid, members, offset):
+        return min(members, key=raid.outstanding)
+
+
+class NearestOffsetPolicy(object):
+
+    '''the member whose last read ended closest to the offset, so a
+    sequential stream stays on one member'''
+
+    def choose(self, raid, members, offset):
+        return min(members, key=lambda dev: (abs(raid.last_offset(dev) - offset),
+                                             raid.outstanding(dev)))
+
+
+RAID1_READ_POLICIES = {
+    'round_robin': RoundRobinPolicy,
+    'least_outstanding': LeastOutstandingPolicy,
+    'nearest': NearestOffsetPolicy,
+}
+
+# latency samples kept for the hedge threshold
+RAID1_LATENCY_WINDOW = 1024
+RAID1_HEDGE_MIN_SAMPLES = 64
+RAID1_RESYNC_CHUNK = 1 * 1024 * 1024  # 1M copied per step of a resync
+
+
 class Raid1(Raid):
 
-    def __init__(self, name, stripe=RAID_DEFAULT_STRIPE):
-        raise FunctionalNotImplementError('Raid1')
+    OPTIONS = ('read_policy', 'hedge_percentile')
 
+    def __init__(self, name, stripe=RAID_DEFAULT_STRIPE,
+                 read_policy='round_robin', hedge_percentile=None):
+        super(Raid1, self).__init__(name, stripe)
+        policy = RAID1_READ_POLICIES.get(read_policy)
+        if policy is None:
+            raise InvalidArgumentError('Bad read policy: %s' % read_policy)
+        if hedge_percentile is not None and not 0 < hedge_percentile < 100:
+            raise InvalidArgumentError(
+                'Bad hedge percentile: %s' % hedge_percentile)
+        self._policy = policy()
+        self._hedge_percentile = hedge_percentile
+        self._hedge_threshold = None
+        self._latencies = collections.deque(maxlen=RAID1_LATENCY_WINDOW)
+        self._new_samples = 0
+        self._outstanding = collections.defaultdict(int)
+        self._last_offset = collections.defaultdict(int)
+        self._failed = set()
+        self._stat_lock = threading.Lock()
+        # members added to a built mirror take writes but serve no reads
+        # until a resync has copied the data onto them
+        self._built = False
+        self._syncing = set()
+        # a resync step and the writes to the mirror exclude each other
+        self._sync_cond = threading.Condition()
+        self._writing = 0
+        self._copying = False
 
-class Raid01(Raid):
+    @property
+    def info(self):
+        return 'Raid1'
 
-    def __init__(self, name, stripe=RAID_DEFAULT_STRIPE):
-        raise FunctionalNotImplementError('Raid01')
+    @property
+    def is_syncing(self):
+        return len(self._syncing) > 0
 
+    def add_disk(self, disk):
+        if self._built and disk not in self._children:
+            self._syncing.add(disk)
+        super(Raid1, self).add_disk(disk)
 
-class Raid10(Raid):
+    def add_disks(self, disks):
+        for disk in disks:
+            self.add_disk(disk)
 
-    def __init__(self, name, stripe=RAID_DEFAULT_STRIPE):
-        raise FunctionalNotImplementError('Raid10')
+    def remove_disk(self, disk):
+        super(Raid1, self).remove_disk(disk)
+        self._syncing.discard(disk)
+        self._failed.discard(disk)
+
+    @property
+    def is_degraded(self):
+        return len(self._failed) > 0
+
+    def outstanding(self, device):
+        return self._outstanding[device]
+
+    def last_offset(self, device):
+        return self._last_offset[device]
+
+    def build(self, validate=True):
+        if validate and len(self._children) < 2:
+            self.logger.error('raid1 needs at least 2 disks')
+            return err_disk_not_enough
+        self._built = True
+        return self._resync()
+
+    def _resync(self):
+        '''copy the data of the mirror onto the members added since it was
+        built, a step at a time while writes keep going to every member'''
+        syncing = [dev for dev in self._children if dev in self._syncing]
+        if not syncing:
+            return err_success
+        size = self.size
+        for offset in range(0, size, RAID1_RESYNC_CHUNK):
+            length = min(RAID1_RESYNC_CHUNK, size - offset)
+            with self._sync_cond:
+                self._copying = True
+                # writes which started before the step land first
+                while self._writing:
+                    self._sync_cond.wait()
+            try:
+                result, data = self._readv([(offset, length)])
+                if not is_success(result):
+                    return result
+                for device in syncing:
+                    if device not in self._failed:
+                        self._write_member(device, [(data[0], offset)])
+            finally:
+                with self._sync_cond:
+                    self._copying = False
+                    self._sync_cond.notify_all()
+        self._syncing.difference_update(syncing)
+        return err_success
+
+    def update_size(self):
+        if self._children:
+            self._size = min(dev.size for dev in self._children)
+        else:
+            self._size = 0
+        if self.parent is not None:
+            self.parent.update_size()
+
+    def _pool_size(self):
+        if self._hedge_percentile is None:
+            return len(self._children)
+        # room for hedged reads queued behind a slow member
+        return 4 * len(self._children)
+
+    def _members(self):
+        '''the members which serve reads'''
+        return [dev for dev in self._children
+                if dev not in self._failed and dev not in self._syncing]
+
+    def _targets(self):
+        '''the members which take writes, those being resynced included'''
+        return [dev for dev in self._children if dev not in self._failed]
+
+    @contextlib.contextmanager
+    def _write_barrier(self):
+        with self._sync_cond:
+            while self._copying:
+                self._sync_cond.wait()
+            self._writing += 1
+        try:
+            yield self._targets()
+        finally:
+            with self._sync_cond:
+                self._writing -= 1
+                if not self._writing:
+                    self._sync_cond.notify_all()
+
+    def _mark_failed(self, device, error):
+        self.logger.error('%s: disk %s failed: %s' %
+                          (self.name, device.name, error))
+        self._failed.add(device)
+
+    def _read_member(self, device, iov):
+        with self._stat_lock:
+            self._outstanding[device] += 1
+        start = time.time()
+        try:
+            result, data = device.readv(iov)
+        except StorgeError as e:
+            self._mark_failed(device, e)
+            result, data = err_disk_be_bad, []
+        latency = time.time() - start
+        with self._stat_lock:
+            self._outstanding[device] -= 1
+            offset, length = iov[-1]
+            self._last_offset[device] = offset + length
+            if is_success(result):
+                self._record_latency(latency)
+        return result, data
+
+    def _record_latency(self, latency):
+        self._latencies.append(latency)
+        if self._hedge_percentile is None:
+            return
+        # the threshold is refreshed every so many samples, not every read
+        self._new_samples += 1
+        if self._new_samples >= RAID1_HEDGE_MIN_SAMPLES:
+            self._new_samples = 0
+            samples = sorted(self._latencies)
+            index = int(len(samples) * self._hedge_percentile / 100.0)
+            self._hedge_threshold = samples[min(index, len(samples) - 1)]
+
+    def _hedged_read(self, first, members, iov, threshold):
+        futures = {self._submit(self._read_member, first, iov): first}
+        done, _ = concurrent.futures.wait(futures, timeout=threshold)
+        if not done:
+            # too slow, reissue the read on a second replica
+            others = [dev for dev in members if dev is not first]
+            second = self._policy.choose(self, others, iov[0][0])
+            futures[self._submit(self._read_member, second, iov)] = second
+        result, data = err_read_data_fail, []
+        for future in concurrent.futures.as_completed(futures):
+            result, data = future.result()
+            if is_success(result):
+                break
+        return result, data
+
+    def _readv(self, iov):
+        members = self._members()
+        if not members:
+            return err_disk_be_bad, []
+        first = self._policy.choose(self, members, iov[0][0])
+        threshold = self._hedge_threshold
+        if threshold is not None and len(members) > 1:
+            result, data = self._hedged_read(first, members, iov, threshold)
+        else:
+            result, data = self._read_member(first, iov)
+        if is_success(result):
+            return result, data
+        # fall back on the other replicas
+        for device in members:
+            if device is first:
+                continue
+            result, data = self._read_member(device, iov)
+            if is_success(result):
+                return result, data
+        return result, []
+
+    def _readv_into(self, iov):
+        return self._readv_into_by_copy(iov)
+
+    async def aread(self, offset, length):
+        if not self.is_valid_range(offset, length):
+            return err_invalid_argument, None
+        members = self._members()
+        if not members:
+            return err_disk_be_bad, None
+        first = self._policy.choose(self, members, offset)
+        # the chosen member first, the others as fallback
+        result, data = err_disk_be_bad, None
+        for device in [first] + [dev for dev in members if dev is not first]:
+            with self._stat_lock:
+                self._outstanding[device] += 1
+            try:
+                result, data = await device.aread(offset, length)
+            except StorgeError as e:
+                self._mark_failed(device, e)
+                result, data = err_disk_be_bad, None
+            finally:
+                with self._stat_lock:
+                    self._outstanding[device] -= 1
+                    self._last_offset[device] = offset + length
+            if is_success(result):
+                break
+        return result, data
+
+    async def awrite(self, data, offset):
+        if data is None:
+            return err_invalid_argument
+        data = byte_view(data)
+        if not self.is_valid_range(offset, len(data)):
+            return err_invalid_argument
+        with self._sync_cond:
+            syncing = bool(self._syncing)
+            if not syncing:
+                # counted as a write in flight, a resync waits for it
+                self._writing += 1
+        if syncing:
+            # the resync barrier blocks, wait for it off the event loop
+            return await self._in_executor(self._writev, [(data, offset)])
+        try:
+            members = self._targets()
+            if not members:
+                return err_disk_be_bad
+            results = await asyncio.gather(
+                *[device.awrite(data, offset) for device in members],
+                return_exceptions=True)
+        finally:
+            with self._sync_cond:
+                self._writing -= 1
+                if not self._writing:
+                    self._sync_cond.notify_all()
+        # every member which did not take the write is failed, the write
+        # stands as long as one replica holds it
+        written = False
+        for device, result in zip(members, results):
+            if isinstance(result, StorgeError):
+                self._mark_failed(device, result)
+            elif isinstance(result, BaseException):
+                raise result
+            elif is_success(result):
+                written = True
+            else:
+                self._mark_failed(device, 'write error %d' % result)
+        return err_success if written else err_disk_be_bad
+
+    def _write_member(self, device, iov):
+        try:
+            result = device.writev(iov)
+        except StorgeError as e:
+            self._mark_failed(device, e)
+            return err_disk_be_bad
+        if not is_success(result):
+            # the member missed the write, it must not serve reads
+            self._mark_failed(device, 'write error %d' % result)
+        return result
+
+    def _writev(self, iov):
+        with self._write_barrier() as members:
+            if not members:
+                return err_disk_be_bad
+            results = self._dispatch([(self._write_member, (device, iov))
+                                      for device in members])
+        # the write stands as long as one replica holds it
+        for result in results:
+            if is_success(result):
+                return err_success
+        return results[0]
+
+
+class NestedRaid(Raid):
+
+    '''a raid built from internal Raid0 and Raid1 arrays over its disks,
+    the internal arrays are made by build()'''
+
+    OPTIONS = ('mirror', 'read_policy', 'hedge_percentile')
+
+    def __init__(self, name, stripe=RAID_DEFAULT_STRIPE, mirror=2,
+                 read_policy='round_robin', hedge_percentile=None):
+        super(NestedRaid, self).__init__(name, stripe)
+        if mirror < 2:
+            raise InvalidArgumentError('Bad mirror width: %d' % mirror)
+        self._mirror = mirror
+        self._read_policy = read_policy
+        self._hedge_percentile = hedge_percentile
+        self._disks = []
+        self._top = None
+
+    @property
+    def mirror(self):
+        return self._mirror
+
+    # disks are held until build() lays them out
+    def add_disk(self, disk):
+        if disk not in self._disks:
+            self._disks.append(disk)
+            self._teardown()
+
+    def add_disks(self, disks):
+        for disk in disks:
+            if disk not in self._disks:
+                self._disks.append(disk)
+        self._teardown()
+
+    def remove_disk(self, disk):
+        if disk in self._disks:
+            self._disks.remove(disk)
+            self._teardown()
+
+    def _teardown(self):
+        top = self._top
+        if top is None:
+            return
+        self._top = None
+        self.remove_child(top)
+        for raid in [top] + top._children:
+            if isinstance(raid, Raid):
+                raid._shutdown_pool()
+
+    def _make_mirror(self, name, devices):
+        raid = Raid1(name, self._stripe, self._read_policy,
+                     self._hedge_percentile)
+        raid.add_disks(devices)
+        return raid
+
+    def _make_stripe(self, name, devices):
+        raid = Raid0(name, self._stripe)
+        raid.add_disks(devices)
+        return raid
+
+    def _make_layout(self):
+        raise NeedToBeImplementedError('need to implement by sub-class')
+
+    def build(self, validate=True):
+        num = len(self._disks)
+        if validate and (num < 2 * self._mirror or num % self._mirror != 0):
+            self.logger.error('%s needs a multiple of %d disks, at least %d' %
+                              (self.name, self._mirror, 2 * self._mirror))
+            return err_disk_not_enough
+        self._teardown()
+        top = self._make_layout()
+        for raid in top._children:
+            result = raid.build(validate)
+            if not is_success(result):
+                return result
+        result = top.build(validate)
+        if not is_success(result):
+            return result
+        self.add_child(top)
+        self._top = top
+        return err_success
+
+    def _readv(self, iov):
+        return self._top.readv(iov)
+
+    def _readv_into(self, iov):
+        return self._top.readv_into(iov)
+
+    async def aread(self, offset, length):
+        if self._top is None:
+            return err_invalid_argument, None
+        return await self._top.aread(offset, length)
+
+    async def awrite(self, data, offset):
+        if self._top is None:
+            return err_invalid_argument
+        return await self._top.awrite(data, offset)
+
+    def _writev(self, iov):
+        return self._top.writev(iov)
+
+
+class Raid01(NestedRaid):
+
+    '''a mirror of stripes: the disks are split into 'mirror' Raid0 sets
+    which are mirrored by a Raid1'''
+
+    @property
+    def info(self):
+        return 'Raid01, mirror: %d' % self._mirror
+
+    def _make_layout(self):
+        width = len(self._disks) // self._mirror
+        stripes = [self._make_stripe('%s_S%d' % (self.name, index),
+                                     self._disks[index * width:(index + 1) * width])
+                   for index in range(self._mirror)]
+        return self._make_mirror('%s_M' % self.name, stripes)
+
+
+class Raid10(NestedRaid):
+
+    '''a stripe of mirrors: every 'mirror' consecutive disks make a Raid1
+    and the Raid1 arrays are striped by a Raid0'''
+
+    @property
+    def info(self):
+        return 'Raid10, mirror: %d' % self._mirror
+
+    def _make_layout(self):
+        width = self._mirror
+        mirrors = [self._make_mirror('%s_M%d' % (self.name, index),
+                                     self._disks[index * width:(index + 1) * width])
+                   for index in range(len(self._disks) // width)]
+        return self._make_stripe('%s_S' % self.name, mirrors)
+
+
+# rows are serialized for writes through a fixed set of locks
+RAID5_ROW_LOCKS = 64
 
 
 class Raid5(Raid):
 
+    '''striping with rotating parity, each row holds one stripe unit per
+    disk, one of which is the XOR of the others'''
+
     def __init__(self, name, stripe=RAID_DEFAULT_STRIPE):
-        raise FunctionalNotImplementError('Raid5')
+        super(Raid5, self).__init__(name, stripe)
+        self._failed = set()
+        self._row_locks = [threading.Lock() for _ in range(RAID5_ROW_LOCKS)]
+
+    @property
+    def info(self):
+        return 'Raid5, stripe: %d' % self._stripe
+
+    @property
+    def is_degraded(self):
+        return len(self._failed) > 0
+
+    def build(self, validate=True):
+        if not validate:
+            return err_success
+        if len(self._children) < 3:
+            self.logger.error('raid5 needs at least 3 disks')
+            return err_disk_not_enough
+        if self._member_size() == 0:
+            self.logger.error('disks are smaller than the stripe size')
+            return err_disk_not_enough
+        return err_success
+
+    def _member_size(self):
+        if not self._children:
+            return 0
+        smallest = min(dev.size for dev in self._children)
+        return smallest - smallest % self._stripe
+
+    def update_size(self):
+        if len(self._children) > 1:
+            self._size = self._member_size() * (len(self._children) - 1)
+        else:
+            self._size = 0
+        if self.parent is not None:
+            self.parent.update_size()
+
+    def fail_disk(self, device):
+        if device not in self._children:
+            raise DeviceNotFoundError('%s is not in %s' %
+                                      (device.name, self.name))
+        self._mark_failed(device, 'failed by request')
+
+    def _mark_failed(self, device, error):
+        self.logger.error('%s: disk %s failed: %s' %
+                          (self.name, device.name, error))
+        self._failed.add(device)
+
+    # row r keeps its parity on disk n - 1 - r % n and its data units on
+    # the disks that follow it
+    def _layout(self, row):
+        num = len(self._children)
+        parity = num - 1 - row % num
+        return parity, [(parity + 1 + index) % num
+                        for index in range(num - 1)]
+
+    def _make_extents(self, offset, length):
+        stripe = self._stripe
+        children = self._children
+        num = len(children)
+        extents = []
+        while length > 0:
+            unit, offset_in_unit = divmod(offset, stripe)
+            row, index = divmod(unit, num - 1)
+            parity = num - 1 - row % num
+            length_in_unit = min(stripe - offset_in_unit, length)
+            extents.append(Extent(children[(parity + 1 + index) % num],
+                                  row * stripe + offset_in_unit,
+                                  length_in_unit))
+            offset += length_in_unit
+            length -= length_in_unit
+        return extents
+
+    @contextlib.contextmanager
+    def _locked_rows(self, rows):
+        indexes = sorted(set(row % RAID5_ROW_LOCKS for row in rows))
+        locks = [self._row_locks[index] for index in indexes]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def _member_readv(self, device, iov):
+        try:
+            return device.readv(iov)
+        except StorgeError as e:
+            self._mark_failed(device, e)
+            return err_disk_be_bad, []
+
+    def _member_writev(self, device, iov):
+        try:
+            return device.writev(iov)
+        except StorgeError as e:
+            self._mark_failed(device, e)
+            return err_disk_be_bad
+
+    def _gather(self, requests):
+        '''read a list of (device, start, length), one readv per member'''
+        batches = collections.OrderedDict()
+        for position, (device, start, length) in enumerate(requests):
+            sub_iov, slots = batches.setdefault(device, ([], []))
+            sub_iov.append((start, length))
+            slots.append(position)
+        results = self._dispatch([(self._member_readv, (device, sub_iov))
+                                  for device, (sub_iov, _) in batches.items()])
+        data = [None] * len(requests)
+        for (result, sub_data), (_, slots) in zip(results, batches.values()):
+            if not is_success(result):
+                return result, None
+            for position, read_data in zip(slots, sub_data):
+                data[position] = read_data
+        return err_success, data
+
+    def _scatter(self, requests):
+        '''write a list of (device, data, start), one writev per member'''
+        batches = collections.OrderedDict()
+        for device, data, start in requests:
+            batches.setdefault(device, []).append((data, start))
+        results = self._dispatch([(self._member_writev, (device, sub_iov))
+                                  for device, sub_iov in batches.items()])
+        # a write missing one member is still held by the parity
+        if len(self._failed) > 1:
+            return err_disk_be_bad
+        for result in results:
+            if not is_success(result) and result != err_disk_be_bad:
+                return result
+        return err_success
+
+    def _readv(self, iov):
+        result, data = self._read_extents(iov)
+        if not is_success(result) and len(self._failed) == 1:
+            # a disk failed under the read, go again in degraded mode
+            result, data = self._read_extents(iov)
+        return result, data
+
+    def _readv_into(self, iov):
+        return self._readv_into_by_copy(iov)
+
+    # parity updates hold row locks, so raid5 keeps its blocking path and
+    # runs it on the loop's executor
+    async def aread(self, offset, length):
+        return await self._in_executor(self.read, offset, length)
+
+    async def awrite(self, data, offset):
+        return await self._in_executor(self.write, data, offset)
+
+    def _read_extents(self, iov):
+        if len(self._failed) > 1:
+            return err_disk_be_bad, []
+        requests = []
+        plans = []
+        rows = set()
+        for offset, length in iov:
+            pieces = []
+            for extent in self._make_extents(offset, length):
+                first = len(requests)
+                if extent.device in self._failed:
+                    # rebuild the unit from every other member of the row
+                    rows.add(extent.start // self._stripe)
+                    for device in self._children:
+                        if device is not extent.device:
+                            requests.append(
+                                (device, extent.start, extent.length))
+                else:
+                    requests.append(
+                        (extent.device, extent.start, extent.length))
+                pieces.append((first, len(requests)))
+            plans.append(pieces)
+        with self._locked_rows(rows):
+            result, read_data = self._gather(requests)
+        if not is_success(result):
+            return result, []
+        data = []
+        for pieces in plans:
+            parts = []
+            for first, last in pieces:
+                if last - first == 1:
+                    parts.append(read_data[first])
+                else:
+                    parts.append(xor_buffers(read_data[first:last]))
+            if len(parts) == 1:
+                data.append(parts[0])
+            else:
+                data.append(b''.join(parts))
+        return err_success, data
+
+    def _writev(self, iov):
+        for data, offset in iov:
+            result = self._write(data, offset)
+            if not is_success(result):
+                return result
+        return err_success
+
+    def _write(self, data, offset):
+        # split the write into rows: row -> {data index: (start, end, data)}
+        rows = collections.OrderedDict()
+        view = memoryview(data)
+        stripe = self._stripe
+        data_per_row = len(self._children) - 1
+        position = 0
+        while position < len(view):
+            unit, start = divmod(offset + position, stripe)
+            row, index = divmod(unit, data_per_row)
+            length = min(stripe - start, len(view) - position)
+            rows.setdefault(row, {})[index] = (
+                start, start + length, view[position:position + length])
+            position += length
+        with self._locked_rows(rows):
+            result = self._write_rows(rows)
+            if not is_success(result) and len(self._failed) == 1:
+                # a disk failed while reading old data, nothing has been
+                # written yet, so go again in degraded mode
+                result = self._write_rows(rows)
+        return result
+
+    def _write_rows(self, rows):
+        if len(self._failed) > 1:
+            return err_disk_be_bad
+        children = self._children
+        stripe = self._stripe
+        reads = []
+        plans = []
+        for row, pieces in rows.items():
+            parity, data_disks = self._layout(row)
+            parity_device = children[parity]
+            low = min(start for start, _, _ in pieces.values())
+            high = max(end for _, end, _ in pieces.values())
+            first = len(reads)
+            if parity_device in self._failed:
+                mode = 'data'
+            elif len(pieces) == len(data_disks) and low == 0 and high == stripe \
+                    and all(end - start == stripe
+                            for start, end, _ in pieces.values()):
+                # full stripe, parity comes from the new data alone
+                mode = 'full'
+            elif any(children[data_disks[index]] in self._failed
+                     for index in pieces):
+                # old data of the failed disk is only known through the
+                # parity, so read the whole row range and rebuild it
+                mode = 'rebuild'
+                for device in [children[index] for index in data_disks] + \
+                        [parity_device]:
+                    if device not in self._failed:
+                        reads.append((device, row * stripe + low, high - low))
+            else:
+                # read-modify-write of the touched units and the parity
+                mode = 'rmw'
+                for index, (start, end, _) in pieces.items():
+                    reads.append((children[data_disks[index]],
+                                  row * stripe + start, end - start))
+                reads.append((parity_device, row * stripe + low, high - low))
+            plans.append((row, mode, parity_device, data_disks,
+                          pieces, low, high, first))
+
+        if reads:
+            result, old = self._gather(reads)
+            if not is_success(result):
+                return result
+
+        writes = []
+        for row, mode, parity_device, data_disks, pieces, low, high, first in plans:
+            base = row * stripe
+            for index, (start, _, data) in pieces.items():
+                device = children[data_disks[index]]
+                if device not in self._failed:
+                    writes.append((device, data, base + start))
+            if mode == 'data':
+                continue
+            if mode == 'full':
+                parity_data = xor_buffers(
+                    [pieces[index][2] for index in range(len(data_disks))])
+            elif mode == 'rmw':
+                parity_data = bytearray(old[first + len(pieces)])
+                for position, (start, end, data) in enumerate(pieces.values()):
+                    parity_data[start - low:end - low] = xor_buffers(
+                        [parity_data[start - low:end - low],
+                         old[first + position], data])
+            else:
+                units = {}
+                position = first
+                failed_index = None
+                for index, device in enumerate(data_disks):
+                    if children[device] in self._failed:
+                        failed_index = index
+                    else:
+                        units[index] = old[position]
+                        position += 1
+                units[failed_index] = xor_buffers(
+                    list(units.values()) + [old[position]])
+                for index, (start, end, data) in pieces.items():
+                    unit = bytearray(units[index])
+                    unit[start - low:end - low] = data
+                    units[index] = unit
+                parity_data = xor_buffers(list(units.values()))
+            writes.append((parity_device, parity_data, base + low))
+        return self._scatter(writes)
@@ -0,0 +1,221 @@
+#!/usr/bin/python
+
+import threading
+import itertools
+import collections
+import concurrent.futures
+
+from error import *
+from device import byte_view
+
+READAHEAD_MIN_WINDOW = 128 * 1024  # 128K
+READAHEAD_MAX_WINDOW = 2 * 1024 * 1024  # 2M
+READAHEAD_STREAMS = 8
+READAHEAD_WORKERS = 2
+READAHEAD_DEPTH = 2  # windows kept ahead of a stream
+
+
+class _Window(object):
+
+    __slots__ = ('start', 'end', 'future', 'used')
+
+    def __init__(self, start, end, future):
+        self.start = start
+        self.end = end
+        self.future = future
+        self.used = False
+
+
+class _Stream(object):
+
+    def __init__(self, next_offset, window):
+        # where the next read of the stream is expected
+        self.next = next_offset
+        self.window = window
+        self.windows = collections.deque()
+        self.hits = 0
+
+
+class Readahead(object):
+
+    '''sequential stream detection and prefetch for the reads of a device.
+
+    A read which starts where an earlier one ended confirms a stream. The
+    stream then keeps READAHEAD_DEPTH windows in flight ahead of it, read
+    on a thread pool, and reads inside them are served from memory. Every
+    window a stream consumes doubles its window size, up to max_window.
+    New streams start at a size which doubles when a retired stream used
+    all its windows and halves when windows were thrown away unread.
+
+    Writes must call invalidate, windows overlapping them are dropped.'''
+
+    def __init__(self, device, min_window=READAHEAD_MIN_WINDOW,
+                 max_window=READAHEAD_MAX_WINDOW, streams=READAHEAD_STREAMS,
+                 workers=READAHEAD_WORKERS):
+        if min_window <= 0 or max_window < min_window:
+            raise InvalidArgumentError('Bad readahead window: %d-%d' %
+                                       (min_window, max_window))
+        self._device = device
+        self._min_window = min_window
+        self._max_window = max_window
+        self._max_streams = streams
+        # stream id -> stream, least recently read first
+        self._streams = collections.OrderedDict()
+        self._ids = itertools.count()
+        self._window = min_window
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self.hits = 0
+        self.misses = 0
+        self.prefetched = 0
+        self.wasted = 0
+
+    @property
+    def window(self):
+        return self._window
+
+    def stats(self):
+        with self._lock:
+            return {'streams': len(self._streams), 'window': self._window,
+                    'hits': self.hits, 'misses': self.misses,
+                    'prefetched': self.prefetched, 'wasted': self.wasted}
+
+    def _fetch(self, start, length):
+        data = bytearray(length)
+        result = self._device.read_into(data, start)
+        return result, data
+
+    def _find(self, offset):
+        for key, stream in reversed(self._streams.items()):
+            windows = stream.windows
+            if stream.next == offset or (windows and windows[0].start <= offset <
+                                         windows[-1].end):
+                self._streams.move_to_end(key)
+                return stream
+        return None
+
+    def _drop(self, stream, windows):
+        for window in windows:
+            if not window.used:
+                self.wasted += window.end - window.start
+            window.future.cancel()
+
+    def _retire(self, stream):
+        if not stream.windows and not stream.hits:
+            # a lone read, never a stream
+            return
+        if any(not window.used for window in stream.windows):
+            self._window = max(self._min_window, self._window // 2)
+        else:
+            self._window = min(self._max_window, self._window * 2)
+        self._drop(stream, stream.windows)
+        stream.windows.clear()
+
+    def _track(self, next_offset):
+        self._streams[next(self._ids)] = _Stream(next_offset, self._window)
+        while len(self._streams) > self._max_streams:
+            _, stream = self._streams.popitem(last=False)
+            self._retire(stream)
+
+    def _cover(self, stream, offset, length):
+        '''the windows holding a range, None unless it is all prefetched'''
+        end = offset + length
+        pieces = []
+        for window in stream.windows:
+            if window.end <= offset or window.start >= end:
+                continue
+            if not pieces and window.start > offset:
+                return None
+            pieces.append(window)
+        if not pieces or pieces[-1].end < end:
+            return None
+        return pieces
+
+    def _advance(self, stream, position):
+        '''forget the windows behind position and keep the stream's
+        windows in flight ahead of it'''
+        windows = stream.windows
+        while windows and windows[0].end <= position:
+            self._drop(stream, [windows.popleft()])
+        size = self._device.size
+        while len(windows) < READAHEAD_DEPTH:
+            start = windows[-1].end if windows else position
+            if start >= size:
+                break
+            end = min(start + stream.window, size)
+            windows.append(_Window(start, end, self._executor.submit(
+                self._fetch, start, end - start)))
+            self.prefetched += end - start
+            stream.window = min(self._max_window, stream.window * 2)
+
+    def read_into(self, buffer, offset):
+        view = byte_view(buffer)
+        length = len(view)
+        if not self._device.is_valid_range(offset, length):
+            return err_invalid_argument
+        pieces = None
+        with self._lock:
+            stream = self._find(offset)
+            if stream is None:
+                self._track(offset + length)
+            else:
+                pieces = self._cover(stream, offset, length)
+                for window in pieces or []:
+                    window.used = True
+                stream.next = offset + length
+                if pieces is not None:
+                    stream.hits += 1
+                    self._advance(stream, offset)
+                else:
+                    # the stream is confirmed, prefetch behind this read
+                    self._advance(stream, offset + length)
+            if pieces is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if pieces is not None:
+            for window in pieces:
+                try:
+                    result, data = window.future.result()
+                except (concurrent.futures.CancelledError, StorgeError):
+                    # invalidated by a write before it ran, or failed,
+                    # the read goes to the device
+                    break
+                if not is_success(result):
+                    break
+                start = max(offset, window.start)
+                end = min(offset + length, window.end)
+                view[start - offset:end - offset] = \
+                    data[start - window.start:end - window.start]
+            else:
+                return err_success
+        return self._device.read_into(view, offset)
+
+    def read(self, offset, length):
+        data = bytearray(length)
+        result = self.read_into(data, offset)
+        if not is_success(result):
+            return result, None
+        return result, data
+
+    def invalidate(self, offset, length):
+        '''drop the windows of every stream overlapping a written range'''
+        end = offset + length
+        with self._lock:
+            for stream in self._streams.values():
+                if any(window.start < end and offset < window.end
+                       for window in stream.windows):
+                    # the stream refills from its next read
+                    self._drop(stream, stream.windows)
+                    stream.windows.clear()
+
+    def reset(self):
+        '''forget every stream, when the device changes size'''
+        with self._lock:
+            for stream in self._streams.values():
+                self._drop(stream, stream.windows)
+            self._streams.clear()
+
+    def close(self):
+        self.reset()
+        self._executor.shutdown(wait=True)
@@ -5,5 +5,13 @@ from log import Logger
 
 class Storage(object):
 
-    def __init__(self, log_filename='runtime.log'):
-        self.logger = Logger.get_logger(log_filename)
+    _log_filename = 'runtime.log'
+
+    def __init__(self, log_filename=None):
+        if log_filename is not None:
+            self._log_filename = log_filename
+
+    @property
+    def logger(self):
+        # fetched on first use, most objects never log
+        return Logger.get_logger(self._log_filename)
@@ -0,0 +1,53 @@
+#!/usr/bin/python
+
+import os
+import json
+import hashlib
+
+from error import *
+
+TOPOLOGY_CACHE_VERSION = 1
+
+
+class TopologyCache(object):
+
+    '''remembers the disk sizes of a tree which built and validated, keyed
+    on the system.json content alone, so a hit costs one hash and touches no
+    disk. It lets BlockSystem skip asking each disk for its size, which for
+    a network disk means connecting, and skip the raid checks. A file disk
+    whose size changed since is caught when it opens; remove the cache file
+    after resizing a disk.'''
+
+    def __init__(self, pathname):
+        self._pathname = pathname
+
+    @property
+    def pathname(self):
+        return self._pathname
+
+    @staticmethod
+    def make_key(conf_data):
+        return hashlib.sha1(conf_data).hexdigest()
+
+    def load(self, key):
+        '''return the cached disk sizes, or None when the cache is stale'''
+        try:
+            with open(self._pathname) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if cache.get('version') != TOPOLOGY_CACHE_VERSION or \
+                cache.get('key') != key:
+            return None
+        return cache.get('sizes')
+
+    def save(self, key, sizes):
+        cache = {'version': TOPOLOGY_CACHE_VERSION, 'key': key,
+                 'sizes': sizes}
+        temp = '%s.tmp' % self._pathname
+        try:
+            with open(temp, 'w') as f:
+                json.dump(cache, f)
+            os.replace(temp, self._pathname)
+        except OSError as e:
+            raise DeviceAccessError(str(e))
@@ -0,0 +1,443 @@
+#!/usr/bin/python
+
+import zlib
+import bisect
+import struct
+import threading
+import collections
+
+from error import *
+from device import byte_view
+from storage import Storage
+
+WAL_MAGIC = b'BWAL'
+WAL_RECORD_MAGIC = b'WREC'
+WAL_UNIT = 512  # records start on unit boundaries
+WAL_LOG_START = 4096  # the header owns the first block
+WAL_CHECKPOINT_INTERVAL = 1.0  # seconds
+
+# magic, crc32, tail position, sequence number of the record at the tail
+_HEADER = struct.Struct('!4sIQQ')
+# magic, crc32, sequence number, padded record size, extent count, name length
+_RECORD = struct.Struct('!4sIQIHH')
+# offset, length
+_EXTENT = struct.Struct('!QI')
+
+
+def _units(length):
+    return (length + WAL_UNIT - 1) // WAL_UNIT * WAL_UNIT
+
+
+def _crc(data):
+    return zlib.crc32(data) & 0xFFFFFFFF
+
+
+def _pack_header(tail, tail_seq):
+    body = struct.pack('!QQ', tail, tail_seq)
+    return _HEADER.pack(WAL_MAGIC, _crc(body), tail, tail_seq)
+
+
+def _pack_body(name, views):
+    '''the part of a record past its header, built without the log lock.
+    Return the body, its crc32 and where each extent's data starts'''
+    name = name.encode('utf-8')
+    parts = [name]
+    parts.extend(_EXTENT.pack(offset, len(data)) for data, offset in views)
+    parts.extend(data for data, _ in views)
+    body = b''.join(parts)
+    position = len(name) + len(views) * _EXTENT.size
+    starts = []
+    for data, _ in views:
+        starts.append(position)
+        position += len(data)
+    return body, zlib.crc32(body), starts
+
+
+def _pack_head(seq, size, count, name_length, body_crc):
+    # the crc covers the body, then the header fields after it
+    head = struct.pack('!QIHH', seq, size, count, name_length)
+    return WAL_RECORD_MAGIC + struct.pack(
+        '!I', zlib.crc32(head, body_crc) & 0xFFFFFFFF) + head
+
+
+def _wrap_marker(seq):
+    '''tells replay that the record of seq starts over at WAL_LOG_START'''
+    return _pack_head(seq, WAL_UNIT, 0, 0, 0) + bytes(WAL_UNIT - _RECORD.size)
+
+
+class _Record(object):
+
+    __slots__ = ('seq', 'lun', 'views', 'position', 'size', 'committed')
+
+    def __init__(self, seq, lun, views, position, size):
+        self.seq = seq
+        self.lun = lun
+        self.views = views
+        self.position = position
+        # log bytes the record holds, any wrapped space at the end included
+        self.size = size
+        self.committed = False
+
+
+class _Overlay(object):
+
+    '''the logged extents of one LUN which are not home yet'''
+
+    def __init__(self):
+        self.starts = []
+        self.extents = []
+        self.longest = 0
+
+    def add(self, seq, views):
+        for data, offset in views:
+            at = bisect.bisect_right(self.starts, offset)
+            self.starts.insert(at, offset)
+            self.extents.insert(at, (offset, seq, data))
+            self.longest = max(self.longest, len(data))
+
+    def find(self, offset, length):
+        end = offset + length
+        first = bisect.bisect_left(self.starts, offset - self.longest + 1)
+        last = bisect.bisect_left(self.starts, end)
+        return [extent for extent in self.extents[first:last]
+                if extent[0] + len(extent[2]) > offset]
+
+    def retire(self, seq):
+        kept = [extent for extent in self.extents if extent[1] > seq]
+        self.extents = kept
+        self.starts = [extent[0] for extent in kept]
+        self.longest = max([len(extent[2]) for extent in kept] or [0])
+
+
+class WriteAheadLog(Storage):
+
+    '''a circular log of LUN writes on its own disk.
+
+    A write becomes one record appended at the head of the log, and is
+    acknowledged once the log is flushed. Writers which arrive while a
+    flush runs queue behind it, and the first of them writes and flushes
+    the whole queue at once, so concurrent writers share one flush.
+    Logged writes are read from memory until a background checkpoint
+    writes them home, flushes the LUNs and moves the tail in the header
+    past them.
+
+    A record carries every extent of a writev and replay at startup
+    applies the records past the tail whole, a crash never leaves a torn
+    write. A write larger than half of the log is refused.'''
+
+    def __init__(self, disk, interval=WAL_CHECKPOINT_INTERVAL):
+        super(WriteAheadLog, self).__init__()
+        self._disk = disk
+        self._interval = interval
+        self._end = disk.size // WAL_UNIT * WAL_UNIT
+        if self._end - WAL_LOG_START < 2 * WAL_UNIT:
+            raise DeviceNoEnoughSpaceError('WAL disk %s is too small' %
+                                           disk.name)
+        self._head = WAL_LOG_START
+        self._used = 0
+        self._seq = 0
+        # every record in the log, oldest first, committed ones lead
+        self._records = collections.deque()
+        # (data, position) waiting for the next group commit
+        self._batch = []
+        self._committing = False
+        self._overlays = {}
+        self._broken = None
+        self._cond = threading.Condition()
+        self._checkpoint_lock = threading.Lock()
+        self._kick = threading.Event()
+        self._stop = False
+        self._checkpointer = None
+        self.commits = 0
+        self.records = 0
+        self.checkpoints = 0
+
+    @property
+    def disk(self):
+        return self._disk
+
+    @property
+    def capacity(self):
+        return self._end - WAL_LOG_START
+
+    def stats(self):
+        with self._cond:
+            return {'used': self._used, 'capacity': self.capacity,
+                    'pending': len(self._records), 'records': self.records,
+                    'commits': self.commits, 'checkpoints': self.checkpoints}
+
+    def _read_header(self):
+        result, data = self._disk.read(0, _HEADER.size)
+        if not is_success(result):
+            raise DeviceAccessError('read WAL header failed, error %d' % result)
+        magic, crc, tail, tail_seq = _HEADER.unpack(bytes(data))
+        if magic != WAL_MAGIC or crc != _crc(bytes(data[8:])) or \
+                not WAL_LOG_START <= tail < self._end:
+            return None
+        return tail, tail_seq
+
+    def _write_header(self, tail, tail_seq):
+        result = self._disk.write(_pack_header(tail, tail_seq), 0)
+        if is_success(result):
+            result = self._disk.flush()
+        if not is_success(result):
+            raise DeviceAccessError('write WAL header failed, error %d' % result)
+
+    def _read_record(self, position, seq):
+        '''return (size, name, views) of the record of seq at position, a
+        size of None for a wrap marker, or None at the end of the log'''
+        if position + _RECORD.size > self._end:
+            return None
+        result, head = self._disk.read(position, _RECORD.size)
+        if not is_success(result):
+            return None
+        magic, crc, record_seq, size, count, name_length = \
+            _RECORD.unpack(bytes(head))
+        if magic != WAL_RECORD_MAGIC or record_seq != seq or \
+                size < _RECORD.size or position + size > self._end:
+            return None
+        result, record = self._disk.read(position, size)
+        if not is_success(result):
+            return None
+        body = memoryview(bytes(record))[_RECORD.size:]
+        table = name_length
+        if table + count * _EXTENT.size > len(body):
+            return None
+        extents = [_EXTENT.unpack_from(body, table + i * _EXTENT.size)
+                   for i in range(count)]
+        start = table + count * _EXTENT.size
+        body_end = start + sum(length for _, length in extents)
+        if body_end > len(body) or crc != zlib.crc32(
+                bytes(head[8:]), zlib.crc32(body[:body_end])) & 0xFFFFFFFF:
+            return None
+        if count == 0:
+            return None, None, None
+        name = bytes(body[:name_length]).decode('utf-8')
+        views = []
+        for offset, length in extents:
+            views.append((body[start:start + length], offset))
+            start += length
+        return size, name, views
+
+    def replay(self, luns):
+        '''write the records past the tail home, call once at startup
+        before any write, luns maps names to LUNs'''
+        header = self._read_header()
+        position, seq = header if header is not None else (WAL_LOG_START, 0)
+        replayed = collections.OrderedDict()
+        count = 0
+        while True:
+            record = self._read_record(position, seq)
+            if record is None:
+                break
+            size, name, views = record
+            if size is None:
+                position = WAL_LOG_START
+                continue
+            lun = luns.get(name)
+            if lun is None:
+                self.logger.error('WAL record %d for missing LUN %s' %
+                                  (seq, name))
+            else:
+                result = lun.home_writev(views)
+                if not is_success(result):
+                    raise DeviceAccessError('replay WAL record %d failed, '
+                                            'error %d' % (seq, result))
+                replayed[lun] = True
+            count += 1
+            seq += 1
+            position += size
+            if position >= self._end:
+                position = WAL_LOG_START
+        for lun in replayed:
+            result = lun.flush()
+            if not is_success(result):
+                raise DeviceAccessError('flush LUN %s failed, error %d' %
+                                        (lun.name, result))
+        if count:
+            self.logger.info('WAL replayed %d records' % count)
+        # the log is empty from here on
+        self._write_header(position, seq)
+        self._head = position
+        self._seq = seq
+        return count
+
+    def start(self):
+        '''start the background checkpoint, after replay'''
+        self._checkpointer = threading.Thread(target=self._checkpoint_loop,
+                                              name='wal-checkpointer')
+        self._checkpointer.daemon = True
+        self._checkpointer.start()
+
+    def _reserve(self, size):
+        '''place a record of size at the head, return (position, wasted
+        bytes at the end of the log before it)'''
+        while True:
+            if self._broken is not None:
+                raise self._broken
+            waste = self._end - self._head if self._head + size > self._end \
+                else 0
+            if self._used + waste + size <= self.capacity:
+                break
+            # full, wait for the checkpoint to move the tail
+            self._kick.set()
+            self._cond.wait(self._interval)
+        position = WAL_LOG_START if waste else self._head
+        self._head = position + size
+        if self._head >= self._end:
+            self._head = WAL_LOG_START
+        self._used += waste + size
+        if self._used > self.capacity // 2:
+            self._kick.set()
+        return position, waste
+
+    def log(self, lun, views):
+        '''log a write of (data, offset) views to lun, return once it is
+        durable in the log'''
+        body, body_crc, starts = _pack_body(lun.name, views)
+        size = _units(_RECORD.size + len(body))
+        if size > self.capacity // 2:
+            self.logger.error('write of %d bytes does not fit the WAL' %
+                              len(body))
+            return err_invalid_argument
+        payload = memoryview(body)
+        logged = [(payload[start:start + len(data)], offset)
+                  for start, (data, offset) in zip(starts, views)]
+        with self._cond:
+            position, waste = self._reserve(size)
+            seq = self._seq
+            self._seq += 1
+            if waste:
+                self._batch.append((_wrap_marker(seq), self._end - waste))
+            self._batch.append((_pack_head(
+                seq, size, len(views), len(lun.name.encode('utf-8')),
+                body_crc), position))
+            self._batch.append((body, position + _RECORD.size))
+            padding = size - _RECORD.size - len(body)
+            if padding:
+                self._batch.append((bytes(padding), position + size - padding))
+            record = _Record(seq, lun, logged, position, waste + size)
+            self._records.append(record)
+            while not record.committed:
+                if self._broken is not None:
+                    raise self._broken
+                if self._committing:
+                    self._cond.wait()
+                    continue
+                self._commit()
+        return err_success
+
+    def _commit(self):
+        '''as the group leader write and flush everything queued, called
+        and returns with the lock held'''
+        self._committing = True
+        batch = self._batch
+        self._batch = []
+        # the records whose pieces are in the batch
+        pending = [record for record in self._records if not record.committed]
+        error = None
+        self._cond.release()
+        try:
+            result = self._disk.writev(batch)
+            if is_success(result):
+                result = self._disk.flush()
+            if not is_success(result):
+                error = DeviceAccessError('WAL write failed, error %d' % result)
+        except StorgeError as e:
+            error = e
+        finally:
+            self._cond.acquire()
+            self._committing = False
+            self._cond.notify_all()
+        if error is not None:
+            # later records would follow a hole in the log, stop logging
+            self._broken = error
+            self.logger.error('WAL is broken: %s' % error)
+            raise error
+        for record in pending:
+            record.committed = True
+            self._overlays.setdefault(record.lun, _Overlay()).add(
+                record.seq, record.views)
+        self.commits += 1
+        self.records += len(pending)
+
+    def readv_into(self, lun, iov, reader):
+        '''read iov through reader, then lay the logged writes which are not
+        home yet over it'''
+        with self._cond:
+            overlay = self._overlays.get(lun)
+            patches = None
+            if overlay is not None:
+                patches = [overlay.find(offset, len(buffer))
+                           for buffer, offset in iov]
+        result = reader(iov)
+        if not is_success(result) or not patches:
+            return result
+        for (buffer, offset), extents in zip(iov, patches):
+            end = offset + len(buffer)
+            for start, _, data in sorted(extents, key=lambda extent: extent[1]):
+                first = max(start, offset)
+                last = min(start + len(data), end)
+                buffer[first - offset:last - offset] = \
+                    data[first - start:last - start]
+        return result
+
+    def checkpoint(self):
+        '''write the committed records home and free their log space'''
+        with self._checkpoint_lock:
+            with self._cond:
+                records = []
+                for record in self._records:
+                    if not record.committed:
+                        break
+                    records.append(record)
+            if not records:
+                return err_success
+            luns = collections.OrderedDict()
+            for record in records:
+                result = record.lun.home_writev(record.views)
+                if not is_success(result):
+                    self.logger.error('checkpoint to %s failed, error %d' %
+                                      (record.lun.name, result))
+                    return result
+                luns[record.lun] = True
+            for lun in luns:
+                result = lun.flush()
+                if not is_success(result):
+                    return result
+            last = records[-1]
+            with self._cond:
+                following = self._records[len(records)] \
+                    if len(self._records) > len(records) else None
+                tail = self._head if following is None else following.position
+            # the new tail is durable before its space is reused
+            self._write_header(tail, last.seq + 1)
+            with self._cond:
+                for _ in records:
+                    self._used -= self._records.popleft().size
+                for lun in luns:
+                    overlay = self._overlays[lun]
+                    overlay.retire(last.seq)
+                    if not overlay.extents:
+                        del self._overlays[lun]
+                self.checkpoints += 1
+                self._cond.notify_all()
+        return err_success
+
+    def _checkpoint_loop(self):
+        while not self._stop:
+            self._kick.wait(self._interval)
+            self._kick.clear()
+            try:
+                self.checkpoint()
+            except StorgeError as e:
+                self.logger.error('WAL checkpoint: %s' % e)
+
+    def close(self):
+        self._stop = True
+        self._kick.set()
+        if self._checkpointer is not None:
+            self._checkpointer.join()
+        result = self.checkpoint()
+        self._disk.close()
+        return result
@@ -0,0 +1,332 @@
+#!/usr/bin/python
+
+import json
+import zlib
+import collections
+import threading
+import itertools
+import contextlib
+import multiprocessing
+from multiprocessing import shared_memory
+
+from error import *
+from log import Logger
+from lun import Lun
+from raid import Raid1, Raid5
+from disk import MemoryDisk
+from block_system import BlockSystem
+
+WORKER_SLOT = 1 * 1024 * 1024  # 1M, also the routing region of a LUN
+WORKER_SLOTS = 64
+
+_OP_READ = 1
+_OP_WRITE = 2
+_OP_FLUSH = 3
+_OP_STOP = 4
+
+
+def _spreadable(lun):
+    '''true when any process may serve any region of the LUN: a plain LUN
+    over file or network disks, without QoS or readahead and without RAID1
+    or RAID5, whose failed members and parity rows are only known inside
+    one process'''
+    if type(lun) is not Lun or lun.qos is not None or \
+            lun.readahead is not None:
+        return False
+    devices = [lun]
+    while devices:
+        device = devices.pop()
+        if isinstance(device, (Raid1, Raid5, MemoryDisk)):
+            return False
+        devices.extend(device.children)
+    return True
+
+
+def _lun_groups(sys_conf):
+    '''map every LUN, snapshots included, to the name of its group: LUNs
+    which share a raid, directly or through a pool, are in one group, to
+    be served by the one process which holds the state of the raid or the
+    pool'''
+    pools = dict((conf['name'], conf['raids'])
+                 for conf in sys_conf.get('pools', []))
+    # raid name -> group of the LUNs over it
+    owners = {}
+    groups = {}
+    for conf in sys_conf.get('luns', []):
+        name = conf['name']
+        raids = pools[conf['pool']] if 'pool' in conf else conf.get('raids', [])
+        merged = set(owners[raid_name] for raid_name in raids
+                     if raid_name in owners)
+        group = min(merged | set([name]))
+        for lun_name, lun_group in groups.items():
+            if lun_group in merged:
+                groups[lun_name] = group
+        for raid_name, raid_group in owners.items():
+            if raid_group in merged:
+                owners[raid_name] = group
+        for raid_name in raids:
+            owners[raid_name] = group
+        groups[name] = group
+        for snapshot in conf.get('snapshots', []):
+            groups[snapshot['name']] = group
+    return groups
+
+
+def _worker_main(index, system_db_name, shm_name, requests, responses):
+    logger = Logger.get_logger('runtime.log')
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        bs = BlockSystem(system_db_name)
+    except Exception as e:
+        responses.put((None, index, str(e)))
+        shm.close()
+        return
+    responses.put((None, index, dict(
+        (name, (lun.size, _spreadable(lun))) for name, lun in bs.luns.items())))
+    while True:
+        rid, op, name, offset, start, length = requests.get()
+        if op == _OP_STOP:
+            break
+        view = shm.buf[start:start + length]
+        try:
+            if op == _OP_READ:
+                result = bs.luns[name].read_into(view, offset)
+            elif op == _OP_WRITE:
+                result = bs.luns[name].write(view, offset)
+            else:
+                result = bs.flush()
+        except StorgeError as e:
+            logger.error('worker %d: %s' % (index, e))
+            result = err_read_data_fail if op == _OP_READ else \
+                err_write_data_fail
+        finally:
+            view.release()
+        responses.put((rid, result, None))
+    bs.close()
+    shm.close()
+
+
+class _Pending(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+
+
+class _Buffer(object):
+
+    def __init__(self, view, start=None):
+        self.view = view
+        # offset in the shared memory, None for a private buffer
+        self.start = start
+
+
+class _Slots(object):
+
+    '''hands out runs of back to back slots of the shared memory'''
+
+    def __init__(self, count):
+        self._used = bytearray(count)
+        self._cond = threading.Condition()
+
+    def take(self, count):
+        with self._cond:
+            while True:
+                start = self._used.find(bytes(count))
+                if start != -1:
+                    self._used[start:start + count] = b'\x01' * count
+                    return start
+                self._cond.wait()
+
+    def give(self, start, count):
+        with self._cond:
+            self._used[start:start + count] = bytes(count)
+            self._cond.notify_all()
+
+
+class WorkerPool(object):
+
+    '''a BlockSystem loaded by several worker processes, so LUN I/O runs on
+    more than one core. Payloads stay in one shared memory segment, only
+    (offset, length) tuples cross the process boundary.
+
+    A plain LUN is split into WORKER_SLOT regions which hash to workers,
+    so requests to one region stay ordered. Every other LUN keeps in-process
+    state (chunk maps, indexes, parity locks, failed mirrors, QoS buckets,
+    memory disks) and is pinned to one worker, together with every LUN it
+    shares a raid or a pool with.'''
+
+    def __init__(self, system_db_name, workers=None, slots=WORKER_SLOTS):
+        self.logger = Logger.get_logger('runtime.log')
+        with open(system_db_name) as f:
+            sys_conf = json.load(f)
+        if 'wal' in sys_conf:
+            # every worker would replay and append to the same log
+            raise InvalidArgumentError('a WAL needs a single process')
+        self._groups = _lun_groups(sys_conf)
+        sizes = collections.Counter(self._groups.values())
+        # groups of more than one LUN are pinned whole to a worker
+        self._shared = set(group for group, size in sizes.items() if size > 1)
+        self._num_workers = workers or multiprocessing.cpu_count()
+        self._num_slots = slots
+        self._shm = shared_memory.SharedMemory(create=True,
+                                               size=slots * WORKER_SLOT)
+        self._slots = _Slots(slots)
+        self._ids = itertools.count(1)
+        self._pending = {}
+        self._lock = threading.Lock()
+        context = multiprocessing.get_context('spawn')
+        self._responses = context.Queue()
+        self._requests = []
+        self._processes = []
+        for index in range(self._num_workers):
+            requests = context.Queue()
+            process = context.Process(
+                target=_worker_main, name='block-worker-%d' % index,
+                args=(index, system_db_name, self._shm.name, requests,
+                      self._responses))
+            process.daemon = True
+            process.start()
+            self._requests.append(requests)
+            self._processes.append(process)
+
+        self._luns = None
+        errors = []
+        for _ in range(self._num_workers):
+            _, index, info = self._responses.get()
+            if isinstance(info, str):
+                errors.append('worker %d: %s' % (index, info))
+            elif self._luns is None:
+                self._luns = info
+        if errors:
+            self.close()
+            raise DeviceNotAvailableError('; '.join(errors))
+        self._receiver = threading.Thread(target=self._receive)
+        self._receiver.daemon = True
+        self._receiver.start()
+
+    @property
+    def num_workers(self):
+        return self._num_workers
+
+    @property
+    def capacity(self):
+        return self._num_slots * WORKER_SLOT
+
+    def size_of(self, name):
+        info = self._luns.get(name)
+        return None if info is None else info[0]
+
+    def _receive(self):
+        while True:
+            rid, result, _ = self._responses.get()
+            if rid is None:
+                return
+            with self._lock:
+                pending = self._pending.pop(rid)
+            pending.result = result
+            pending.event.set()
+
+    def _submit(self, worker, op, name, offset, start, length):
+        rid = next(self._ids)
+        pending = _Pending()
+        with self._lock:
+            self._pending[rid] = pending
+        self._requests[worker].put((rid, op, name, offset, start, length))
+        return pending
+
+    def _route(self, name, offset, length):
+        '''split a range into (worker, position, offset, length)'''
+        group = self._groups.get(name, name)
+        seed = zlib.crc32(group.encode('utf-8'))
+        if not self._luns[name][1] or group in self._shared:
+            yield seed % self._num_workers, 0, offset, length
+            return
+        position = 0
+        while position < length:
+            region, start = divmod(offset + position, WORKER_SLOT)
+            piece = min(WORKER_SLOT - start, length - position)
+            yield (seed + region) % self._num_workers, position, \
+                offset + position, piece
+            position += piece
+
+    def _run(self, op, name, offset, start, length):
+        '''run a range whose payload is at start in shared memory'''
+        pending = [self._submit(worker, op, name, piece_offset,
+                                start + position, piece)
+                   for worker, position, piece_offset, piece
+                   in self._route(name, offset, length)]
+        result = err_success
+        for item in pending:
+            item.event.wait()
+            if not is_success(item.result) and is_success(result):
+                result = item.result
+        return result
+
+    @contextlib.contextmanager
+    def buffer(self, length):
+        '''a _Buffer for a payload, in shared memory when it fits'''
+        count = (length + WORKER_SLOT - 1) // WORKER_SLOT
+        if count == 0 or count > self._num_slots:
+            yield _Buffer(memoryview(bytearray(length)))
+            return
+        first = self._slots.take(count)
+        start = first * WORKER_SLOT
+        view = self._shm.buf[start:start + length]
+        try:
+            yield _Buffer(view, start)
+        finally:
+            view.release()
+            self._slots.give(first, count)
+
+    def _valid(self, name, offset, length):
+        info = self._luns.get(name)
+        return info is not None and offset >= 0 and length > 0 and \
+            offset + length <= info[0]
+
+    def read(self, name, buffer, offset):
+        '''fill a _Buffer from buffer()'''
+        return self._transfer(_OP_READ, name, buffer, offset)
+
+    def write(self, name, buffer, offset):
+        return self._transfer(_OP_WRITE, name, buffer, offset)
+
+    def _transfer(self, op, name, buffer, offset):
+        length = len(buffer.view)
+        if not self._valid(name, offset, length):
+            return err_invalid_argument
+        if buffer.start is not None:
+            return self._run(op, name, offset, buffer.start, length)
+        # too large for the shared memory, go through it a window at a time
+        window = self.capacity // 2
+        for position in range(0, length, window):
+            piece = min(window, length - position)
+            with self.buffer(piece) as shared:
+                if op == _OP_WRITE:
+                    shared.view[:] = buffer.view[position:position + piece]
+                result = self._run(op, name, offset + position, shared.start,
+                                   piece)
+                if not is_success(result):
+                    return result
+                if op == _OP_READ:
+                    buffer.view[position:position + piece] = shared.view
+        return err_success
+
+    def flush(self):
+        pending = [self._submit(worker, _OP_FLUSH, None, 0, 0, 0)
+                   for worker in range(self._num_workers)]
+        result = err_success
+        for item in pending:
+            item.event.wait()
+            if not is_success(item.result) and is_success(result):
+                result = item.result
+        return result
+
+    def close(self):
+        for requests in self._requests:
+            requests.put((None, _OP_STOP, None, 0, 0, 0))
+        for process in self._processes:
+            process.join()
+        self._responses.put((None, None, None))
+        self._shm.close()
+        self._shm.unlink()